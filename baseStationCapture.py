@@ -2,6 +2,8 @@
 
 from ublox2 import UbloxReader
 from ubloxMessage import UbloxMessage, clearMaskShiftDict, CLIDPAIR
+from ubxConfig import applyConfig
+from rtcmServer import CorrectionServer, parseMountpoint, DEFAULT_MAX_CLIENTS
 import serial
 import serial.threaded
 import time
@@ -9,6 +11,7 @@ import datetime
 import calendar
 import logging
 import os
+import collections
 
 fixTypeDict = {0: 'NO', 1: 'DR', 2: '2D', 3: '3D', 4: '3D+DR', 5: 'Time'}
 fusionModeDict = {0: 'INIT', 1: 'ON', 2: 'Suspended', 3: 'Disabled'}
@@ -60,14 +63,60 @@ def setMessageRate(ser, ublox, messageType, rate, port=None):
     if port is None:
         ublox.sendConfig(ser, 'CFG-MSG', 3, {'msgClass': messageClass, 'msgId': messageId, 'rate': rate})
     else:
-        msgFormat, msgData = ublox.poll(ser, 'CFG-MSG', 2, {'msgClass': messageClass, 'msgId': messageId})
+        # Only match the CFG-MSG response for this message type
+        match = lambda msgData: msgData[0]['msgClass'] == messageClass and msgData[0]['msgId'] == messageId
+        msgFormat, msgData = ublox.poll(ser, 'CFG-MSG', 2, {'msgClass': messageClass, 'msgId': messageId}, match=match)
         msgData[port+1]['rate'] = rate
         ublox.sendConfig(ser, msgFormat, 8, msgData)
 
-def messageHandler(msgTime, msgFormat, msgData, rawMessage):
-    global logger, dataRate, dataRateStartTime, dataCaptured, timestamp, epoch, dt, offset, lat, lon, alt, speed, hAcc, vAcc, hdop, numSats, avgCNO, fix, timeValid, output, display, dataRate, msSinceStartup, messageCount
+# Messages enabled by configureReceiver, as (message type, rate)
+MESSAGE_LIST = [('NAV-PVT', 1), ('NAV-STATUS', 1), ('NAV-SVINFO', 1), ('RXM-RAWX', 1), ('RXM-SFRBX', 1)]
+# Corrections added for --rtcm-server. The receiver only outputs them in survey-in or fixed mode (CFG-TMODE3).
+RTCM_MESSAGE_LIST = [('RTCM-REFSTATIONARP', 10), ('RTCM-GPSMSM7', 1), ('RTCM-GLOMSM7', 1), ('RTCM-BEIMSM7', 1), ('RTCM-GLOCODE', 10)]
 
-    curTimestamp = time.time()
+def configureReceiver(ser, ublox, measurementRate, messageList=MESSAGE_LIST, port=None):
+    logger.info('*** Configuring receiver...')
+    # Set measurement rate to 1 Hz during config to prevent problems
+    logger.info('Setting measurement rate to 1 Hz...')
+    ublox.sendConfig(ser, 'CFG-RATE', 6, {'Meas': 1000, 'Nav': 1, 'Time': 1})
+
+    # Reset to default config
+    clearMask = UbloxMessage.buildMask(['msgConf'], clearMaskShiftDict)
+    logger.info('Restoring message configuration...')
+    ublox.sendConfig(ser, 'CFG-CFG', 12, {'clearMask': clearMask, 'saveMask': 0, 'loadMask': clearMask})
+
+    # Set power management settings
+    logger.info('Setting power management to full power...')
+    ublox.sendConfig(ser, 'CFG-PMS', 8, {'Version': 0, 'PowerSetupValue': 0, 'Period': 0, 'OnTime': 0})
+
+    # Disable NMEA output - UBX only, plus RTCM3 if any RTCM messages are enabled
+    logger.info('Polling for port config (CFG-PRT)...')
+    msgFormat, msgData = ublox.poll(ser, 'CFG-PRT')
+    UbloxMessage.printMessage(msgFormat, msgData)
+    logger.info('Disabling NMEA output (CFG-PRT)...')
+    msgData[1]["Out_proto_mask"] = 0x21 if any(message.startswith('RTCM-') for message, rate in messageList) else 1
+    ublox.sendConfig(ser, msgFormat, 20, msgData)
+
+    # Enable messages - the CFG-MSG polls and writes are pipelined
+    logger.info('Enabling {} messages...'.format(', '.join(message for message, rate in messageList)))
+    rates = collections.OrderedDict((message, rate if port is None else {port: rate}) for message, rate in messageList)
+    applyConfig(ublox, ser, {'CFG-MSG': rates})
+
+    # Configure constellations (CFG-GNSS)
+
+    # Configure automobile dynamics (CFG-NAV5)
+
+    # Set measurement rate to desired
+    logger.info('Setting measurement rate to {} Hz...'.format(measurementRate))
+    measurementInterval = int(1./measurementRate*1000)
+    navRate = measurementRate
+    ublox.sendConfig(ser, 'CFG-RATE', 6, {'Meas': measurementInterval, 'Nav': navRate, 'Time': 1})
+
+    logger.info('*** Configuration complete!')
+
+# Subscribed to every message without decoding - data rate and message counts
+def countHandler(msgTime, msgFormat, msgData, rawMessage):
+    global dataRate, dataRateStartTime, dataCaptured, messageCount
 
     if dataRateStartTime is None:
         dataRateStartTime = time.time()
@@ -86,6 +135,12 @@ def messageHandler(msgTime, msgFormat, msgData, rawMessage):
         messageCount[msgFormat] = 0
     messageCount[msgFormat] += 1
 
+# Subscribed to NAV-PVT, NAV-STATUS and NAV-SVINFO
+def messageHandler(msgTime, msgFormat, msgData, rawMessage):
+    global logger, timestamp, epoch, dt, offset, lat, lon, alt, speed, hAcc, vAcc, hdop, numSats, avgCNO, fix, timeValid, output, display, dataRate, msSinceStartup, messageCount
+
+    curTimestamp = time.time()
+
     if msgFormat == 'NAV-PVT':
         epoch = msgData[0]['ITOW']/1e3
         
@@ -159,6 +214,13 @@ if __name__=='__main__':
     parser.add_argument('--configure', '-c', action='store_true', help='Configure the receiver')
     parser.add_argument('--measurementRate', '-m', type=int, choices=[1, 2, 5, 10], default=5, help='Specify the GNSS measurement rate')
     parser.add_argument('--interval', '-i', choices=['daily', 'hourly'], default=None, help='Specify file interval (daily, hourly)')
+    parser.add_argument('--max-size', type=float, help='Also start a new file when one reaches this many MB')
+    parser.add_argument('--fsync', type=float, help='Sync the save file to storage every this many seconds')
+    parser.add_argument('--compress', choices=['zlib', 'lzma'], help='Save seekable compressed .ubz files')
+    parser.add_argument('--rtcm-server', type=int, metavar='PORT', help='Serve the RTCM3 corrections to NTRIP clients on this TCP port')
+    parser.add_argument('--mountpoint', action='append', help='Correction server mountpoint NAME[:TYPES][:TYPE/N,...], see rtcmServer.py. Default BASE with all types.')
+    parser.add_argument('--max-clients', type=int, default=DEFAULT_MAX_CLIENTS, help='Correction server client limit')
+    parser.add_argument('--credentials', help='user:password the correction clients must give')
     parser.add_argument('--logFile', '-l', help='Path to log file')
     parser.add_argument('--debug', action='store_true')
     args = parser.parse_args()
@@ -180,63 +242,50 @@ if __name__=='__main__':
 
     logger.info('***** Session start *****')
 
+    server = None
+    if args.rtcm_server is not None:
+        try:
+            mountpoints = [parseMountpoint(spec) for spec in args.mountpoint or ['BASE']]
+        except ValueError as exc:
+            parser.error(str(exc))
+        server = CorrectionServer(mountpoints, port=args.rtcm_server, maxClients=args.max_clients, credentials=args.credentials, logger=logger)
+
     ser = serial.Serial(args.device, 921600, timeout=1)
     with serial.threaded.ReaderThread(ser, UbloxReader) as ublox:
         if args.output is not None:
             ublox.saveFileName = os.path.join(args.output, 'ublox')
         ublox.logger = logger
         ublox.setSaveInterval(args.interval)
+        ublox.saveMaxFileSize = int(args.max_size*1e6) if args.max_size is not None else None
+        ublox.saveFsyncInterval = args.fsync
+        ublox.saveCompression = args.compress
         ublox.printMessageFlag = False
-        ublox.userHandler = messageHandler
+        ublox.subscribe(None, countHandler, decode=False)
+        ublox.subscribe(['NAV-PVT', 'NAV-STATUS', 'NAV-SVINFO'], messageHandler)
+
+        if server is not None:
+            # RTCM3 frames are taken out of the stream by the reader thread and served from this one
+            ublox.scanner.rtcmCallback = server.handleFrame
 
         if args.configure:
-            logger.info('*** Configuring receiver...')
-            # Set measurement rate to 1 Hz during config to prevent problems
-            logger.info('Setting measurement rate to 1 Hz...')
-            ublox.sendConfig(ser, 'CFG-RATE', 6, {'Meas': 1000, 'Nav': 1, 'Time': 1})
-
-            # Reset to default config
-            clearMask = UbloxMessage.buildMask(['msgConf'], clearMaskShiftDict)
-            logger.info('Restoring message configuration...')
-            ublox.sendConfig(ser, 'CFG-CFG', 12, {'clearMask': clearMask, 'saveMask': 0, 'loadMask': clearMask})
-
-            # Set power management settings
-            logger.info('Setting power management to full power...')
-            ublox.sendConfig(ser, 'CFG-PMS', 8, {'Version': 0, 'PowerSetupValue': 0, 'Period': 0, 'OnTime': 0})            
-            
-            # Disable NMEA output - UBX only
-            logger.info('Polling for port config (CFG-PRT)...')
-            msgFormat, msgData = ublox.poll(ser, 'CFG-PRT')
-            UbloxMessage.printMessage(msgFormat, msgData)
-            logger.info('Disabling NMEA output (CFG-PRT)...')
-            msgData[1]["Out_proto_mask"] = 1
-            ublox.sendConfig(ser, msgFormat, 20, msgData)
-
-            # Enable messages
-            rate = 1
-            messageList = [('NAV-PVT', 1), ('NAV-STATUS', 1), ('NAV-SVINFO', 1), ('RXM-RAWX', 1), ('RXM-SFRBX', 1)]
-            for message, rate in messageList:
-                print('Enabling {} message...'.format(message))
-                setMessageRate(ser, ublox, message, rate)
-
-            # Configure constellations (CFG-GNSS)
-
-            # Configure automobile dynamics (CFG-NAV5)
-            
-            # Set measurement rate to desired
-            logger.info('Setting measurement rate to {} Hz...'.format(args.measurementRate))
-            measurementInterval = int(1./args.measurementRate*1000)
-            navRate = args.measurementRate
-            ublox.sendConfig(ser, 'CFG-RATE', 6, {'Meas': measurementInterval, 'Nav': navRate, 'Time': 1})
-
-            logger.info('*** Configuration complete!')
+            configureReceiver(ser, ublox, args.measurementRate, MESSAGE_LIST + RTCM_MESSAGE_LIST if server is not None else MESSAGE_LIST)
 
 
         ublox.saveStreamFlag = True
+        lastStatsTime = time.time()
         while 1:
             try:
-                time.sleep(1)
+                if server is not None:
+                    server.poll(1.0)
+                    if time.time() - lastStatsTime > 10:
+                        logger.info(CorrectionServer.formatStats(server.stats(reset=True)))
+                        lastStatsTime = time.time()
+                else:
+                    time.sleep(1)
             except KeyboardInterrupt:
                 break
 
+    if server is not None:
+        server.close()
+
 
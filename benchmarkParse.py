@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the UBX parse, decode, checksum and build paths
+
+A synthetic corpus is built with UbloxMessage.buildMessage from NAV-PVT,
+NAV-SAT, RXM-RAWX and ESF-MEAS messages mixed with NMEA sentences, corrupted
+frames (a flipped payload byte) and truncated frames. The corpus is seeded, so
+the same --size and --seed always give the same bytes.
+
+Each benchmark runs in its own process and reports frames/s, MB/s, the peak
+memory allocated by Python during one run (tracemalloc) and the peak RSS of
+the process. Results can be saved as a baseline and later runs compared
+against it, exiting with an error if any benchmark regressed by more than the
+tolerance.
+
+    ./benchmarkParse.py --save-baseline baseline.json
+    ./benchmarkParse.py --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+from collections import OrderedDict
+
+from ubloxMessage import UbloxMessage, MSGFMT
+
+NMEA_SENTENCES = [b'$GNGGA,005500.00,3747.15334,N,12216.28046,W,1,12,0.79,10.2,M,-29.9,M,,*4B\r\n',
+                  b'$GNRMC,005500.00,A,3747.15334,N,12216.28046,W,0.012,,010126,,,A*7C\r\n',
+                  b'$GNGSA,A,3,05,13,15,18,20,23,24,,,,,,1.35,0.79,1.09*1D\r\n']
+
+# Fraction of the frames that are corrupted or truncated
+CORRUPT_RATE = 0.01
+TRUNCATE_RATE = 0.005
+NMEA_RATE = 0.1
+
+# Stream parsers are fed the corpus in reads of this size
+READ_SIZE = 4096
+
+
+def buildCorpus(size, seed=0):
+    # Returns (corpus bytes, number of intact UBX frames)
+    rng = random.Random(seed)
+    pvtFields = MSGFMT[('NAV-PVT', 92)][1]
+    chunks = []
+    total = 0
+    numFrames = 0
+    epoch = 0
+    while total < size:
+        iTOW = epoch * 200
+        messages = []
+
+        pvt = dict((field, 0) for field in pvtFields)
+        pvt.update(ITOW=iTOW, Year=2026, Month=1, Day=1, Hour=(epoch // 18000) % 24, Min=(epoch // 300) % 60,
+                   Sec=(epoch // 5) % 60, Nano=(epoch % 5) * 200000000, Valid=0x37, FixType=3, NumSV=rng.randint(8, 30),
+                   LON=-1222713410 + rng.randint(-1000, 1000), LAT=377858890 + rng.randint(-1000, 1000),
+                   HEIGHT=rng.randint(0, 100000), Hacc=rng.randint(0, 5000))
+        messages.append(UbloxMessage.buildMessage('NAV-PVT', 92, pvt))
+
+        numSv = rng.randint(8, 30)
+        sats = [{'ITOW': iTOW, 'Version': 1, 'NumSv': numSv}]
+        for i in range(numSv):
+            sats.append({'GNSSID': rng.randint(0, 6), 'SVID': rng.randint(1, 32), 'CNO': rng.randint(10, 50),
+                         'Elev': rng.randint(-90, 90), 'Azim': rng.randint(0, 359), 'PRRes': rng.randint(-500, 500), 'Flags': rng.randint(0, 0xffff)})
+        messages.append(UbloxMessage.buildMessage('NAV-SAT', 8 + 12*numSv, sats))
+
+        numMeas = rng.randint(8, 40)
+        raw = [{'RCVTOW': iTOW/1e3, 'Week': 2400, 'LeapS': 18, 'NumMeas': numMeas, 'RecStat': 1}]
+        for i in range(numMeas):
+            raw.append({'PRMes': rng.uniform(2e7, 2.6e7), 'CPMes': rng.uniform(1e8, 1.4e8), 'DOMes': rng.uniform(-4000, 4000),
+                        'GNSSID': rng.randint(0, 6), 'SVID': rng.randint(1, 32), 'FreqId': 0, 'LockTime': rng.randint(0, 65535),
+                        'CNO': rng.randint(10, 50), 'PRStdev': rng.randint(0, 15), 'CPStdev': rng.randint(0, 15),
+                        'DOStdev': rng.randint(0, 15), 'TrkStat': rng.randint(0, 15)})
+        messages.append(UbloxMessage.buildMessage('RXM-RAWX', 16 + 32*numMeas, raw))
+
+        for i in range(4):
+            numData = rng.randint(1, 7)
+            meas = [{'TimeTag': epoch * 200 + i * 50, 'Flags': 0, 'Id': 0}]
+            meas.extend({'Data': rng.randint(0, 0xffffffff)} for j in range(numData))
+            messages.append(UbloxMessage.buildMessage('ESF-MEAS', 8 + 4*numData, meas))
+
+        for message in messages:
+            if rng.random() < NMEA_RATE:
+                chunks.append(rng.choice(NMEA_SENTENCES))
+                total += len(chunks[-1])
+            r = rng.random()
+            if r < CORRUPT_RATE:
+                message = bytearray(message)
+                message[rng.randint(6, len(message) - 3)] ^= 0xff
+                message = bytes(message)
+            elif r < CORRUPT_RATE + TRUNCATE_RATE:
+                message = message[:rng.randint(1, len(message) - 1)]
+            else:
+                numFrames += 1
+            chunks.append(message)
+            total += len(message)
+        epoch += 1
+
+    return b''.join(chunks), numFrames
+
+
+def _frames(corpus):
+    # (class, id, payload, offset) of the intact frames of the corpus
+    from frameScanner import FrameScanner
+    scanner = FrameScanner()
+    scanner.feed(corpus)
+    return [(msgClass, msgId, bytes(payload), offset) for msgClass, msgId, payload, offset in scanner.frames()]
+
+
+# Each benchmark takes the corpus and its path and returns a function that runs
+# it once and returns (frames processed, bytes processed)
+
+def benchScanner(corpus, path):
+    from frameScanner import FrameScanner
+    def run():
+        scanner = FrameScanner()
+        numFrames = 0
+        for i in range(0, len(corpus), READ_SIZE):
+            scanner.feed(corpus[i:i+READ_SIZE])
+            for frame in scanner.frames():
+                numFrames += 1
+        return numFrames, len(corpus)
+    return run
+
+
+def benchUbxParser(corpus, path):
+    import ubx
+    def run():
+        counter = [0]
+        def callback(msgFormat, data):
+            counter[0] += 1
+        parser = ubx.Parser(callback, device=None)
+        for i in range(0, len(corpus), READ_SIZE):
+            parser.parse(corpus[i:i+READ_SIZE])
+        return counter[0], len(corpus)
+    return run
+
+
+def benchUbloxReader(corpus, path):
+    import ublox2
+    def run():
+        reader = ublox2.UbloxReader()
+        counter = [0]
+        def userHandler(msgTime, msgFormat, msgData, rawMessage):
+            counter[0] += 1
+        reader.userHandler = userHandler
+        for i in range(0, len(corpus), READ_SIZE):
+            reader.data_received(corpus[i:i+READ_SIZE])
+        return counter[0], len(corpus)
+    return run
+
+
+def benchMessageParse(corpus, path):
+    def run():
+        numFrames = 0
+        start = 0
+        while True:
+            rawMessage, msgClass, msgId, length, start = UbloxMessage.getMessageFromBuffer(corpus, start)
+            if rawMessage is None:
+                break
+            msgFormat, msgData, remainder = UbloxMessage.parse(rawMessage)
+            if msgFormat is not None:
+                numFrames += 1
+        return numFrames, len(corpus)
+    return run
+
+
+def benchDecode(corpus, path):
+    frames = _frames(corpus)
+    size = sum(len(payload) + 8 for _, _, payload, _ in frames)
+    def run():
+        for msgClass, msgId, payload, offset in frames:
+            UbloxMessage.decode(msgClass, msgId, len(payload), payload)
+        return len(frames), size
+    return run
+
+
+def benchDecodeLazy(corpus, path):
+    frames = _frames(corpus)
+    size = sum(len(payload) + 8 for _, _, payload, _ in frames)
+    def run():
+        for msgClass, msgId, payload, offset in frames:
+            msgFormat, msgData = UbloxMessage.decodeLazy(msgClass, msgId, len(payload), payload)
+            msgData[0]
+        return len(frames), size
+    return run
+
+
+def benchDecodeRecord(corpus, path):
+    frames = _frames(corpus)
+    size = sum(len(payload) + 8 for _, _, payload, _ in frames)
+    def run():
+        # Records are kept, so the peak memory shows what holding a whole log costs
+        messages = []
+        for msgClass, msgId, payload, offset in frames:
+            messages.append(UbloxMessage.decodeRecord(msgClass, msgId, len(payload), payload))
+        return len(frames), size
+    return run
+
+
+def benchChecksum(corpus, path):
+    frames = [corpus[offset+2:offset+len(payload)+6] for _, _, payload, offset in _frames(corpus)]
+    size = sum(len(frame) + 4 for frame in frames)
+    def run():
+        for frame in frames:
+            UbloxMessage.checksum(frame)
+        return len(frames), size
+    return run
+
+
+def benchBatchChecksum(corpus, path):
+    from ubxChecksum import validateFrames
+    frames = _frames(corpus)
+    offsets = [offset for _, _, _, offset in frames]
+    lengths = [len(payload) for _, _, payload, _ in frames]
+    size = sum(lengths) + 8 * len(lengths)
+    def run():
+        validateFrames(corpus, offsets, lengths)
+        return len(frames), size
+    return run
+
+
+def benchBuildMessage(corpus, path):
+    messages = []
+    for msgClass, msgId, payload, offset in _frames(corpus):
+        msgFormat, msgData = UbloxMessage.decode(msgClass, msgId, len(payload), payload)
+        messages.append((msgFormat, len(payload), msgData if len(msgData) > 1 else msgData[0]))
+    size = sum(length + 8 for _, length, _ in messages)
+    def run():
+        for msgFormat, length, msgData in messages:
+            UbloxMessage.buildMessage(msgFormat, length, msgData)
+        return len(messages), size
+    return run
+
+
+def benchUbxFile(corpus, path):
+    from ubxFile import UbxFile
+    def run():
+        numFrames = 0
+        with UbxFile(path, useSidecar=False) as ubxFile:
+            for message in ubxFile.messages():
+                numFrames += 1
+        return numFrames, len(corpus)
+    return run
+
+
+def benchExtractArrays(corpus, path):
+    from ubxFile import UbxFile
+    from ubxArrays import extractArrays
+    def run():
+        with UbxFile(path, useSidecar=False) as ubxFile:
+            extractArrays(ubxFile)
+            numFrames = int(ubxFile.index['checksumOk'].sum())
+        return numFrames, len(corpus)
+    return run
+
+
+BENCHMARKS = OrderedDict([
+    ('FrameScanner', benchScanner),
+    ('ubx.Parser.parse', benchUbxParser),
+    ('UbloxReader.parse', benchUbloxReader),
+    ('UbloxMessage.parse', benchMessageParse),
+    ('UbloxMessage.decode', benchDecode),
+    ('UbloxMessage.decodeLazy', benchDecodeLazy),
+    ('UbloxMessage.decodeRecord', benchDecodeRecord),
+    ('UbloxMessage.checksum', benchChecksum),
+    ('validateFrames', benchBatchChecksum),
+    ('UbloxMessage.buildMessage', benchBuildMessage),
+    ('UbxFile.messages', benchUbxFile),
+    ('extractArrays', benchExtractArrays),
+])
+
+# Metrics compared against a baseline, and whether higher is better
+METRICS = [('framesPerSec', True), ('allocPeak', False), ('peakRss', False)]
+
+
+def runBenchmark(name, path, repeat):
+    # Run one benchmark in this process and return its results
+    with open(path, 'rb') as f:
+        corpus = f.read()
+    try:
+        run = BENCHMARKS[name](corpus, path)
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    best = None
+    for i in range(repeat):
+        startTime = time.perf_counter()
+        numFrames, numBytes = run()
+        elapsed = time.perf_counter() - startTime
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    run()
+    allocPeak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peakRss *= 1024
+
+    return {'frames': numFrames, 'bytes': numBytes, 'seconds': best,
+            'framesPerSec': numFrames / best, 'mbPerSec': numBytes / 1e6 / best,
+            'allocPeak': allocPeak, 'peakRss': peakRss}
+
+
+def runIsolated(name, path, repeat):
+    # Run one benchmark in a new process, so the peak RSS is its own
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', name,
+                                      '--corpus', path, '--repeat', str(repeat)])
+    return json.loads(output.decode('utf-8'))
+
+
+def compare(results, baseline, tolerance):
+    # Returns a list of regression descriptions
+    regressions = []
+    for name, result in results.items():
+        if 'skipped' in result or name not in baseline or 'skipped' in baseline[name]:
+            continue
+        for metric, higherIsBetter in METRICS:
+            old = baseline[name][metric]
+            new = result[metric]
+            if old <= 0:
+                continue
+            change = (new - old) / float(old)
+            if (higherIsBetter and change < -tolerance) or (not higherIsBetter and change > tolerance):
+                regressions.append('{} {}: {:.4g} -> {:.4g} ({:+.1f} %)'.format(name, metric, old, new, change * 100))
+    return regressions
+
+
+def printResults(results, baseline=None):
+    print('{:28} {:>12} {:>10} {:>12} {:>10} {:>10}'.format('Benchmark', 'frames/s', 'MB/s', 'alloc MB', 'RSS MB', 'vs base'))
+    for name, result in results.items():
+        if 'skipped' in result:
+            print('{:28} skipped ({})'.format(name, result['skipped']))
+            continue
+        change = ''
+        if baseline is not None and name in baseline and 'skipped' not in baseline[name]:
+            change = '{:+.1f} %'.format((result['framesPerSec'] / baseline[name]['framesPerSec'] - 1) * 100)
+        print('{:28} {:12.0f} {:10.2f} {:12.2f} {:10.1f} {:>10}'.format(name, result['framesPerSec'], result['mbPerSec'],
+              result['allocPeak'] / 1e6, result['peakRss'] / 1e6, change))
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the UBX parse, decode, checksum and build paths')
+    parser.add_argument('--size', type=float, default=8, help='Corpus size in MB')
+    parser.add_argument('--seed', type=int, default=0, help='Corpus random seed')
+    parser.add_argument('--corpus', default=None, help='Corpus file to use, or to write if it does not exist')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Runs per benchmark, the fastest is reported')
+    parser.add_argument('--benchmarks', '-b', nargs='+', default=None, choices=list(BENCHMARKS), help='Benchmarks to run')
+    parser.add_argument('--baseline', default=None, help='Compare against this baseline JSON file')
+    parser.add_argument('--save-baseline', default=None, help='Save the results as a baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed fractional regression against the baseline')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process - run a single benchmark and write the result as JSON
+    if args.run is not None:
+        json.dump(runBenchmark(args.run, args.corpus, args.repeat), sys.stdout)
+        sys.exit()
+
+    tempDir = None
+    corpusPath = args.corpus
+    if corpusPath is None:
+        tempDir = tempfile.mkdtemp()
+        corpusPath = os.path.join(tempDir, 'corpus.ubx')
+    if not os.path.exists(corpusPath):
+        startTime = time.time()
+        corpus, numFrames = buildCorpus(int(args.size * 1e6), args.seed)
+        with open(corpusPath, 'wb') as f:
+            f.write(corpus)
+        print('Corpus: {:.1f} MB, {} intact frames, built in {:.1f} s'.format(len(corpus)/1e6, numFrames, time.time() - startTime))
+    print('')
+
+    results = OrderedDict()
+    try:
+        for name in (args.benchmarks or BENCHMARKS):
+            results[name] = runIsolated(name, corpusPath, args.repeat)
+    finally:
+        if tempDir is not None:
+            os.remove(corpusPath)
+            os.rmdir(tempDir)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    printResults(results, baseline)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('\nBaseline saved to {}'.format(args.save_baseline))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\n*** REGRESSIONS (tolerance {:.0f} %) ***'.format(args.tolerance * 100))
+            for regression in regressions:
+                print(regression)
+            sys.exit(1)
+        print('\nNo regressions against {}'.format(args.baseline))
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Capture daemon for many receivers
+
+Captures the UBX streams of N serial/USB receivers in one process. The ports
+are multiplexed with selectors (epoll on Linux) and each one feeds its own
+UbloxReader, which scans the frames and writes the rotating save files and
+sidecar indexes as baseStationCapture.py does. Only NAV-PVT is decoded (for
+the file rotation and index), everything else is saved untouched.
+
+The config file is JSON:
+
+{
+    "outputDir": "/data/ubx",
+    "interval": "hourly",
+    "maxFileSize": 1073741824,
+    "fsyncInterval": 10,
+    "compression": "zlib",
+    "profiles": {
+        "base": {"measurementRate": 5, "messages": [["NAV-PVT", 1], ["RXM-RAWX", 1], ["RXM-SFRBX", 1]]}
+    },
+    "receivers": [
+        {"name": "rx01", "device": "/dev/ttyUSB0", "baudRate": 921600, "profile": "base"},
+        {"name": "rx02", "device": "/dev/ttyUSB1", "baudRate": 921600, "profile": "base"}
+    ]
+}
+
+maxFileSize (bytes) also rotates the files by size, fsyncInterval
+(seconds) syncs them to storage that often, and compression ("zlib" or
+"lzma") saves seekable compressed .ubz files. All are optional.
+
+Profiles are used with --configure. A profile may also give the receiver
+port for CFG-MSG (see baseStationCapture.setMessageRate).
+"""
+import os
+import json
+import time
+import errno
+import logging
+import selectors
+import concurrent.futures
+
+import serial
+import serial.threaded
+
+from ublox2 import UbloxReader
+from baseStationCapture import configureReceiver, MESSAGE_LIST
+from ubxLinkMonitor import LinkMonitor
+
+logger = logging.getLogger()
+
+DEFAULT_BAUD_RATE = 921600
+DEFAULT_PROFILE = {'measurementRate': 5, 'messages': MESSAGE_LIST, 'port': None}
+# Bytes read per readable port
+READ_SIZE = 65536
+# Minimum time between selects, so each read returns a useful amount of data
+# instead of a few bytes. Must be well under the time to fill the tty buffer.
+POLL_INTERVAL = 0.01
+# Seconds between attempts to reopen a port that failed
+RETRY_INTERVAL = 5
+# Warn if a port has not sent data for this many seconds
+STALL_TIMEOUT = 5
+
+
+def loadConfig(path):
+    with open(path) as f:
+        config = json.load(f)
+    profiles = config.get('profiles', {})
+    for receiver in config['receivers']:
+        if 'name' not in receiver or 'device' not in receiver:
+            raise ValueError('Each receiver needs a name and a device: {}'.format(receiver))
+        profileName = receiver.get('profile')
+        if profileName is not None and profileName not in profiles:
+            raise ValueError('Receiver {} uses unknown profile {}'.format(receiver['name'], profileName))
+    return config
+
+
+class Receiver(object):
+    def __init__(self, name, device, baudRate=DEFAULT_BAUD_RATE, profile=None, outputDir=None, interval=None, maxFileSize=None, fsyncInterval=None, compression=None):
+        self.name = name
+        self.device = device
+        self.baudRate = baudRate
+        self.profile = dict(DEFAULT_PROFILE, **(profile or {}))
+        self.outputDir = outputDir
+        self.interval = interval
+        self.maxFileSize = maxFileSize
+        self.fsyncInterval = fsyncInterval
+        self.compression = compression
+        self.ser = None
+        self.reader = None
+        # Reports link usage if the receiver outputs MON-IO/MON-TXBUF, e.g. with "messages": [["MON-IO", 1], ["MON-TXBUF", 1]]
+        self.link = None
+        # Time of the next reopen attempt after a failure
+        self.retryTime = 0
+        self.lastDataTime = None
+        self.stalled = False
+        self.resetStats()
+
+    def resetStats(self):
+        self.statsStartTime = time.time()
+        self.bytesReceived = 0
+        self.reads = 0
+        self.messageCount = {}
+        # The scanner counters keep running (LinkMonitor works on their deltas), so the
+        # checksum errors are counted from here
+        self.checksumErrorsStart = self.reader.scanner.checksumErrors if self.reader is not None else 0
+        if self.link is not None:
+            self.link.reset()
+
+    def open(self):
+        self.ser = serial.Serial(self.device, self.baudRate, timeout=0)
+        self.reader = UbloxReader()
+        self.reader.logger = logger
+        self.reader.saveFileName = os.path.join(self.outputDir, self.name) if self.outputDir else self.name
+        self.reader.setSaveInterval(self.interval)
+        self.reader.saveMaxFileSize = self.maxFileSize
+        self.reader.saveFsyncInterval = self.fsyncInterval
+        self.reader.saveCompression = self.compression
+        self.reader.saveStreamFlag = True
+        self.reader.subscribe(None, self.countMessage, decode=False)
+        self.link = LinkMonitor(self.reader, baudRate=self.baudRate)
+        self.checksumErrorsStart = 0
+        self.lastDataTime = time.time()
+        self.stalled = False
+        logger.info('{}: opened {} at {} baud'.format(self.name, self.device, self.baudRate))
+
+    def configure(self):
+        # Send the profile configuration, with a temporary reader thread for the polls and ACKs
+        self.ser.timeout = 1
+        thread = serial.threaded.ReaderThread(self.ser, UbloxReader)
+        thread.start()
+        try:
+            ublox = thread.connect()[1]
+            ublox.logger = logger
+            configureReceiver(self.ser, ublox, self.profile['measurementRate'], self.profile['messages'], self.profile['port'])
+        finally:
+            thread.stop()
+            self.ser.timeout = 0
+
+    def readReady(self):
+        data = os.read(self.ser.fileno(), READ_SIZE)
+        if not data:
+            raise OSError(errno.EIO, 'Device closed')
+        self.reads += 1
+        self.bytesReceived += len(data)
+        self.lastDataTime = time.time()
+        self.reader.data_received(data)
+
+    def countMessage(self, msgTime, msgFormat, msgData, rawMessage):
+        self.messageCount[msgFormat] = self.messageCount.get(msgFormat, 0) + 1
+
+    def close(self, exc=None):
+        if self.reader is not None:
+            # Closes the save file and index
+            self.reader.connection_lost(exc)
+            self.reader = None
+            self.link = None
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    def stats(self):
+        elapsed = max(time.time() - self.statsStartTime, 1e-9)
+        frames = sum(self.messageCount.values())
+        counts = ', '.join('{}: {}'.format(key, value) for key, value in sorted(self.messageCount.items()))
+        pending = self.reader.scanner.pending() if self.reader is not None else 0
+        checksumErrors = self.reader.scanner.checksumErrors - self.checksumErrorsStart if self.reader is not None else 0
+        stats = '{}: {:.1f} kbps, {:.1f} frames/s, {:.0f} B/read, {} B pending, {} checksum errors | {}'.format(
+            self.name, self.bytesReceived*8/elapsed/1e3, frames/elapsed, self.bytesReceived/max(self.reads, 1), pending, checksumErrors, counts)
+        if self.reader is not None and self.reader.saveWriter is not None:
+            writerStats = self.reader.saveWriter.stats(reset=True)
+            stats += '\n    ' + self.reader.saveWriter.formatStats(writerStats)
+            if writerStats['droppedFrames']:
+                logger.warning('{}: storage too slow, {} frames dropped'.format(self.name, writerStats['droppedFrames']))
+        if self.link is not None and self.link.report is not None:
+            stats += '\n' + LinkMonitor.formatReport(self.link.report)
+            for message in self.link.warnings():
+                logger.warning('{}: {}'.format(self.name, message))
+        return stats
+
+
+def capture(receivers, statsInterval=10):
+    selector = selectors.DefaultSelector()
+    for receiver in receivers:
+        if receiver.ser is not None:
+            selector.register(receiver.ser.fileno(), selectors.EVENT_READ, receiver)
+
+    def fail(receiver, exc):
+        logger.error('{}: {}'.format(receiver.name, exc))
+        if receiver.ser is not None:
+            selector.unregister(receiver.ser.fileno())
+        receiver.close(exc)
+        receiver.retryTime = time.time() + RETRY_INTERVAL
+
+    lastStatsTime = time.time()
+    try:
+        while True:
+            selectTime = time.time()
+            for key, events in selector.select(timeout=1.0):
+                try:
+                    key.data.readReady()
+                except (OSError, serial.SerialException) as exc:
+                    fail(key.data, exc)
+
+            now = time.time()
+            for receiver in receivers:
+                # Reopen ports that failed, e.g. an unplugged USB receiver
+                if receiver.ser is None:
+                    if now >= receiver.retryTime:
+                        try:
+                            receiver.open()
+                            selector.register(receiver.ser.fileno(), selectors.EVENT_READ, receiver)
+                        except (OSError, serial.SerialException) as exc:
+                            receiver.close()
+                            receiver.retryTime = now + RETRY_INTERVAL
+                            logger.debug('{}: reopen failed: {}'.format(receiver.name, exc))
+                elif not receiver.stalled and now - receiver.lastDataTime > STALL_TIMEOUT:
+                    receiver.stalled = True
+                    logger.warning('{}: no data for {:.0f} s'.format(receiver.name, now - receiver.lastDataTime))
+                elif receiver.stalled and now - receiver.lastDataTime <= STALL_TIMEOUT:
+                    receiver.stalled = False
+
+            if now - lastStatsTime > statsInterval:
+                totalBytes = 0
+                for receiver in receivers:
+                    logger.info(receiver.stats() if receiver.ser is not None else '{}: disconnected'.format(receiver.name))
+                    totalBytes += receiver.bytesReceived
+                    receiver.resetStats()
+                logger.info('Total: {:.1f} kbps from {}/{} receivers'.format(totalBytes*8/(now - lastStatsTime)/1e3,
+                            sum(receiver.ser is not None for receiver in receivers), len(receivers)))
+                lastStatsTime = now
+
+            # Let more data arrive before the next select
+            remaining = POLL_INTERVAL - (time.time() - selectTime)
+            if remaining > 0:
+                time.sleep(remaining)
+    finally:
+        selector.close()
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Capture the UBX streams of many receivers in one process')
+    parser.add_argument('config', help='JSON config file listing the receivers')
+    parser.add_argument('--configure', '-c', action='store_true', help='Configure the receivers with their profiles before capturing')
+    parser.add_argument('--stats-interval', '-s', type=float, default=10, help='Seconds between stats reports')
+    parser.add_argument('--logFile', '-l', help='Path to log file')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    if args.logFile is not None:
+        handler = logging.FileHandler(args.logFile)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    logger.info('***** Session start *****')
+
+    config = loadConfig(args.config)
+    outputDir = config.get('outputDir')
+    if outputDir is not None and not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    profiles = config.get('profiles', {})
+    receivers = [Receiver(item['name'], item['device'], item.get('baudRate', DEFAULT_BAUD_RATE),
+                          profiles.get(item.get('profile')), outputDir, config.get('interval'),
+                          config.get('maxFileSize'), config.get('fsyncInterval'), config.get('compression'))
+                 for item in config['receivers']]
+
+    for receiver in receivers:
+        try:
+            receiver.open()
+        except (OSError, serial.SerialException) as exc:
+            logger.error('{}: {}'.format(receiver.name, exc))
+            receiver.close()
+
+    if args.configure:
+        # Configure the receivers in parallel - each waits on its own ACKs
+        connected = [receiver for receiver in receivers if receiver.ser is not None]
+        if connected:
+            with concurrent.futures.ThreadPoolExecutor(len(connected)) as executor:
+                futures = dict((executor.submit(receiver.configure), receiver) for receiver in connected)
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception() is not None:
+                        logger.error('{}: configuration failed: {}'.format(futures[future].name, future.exception()))
+
+    try:
+        capture(receivers, args.stats_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for receiver in receivers:
+            receiver.close()
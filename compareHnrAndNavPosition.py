@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 
-import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 from pyproj import Proj, transform
 import math
-import datetime
+from ubxArrays import loadArrays, utcTimes
 
 def determineUtmZone(longitude):
     zone = (math.floor((longitude + 180)/6) % 60) + 1
@@ -18,48 +17,32 @@ if __name__=='__main__':
     parser.add_argument('input')
     args = parser.parse_args()
 
-    data = pickle.load(open(args.input, 'rb'))
+    # .npz from parseToPickle.py --columnar, or a pickle file
+    data = loadArrays(args.input)
+    nav = data['NAV-PVT']
+    hnr = data['HNR-PVT']
 
-    navData = {'ITOW': [], 'LAT': [], 'LON': [], 'HEIGHT': [], 'FixType': [], 'DateTime': []}
-    hnrData = {'ITOW': [], 'LAT': [], 'LON': [], 'HEIGHT': [], 'GPSFix': [], 'DateTime': []}
-    
-    for msg in data['NAV-PVT']:
-        dt = datetime.datetime(msg[0]['Year'], msg[0]['Month'], msg[0]['Day'], msg[0]['Hour'], msg[0]['Min'], msg[0]['Sec']) + datetime.timedelta(microseconds=msg[0]['Nano']/1000.)
-        for key in navData.keys():
-            if key == 'DateTime':
-                navData['DateTime'].append(dt)
-            else:
-                navData[key].append(msg[0][key])
-
-    navItowSet = set(navData['ITOW'])
-
-    fullHnrDt = []
-    fullHnrItow = []
-    fullHnrLat = []
-    fullHnrLon = []
-    fullHnrHeight = []
-    for msg in data['HNR-PVT']:
-        dt = datetime.datetime(msg[0]['Year'], msg[0]['Month'], msg[0]['Day'], msg[0]['Hour'], msg[0]['Min'], msg[0]['Sec']) + datetime.timedelta(microseconds=msg[0]['Nano']/1000.)
-        fullHnrDt.append(dt)
-        fullHnrItow.append(msg[0]['ITOW'])
-        fullHnrLat.append(msg[0]['LAT'])
-        fullHnrLon.append(msg[0]['LON'])
-        fullHnrHeight.append(msg[0]['HEIGHT'])
-        if msg[0]['ITOW'] not in navItowSet:
-            continue
-        for key in hnrData.keys():
-            if key == 'DateTime':
-                hnrData['DateTime'].append(dt)
-            else:
-                hnrData[key].append(msg[0][key])   
+    navData = dict((key, nav[key]) for key in ['ITOW', 'LAT', 'LON', 'HEIGHT', 'FixType'])
+    navData['DateTime'] = utcTimes(nav)
+
+    fullHnrDt = utcTimes(hnr)
+    fullHnrItow = hnr['ITOW']
+    fullHnrLat = hnr['LAT']
+    fullHnrLon = hnr['LON']
+    fullHnrHeight = hnr['HEIGHT']
+
+    # HNR-PVT at the NAV-PVT epochs
+    atNav = np.isin(hnr['ITOW'], nav['ITOW'])
+    hnrData = dict((key, hnr[key][atNav]) for key in ['ITOW', 'LAT', 'LON', 'HEIGHT', 'GPSFix'])
+    hnrData['DateTime'] = fullHnrDt[atNav]
 
     itow, idxNav, idxHnr = np.intersect1d(navData['ITOW'], hnrData['ITOW'], return_indices=True)
 
     for key in navData.keys():
-        navData[key] = np.array(navData[key])[idxNav]
+        navData[key] = navData[key][idxNav]
 
     for key in hnrData.keys():
-        hnrData[key] = np.array(hnrData[key])
+        hnrData[key] = hnrData[key][idxHnr]
 
     
     zone = determineUtmZone(navData['LON'].mean())
@@ -116,7 +99,7 @@ if __name__=='__main__':
     ax.plot(navData['DateTime'], navData['ITOW'], 'rx')
 
     deltas = hnrData['DateTime'] - navData['DateTime']
-    dSec = np.array([d.total_seconds() for d in deltas])
+    dSec = deltas / np.timedelta64(1, 's')
     print('dUTC - Mean: {:.6f} s, Std: {:.6f} s, Min: {:.6f} s, Max: {:.6f} s'.format(dSec.mean(), dSec.std(), dSec.min(), dSec.max()))
     
     fig, ax = plt.subplots(1)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Streaming UBX frame scanner
+
+Finds UBX frames in a byte stream without slicing the buffer per message.
+Data is appended to a bytearray and a read cursor is advanced past each frame.
+Payloads are handed out as memoryviews into the buffer.
+
+With an rtcmCallback, RTCM3 frames interleaved with the UBX frames (e.g. a
+base station sending corrections on the same port) are found in the same
+buffer and handed to the callback in stream order.
+"""
+import struct
+from ubxChecksum import fletcher8
+from rtcmFramer import findRtcmFrame, messageType, RTCM3_OVERHEAD
+
+UBX_SYNC = b'\xb5\x62'
+UBX_HEADER = struct.Struct('<BBH')
+UBX_CHECKSUM = struct.Struct('<BB')
+
+# Unframed data (e.g. NMEA) retained for the unframed callback is flushed past this size
+MAX_UNFRAMED = 65536
+
+
+def findFrame(buf, start=0, end=None, maxLength=None, validateChecksum=True, checksumKeys=None, stats=None):
+    # Search buf[start:end] for the next valid UBX frame. buf must support find(),
+    # e.g. bytes, bytearray or mmap. If checksumKeys is given, only frames whose
+    # (class, id) is in it are checksummed. If stats is given, its checksumErrors
+    # and lengthErrors attributes count the syncs rejected (e.g. a FrameScanner).
+    #
+    # Returns (offset, msgClass, msgId, length). If no complete frame was found,
+    # msgClass, msgId and length are None and offset is where the search should
+    # resume once more data is available.
+    if end is None:
+        end = len(buf)
+    searchStart = start
+
+    while True:
+        start = buf.find(UBX_SYNC, start, end)
+
+        # No sync found - only a trailing first sync byte can start the next frame
+        if start < 0:
+            if end > searchStart and buf[end-1] == UBX_SYNC[0]:
+                return end - 1, None, None, None
+            return end, None, None, None
+
+        # Message shorter than minimum length - wait for additional data
+        if start + 8 > end:
+            return start, None, None, None
+
+        # Decode header - message class, id, and length
+        msgClass, msgId, length = UBX_HEADER.unpack_from(buf, start+2)
+
+        # Implausible length - move past the sync
+        if maxLength is not None and length > maxLength:
+            if stats is not None:
+                stats.lengthErrors += 1
+            start += 2
+            continue
+
+        # Check that there is enough data in the buffer to match the length
+        if start + length + 8 > end:
+            return start, None, None, None
+
+        # Validate checksum - if fail, skip past the sync
+        if validateChecksum and (checksumKeys is None or (msgClass, msgId) in checksumKeys) and fletcher8(buf, start+2, start+length+6) != UBX_CHECKSUM.unpack_from(buf, start+length+6):
+            if stats is not None:
+                stats.checksumErrors += 1
+            start += 2
+            continue
+
+        return start, msgClass, msgId, length
+
+
+class FrameScanner(object):
+    def __init__(self, maxLength=None, validateChecksum=True, unframedCallback=None, rtcmCallback=None):
+        self.maxLength = maxLength
+        self.validateChecksum = validateChecksum
+        # (class, id) pairs to checksum, e.g. only the subscribed messages. None checksums every frame.
+        self.checksumKeys = None
+        # Called with a memoryview of data between frames. If None, that data is discarded.
+        self.unframedCallback = unframedCallback
+        # Called with (message type, frame, stream offset) for each RTCM3 frame, frame being a
+        # memoryview of the whole frame. If None, RTCM3 frames are unframed data.
+        self.rtcmCallback = rtcmCallback
+        self.buffer = bytearray()
+        self.view = None
+        # Buffer index of the first byte that has not been consumed
+        self.cursor = 0
+        # Buffer index where the next sync search starts
+        self.search = 0
+        # Stream offset of buffer[0]
+        self.streamOffset = 0
+        self.resetStats()
+
+    def resetStats(self):
+        # Counters for link monitoring. Every sync that does not start a valid frame is
+        # counted, so corrupted data can count more than once per lost frame.
+        self.bytesFed = 0
+        self.frameCount = 0
+        self.frameBytes = 0
+        # RTCM3 frames are also counted in frameCount and frameBytes, and CRC failures in checksumErrors
+        self.rtcmFrameCount = 0
+        self.checksumErrors = 0
+        self.lengthErrors = 0
+
+    def feed(self, data):
+        # Drop consumed data. Slicing makes a new bytearray, so payload views
+        # already handed out keep pointing at the old, unmodified buffer.
+        if self.cursor:
+            self.buffer = self.buffer[self.cursor:]
+            self.streamOffset += self.cursor
+            self.search -= self.cursor
+            self.cursor = 0
+        self.view = None
+        self.bytesFed += len(data)
+        try:
+            self.buffer += data
+        except BufferError:
+            # A caller is still holding a view into the buffer, so it can't be resized
+            self.buffer = self.buffer + data
+
+    def frames(self):
+        # Yields (msgClass, msgId, payload, offset) for every complete frame in the
+        # buffer. payload is a memoryview and offset is the stream offset of the sync.
+        buf = self.buffer
+        view = self.view = memoryview(buf)
+        end = len(buf)
+        result = None
+        while True:
+            # The UBX search result stays valid while RTCM3 frames before it are handed out
+            if result is None or result[0] < self.search:
+                result = findFrame(buf, self.search, end, self.maxLength, self.validateChecksum, self.checksumKeys, self)
+            offset, msgClass, msgId, length = result
+
+            if self.rtcmCallback is not None and offset > self.search:
+                # An RTCM3 frame before the UBX frame. A partial candidate would run into a
+                # complete UBX frame, so it is only waited for if there is none.
+                rtcmOffset, rtcmLength = findRtcmFrame(buf, self.search, offset, end, msgClass is None, self)
+                if rtcmLength is not None:
+                    if rtcmOffset > self.cursor and self.unframedCallback is not None:
+                        self.unframedCallback(view[self.cursor:rtcmOffset])
+                    self.cursor = self.search = rtcmOffset + rtcmLength + RTCM3_OVERHEAD
+                    self.frameCount += 1
+                    self.rtcmFrameCount += 1
+                    self.frameBytes += rtcmLength + RTCM3_OVERHEAD
+                    self.rtcmCallback(messageType(buf, rtcmOffset) if rtcmLength >= 2 else None,
+                                      view[rtcmOffset:self.search], self.streamOffset + rtcmOffset)
+                    continue
+                if rtcmOffset < offset:
+                    offset = rtcmOffset
+                    msgClass = None
+
+            if msgClass is None:
+                self.search = offset
+                if self.unframedCallback is None:
+                    self.cursor = offset
+                elif offset - self.cursor > MAX_UNFRAMED:
+                    self.unframedCallback(view[self.cursor:offset])
+                    self.cursor = offset
+                return
+
+            # Handle data prior to UBX message
+            if offset > self.cursor and self.unframedCallback is not None:
+                self.unframedCallback(view[self.cursor:offset])
+
+            self.cursor = self.search = offset + length + 8
+            self.frameCount += 1
+            self.frameBytes += length + 8
+            yield msgClass, msgId, view[offset+6:offset+length+6], self.streamOffset + offset
+
+    def rawFrame(self, offset, length):
+        # Full frame (sync to checksum) for a frame just yielded by frames()
+        start = offset - self.streamOffset
+        return self.view[start:start+length+8]
+
+    def pending(self):
+        # Number of buffered bytes not yet consumed
+        return len(self.buffer) - self.cursor
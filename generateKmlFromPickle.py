@@ -4,9 +4,7 @@ from mapper.kml import resampleTrack, writeKmlTrack
 import matplotlib.pyplot as plt
 import os
 import numpy as np
-import pickle
-import datetime
-import calendar
+from ubxArrays import loadArrays, utcTimes
 
 if __name__=='__main__':
     import json
@@ -20,36 +18,16 @@ if __name__=='__main__':
     parser.add_argument('--nav', '-n', action='store_true', help='Use NAV-PVT instead of HNR-PVT')
     args = parser.parse_args()
 
-    data = pickle.load(open(args.input, 'rb'), encoding='latin1')
-    timestamps = []
-    latitude = []
-    longitude = []
+    # .npz from parseToPickle.py --columnar, or a pickle file
+    data = loadArrays(args.input)
 
     navMessageType = 'NAV-PVT' if args.nav else 'HNR-PVT'
+    pvt = data[navMessageType]
 
-    for packet in data[navMessageType]:
-        # timestamp = packet[0]['ITOW']/1e3
-        year = packet[0]['Year']
-        month = packet[0]['Month']
-        day = packet[0]['Day']
-        hour = packet[0]['Hour']
-        minute = packet[0]['Min']
-        second = packet[0]['Sec']
-        nano = packet[0]['Nano']
-        dt = datetime.datetime(year, month, day, hour, minute, second) + datetime.timedelta(microseconds=nano/1000)
-        timestamp = calendar.timegm(dt.timetuple())
-
-
-        lat = packet[0]['LAT']/1e7
-        lon = packet[0]['LON']/1e7
-        # alt = packet[0]['HEIGHT']/1e3
-        # heading = packet[0]['HeadVeh']/1e5
-        # speed = packet[0]['Speed']/1e3
-        # fix = fixTypeDict[packet[0]['GPSFix']]
-        
-        timestamps.append(timestamp)
-        latitude.append(lat)
-        longitude.append(lon)
+    # POSIX timestamps in whole seconds
+    timestamps = (utcTimes(pvt).astype('M8[s]') - np.datetime64(0, 's')).astype(np.int64).tolist()
+    latitude = (pvt['LAT']/1e7).tolist()
+    longitude = (pvt['LON']/1e7).tolist()
 
     # Write KML
     if args.resample:
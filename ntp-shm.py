@@ -169,8 +169,12 @@ if __name__ == "__main__":
     if args.output is not None:
         outputFile = open(args.output, 'wb')
 
+    # Only NAV-PVT is decoded, unless all messages are printed with --raw
+    messageTypes = None if args.raw else ['NAV-PVT']
+
     if args.device:
-        t = ubx.Parser(callback, device=args.device, rawCallback=rawCallback)
+        t = ubx.Parser(device=args.device, rawCallback=rawCallback)
+        t.subscribe(messageTypes, callback)
         try:
             gobject.MainLoop().run()
         except KeyboardInterrupt:
@@ -178,7 +182,8 @@ if __name__ == "__main__":
             if outputFile is not None:
                 outputFile.close()
     else:
-        t = ubx.Parser(callback, device=False)
+        t = ubx.Parser(device=False)
+        t.subscribe(messageTypes, callback)
         binFile = args.file
         data = open(binFile,'r').read()
         t.parse(data)
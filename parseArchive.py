@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Parallel reprocessing of UBX captures to columnar .npz files
+
+Files, e.g. the hourly ublox_*.ubx files written by UbloxReader, are sharded
+across a process pool and each is decoded with ubxArrays.extractArrays into
+a .npz file, as parseToPickle.py --columnar does for one file. Files larger
+than the chunk size are split at frame boundaries and the chunks decoded in
+parallel, then merged back in file order.
+"""
+import os
+import sys
+import glob
+import mmap
+import time
+import logging
+import multiprocessing
+import numpy as np
+
+from frameScanner import findFrame, UBX_SYNC
+from ubxFile import UbxFile
+from ubxArrays import extractArrays, saveArrays, pvtTimes, REPEATED_SUFFIX
+
+# Files larger than this are split into chunks of about this size
+DEFAULT_CHUNK_SIZE = 256 << 20
+
+
+def frameBoundary(buf, start):
+    # Offset of the first frame at or after start that passes its checksum and is
+    # followed by another sync (or the end of the data), or len(buf) if there is none
+    while True:
+        offset, msgClass, msgId, length = findFrame(buf, start)
+        if msgClass is None:
+            return len(buf)
+        frameEnd = offset + length + 8
+        if frameEnd == len(buf) or buf[frameEnd:frameEnd+2] == UBX_SYNC:
+            return offset
+        start = offset + 2
+
+
+def chunkBoundaries(path, chunkSize=DEFAULT_CHUNK_SIZE):
+    # Byte offsets splitting a file into chunks of about chunkSize, at frame boundaries
+    size = os.path.getsize(path)
+    boundaries = [0]
+    if size > chunkSize:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for cut in range(chunkSize, size, chunkSize):
+                    offset = frameBoundary(buf, max(cut, boundaries[-1]))
+                    if boundaries[-1] < offset < size:
+                        boundaries.append(offset)
+            finally:
+                buf.close()
+    boundaries.append(size)
+    return boundaries
+
+
+def processChunk(task):
+    # Worker - decode one chunk of a file. Returns the tables, the last NAV-PVT/HNR-PVT
+    # time of the chunk (for the lastPvtUtc of the next chunk) and timing for the progress report.
+    path, chunk, start, end = task
+    startTime = time.time()
+    with UbxFile(path, start=start, end=end) as ubxFile:
+        tables = extractArrays(ubxFile)
+        _, epochTimes = pvtTimes(ubxFile)
+    lastPvtUtc = epochTimes[-1] if len(epochTimes) else np.datetime64('NaT', 'ns')
+    return path, chunk, end - start, tables, lastPvtUtc, os.getpid(), time.time() - startTime
+
+
+def mergeChunks(chunks):
+    # Concatenate the tables of consecutive chunks of one file. Repeated tables get their
+    # msgIndex shifted past the earlier chunks' messages, and messages before a chunk's
+    # first epoch get the previous chunk's last epoch time.
+    names = set()
+    for tables, _ in chunks:
+        names.update(tables.keys())
+
+    parts = dict((name, []) for name in names)
+    numMessages = dict((name, 0) for name in names)
+    lastPvtUtc = np.datetime64('NaT', 'ns')
+    for tables, chunkPvtUtc in chunks:
+        for name, table in tables.items():
+            if name.endswith(REPEATED_SUFFIX):
+                table['msgIndex'] += numMessages[name[:-len(REPEATED_SUFFIX)]]
+            else:
+                table['lastPvtUtc'][np.isnat(table['lastPvtUtc'])] = lastPvtUtc
+            parts[name].append(table)
+        for name, table in tables.items():
+            if not name.endswith(REPEATED_SUFFIX):
+                numMessages[name] += len(table)
+        if not np.isnat(chunkPvtUtc):
+            lastPvtUtc = chunkPvtUtc
+
+    return dict((name, np.concatenate(tables)) for name, tables in parts.items())
+
+
+def outputPath(path, outputDir=None):
+    head = os.path.splitext(path)[0]
+    if outputDir is not None:
+        head = os.path.join(outputDir, os.path.basename(head))
+    return head + '.npz'
+
+
+def processFiles(paths, outputDir=None, numWorkers=None, chunkSize=DEFAULT_CHUNK_SIZE, skipExisting=False):
+    # Decode paths to .npz files in parallel. Returns {pid: (bytes, seconds)} per worker.
+    if skipExisting:
+        paths = [path for path in paths if not os.path.exists(outputPath(path, outputDir))]
+
+    tasks = []
+    numChunks = {}
+    for path in paths:
+        boundaries = chunkBoundaries(path, chunkSize)
+        numChunks[path] = len(boundaries) - 1
+        for chunk, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+            tasks.append((path, chunk, start, end))
+
+    totalBytes = sum(end - start for _, _, start, end in tasks)
+    results = dict((path, {}) for path in paths)
+    workers = {}
+    processed = 0
+    startTime = time.time()
+
+    pool = multiprocessing.Pool(numWorkers)
+    try:
+        for path, chunk, size, tables, lastPvtUtc, pid, elapsed in pool.imap_unordered(processChunk, tasks):
+            processed += size
+            bytesDone, busy = workers.get(pid, (0, 0.))
+            workers[pid] = (bytesDone + size, busy + elapsed)
+            print('[{}] {} chunk {}/{}: {:.1f} MB in {:.2f} s ({:.1f} MB/s) | {:.1f}/{:.1f} MB, {:.1f} MB/s total'.format(
+                  pid, os.path.basename(path), chunk + 1, numChunks[path], size/1e6, elapsed, size/1e6/max(elapsed, 1e-9),
+                  processed/1e6, totalBytes/1e6, processed/1e6/max(time.time() - startTime, 1e-9)))
+
+            results[path][chunk] = (tables, lastPvtUtc)
+            if len(results[path]) == numChunks[path]:
+                chunks = [results[path][i] for i in range(numChunks[path])]
+                saveArrays(outputPath(path, outputDir), mergeChunks(chunks))
+                del results[path]
+    finally:
+        pool.close()
+        pool.join()
+
+    return workers
+
+
+def findInputs(inputs):
+    # UBX files from file names, directories and glob patterns, in name order
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(glob.glob(os.path.join(item, '*.ubx')))
+        elif os.path.exists(item):
+            paths.append(item)
+        else:
+            paths.extend(glob.glob(item))
+    return sorted(set(paths))
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Decode UBX files to columnar .npz files in parallel')
+    parser.add_argument('input', nargs='+', help='UBX files, directories or glob patterns')
+    parser.add_argument('--output-dir', '-o', default=None, help='Output directory, default is next to each input')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Number of worker processes, default is the number of CPUs')
+    parser.add_argument('--chunk-size', '-c', type=float, default=DEFAULT_CHUNK_SIZE/1e6, help='Split files larger than this many MB')
+    parser.add_argument('--skip-existing', '-s', action='store_true', help='Skip files that already have an output file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    paths = findInputs(args.input)
+    if not paths:
+        print('No UBX files found')
+        sys.exit(1)
+    if args.output_dir is not None and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    startTime = time.time()
+    workers = processFiles(paths, args.output_dir, args.workers, int(args.chunk_size * 1e6), args.skip_existing)
+    elapsed = time.time() - startTime
+
+    print('')
+    totalBytes = 0
+    for pid in sorted(workers):
+        size, busy = workers[pid]
+        totalBytes += size
+        print('Worker {}: {:.1f} MB in {:.1f} s ({:.1f} MB/s)'.format(pid, size/1e6, busy, size/1e6/max(busy, 1e-9)))
+    print('Total: {:.1f} MB in {:.1f} s ({:.1f} MB/s)'.format(totalBytes/1e6, elapsed, totalBytes/1e6/max(elapsed, 1e-9)))
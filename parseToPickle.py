@@ -19,11 +19,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import ubx
+from ubxCompressed import openCapture
+from splitFile import parseDatetime
 import struct
 import calendar
 import os
-import gobject
 import logging
 import sys
 import socket
@@ -33,6 +33,7 @@ import calendar
 
 from stream import fixTypeDict, fusionModeDict, timeValidDict, timeValidSymbolDict
 
+dt = None
 timestamp = 0
 lat = 0
 lon = 0
@@ -162,23 +163,41 @@ def rawCallback(data):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('file', help='UBX file to parse')
+    parser.add_argument('file', help='UBX or compressed UBZ file to parse')
     parser.add_argument('--output', '-o', default=None)
+    parser.add_argument('--columnar', '-c', action='store_true', help='Save NumPy structured arrays to a .npz file instead of a pickle')
+    parser.add_argument('--start', type=parseDatetime, help='UTC start time in ISO8601 format YYYYMMDDTHHMMSS.fff')
+    parser.add_argument('--end', type=parseDatetime, help='UTC end time in ISO8601 format YYYYMMDDTHHMMSS.fff')
     args = parser.parse_args()
-    
+
     logging.basicConfig(level=logging.WARNING)
 
     if args.output is None:
         head, ext = os.path.splitext(args.file)
-        args.output = head + '.pickle'
-        
+        args.output = head + ('.npz' if args.columnar else '.pickle')
+
+    if args.columnar:
+        from ubxArrays import extractArrays, saveArrays
+        with openCapture(args.file, args.start, args.end) as ubxFile:
+            tables = extractArrays(ubxFile)
+        for key in sorted(tables.keys()):
+            print('{}: {}'.format(key, len(tables[key])))
+        saveArrays(args.output, tables)
+        sys.exit()
+
     display = True
     output = {}
-    t = ubx.Parser(callback, device=False, rawCallback=rawCallback)
-    binFile = args.file
-    data = open(binFile,'rb').read()
-    dataSize = len(data)
-    t.parse(data, useRawCallback=True)
+    with openCapture(args.file, args.start, args.end) as ubxFile:
+        dataSize = ubxFile.size
+        for i in range(len(ubxFile)):
+            rawCallback(ubxFile.rawFrame(i))
+            if not ubxFile.index['checksumOk'][i]:
+                continue
+            try:
+                ty, packet = ubxFile.decode(i)
+            except ValueError:
+                continue
+            callback(ty, packet)
 
     for key in sorted(output.keys()):
         print('{}: {}'.format(key, len(output[key])))
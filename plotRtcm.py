@@ -3,11 +3,10 @@
 # plotRtcm.py
 
 import os
-import pickle
 import matplotlib.pyplot as plt
 from pyproj import Proj, transform
 import numpy as np
-import datetime
+from ubxArrays import loadArrays, utcTimes
 
 def determineUtmZone(longitude):
     zone = (np.floor((longitude + 180)/6) % 60) + 1
@@ -21,60 +20,36 @@ if __name__=='__main__':
 
     inputPath = os.path.split(args.input)[0]
 
-    data = pickle.load(open(args.input, 'rb'), encoding='latin1')
+    # .npz from parseToPickle.py --columnar, or a pickle file
+    data = loadArrays(args.input)
 
-    rtcmTimeTypes = {}
     rtcmTypeCount = {}
-    messageTypes = set()
 
-    distanceToBaseStation = []
     startPosition = 37.785889, -122.271341
     zone = determineUtmZone(startPosition[1])
     projectionLatLong = Proj(proj='latlong', datum='WGS84')
     projectionUtm = Proj(proj='utm', zone=zone, datum='WGS84')
     startUtm  = transform(projectionLatLong, projectionUtm, startPosition[1], startPosition[0]) 
     
-    dts = []
-    carrierPhaseSolutionStatus = []
-    for msg in data['NAV-PVT']:
-        year = msg[0]['Year']
-        month = msg[0]['Month']
-        day = msg[0]['Day']
-        hour = msg[0]['Hour']
-        minute = msg[0]['Min']
-        second = msg[0]['Sec']
-        nano = msg[0]['Nano']
-        dt = datetime.datetime(year, month, day, hour, minute, second) + datetime.timedelta(microseconds=nano/1000.)
-        dts.append(dt)
-
-        rtcmTimeTypes[dt] = []
-
-        lat = msg[0]['LAT']/1e7
-        lon = msg[0]['LON']/1e7
-        curUtm  = transform(projectionLatLong, projectionUtm, lon, lat) 
-        dist = np.sqrt((curUtm[0] - startUtm[0])**2 + (curUtm[1] - startUtm[1])**2)
-        distanceToBaseStation.append(dist)
-        
-        carrSoln = msg[0]['Flags'] >> 6
-        carrierPhaseSolutionStatus.append(carrSoln)
-
-    for msg in data['RXM-RTCM']:
-        dt = msg[0]['lastPvtDt']
-        msgType = msg[0]['MsgType']
-        if dt is None:
-            continue
-
-        rtcmTimeTypes[dt].append(msgType)
-        messageTypes.add(msgType)
-
-    for messageType in messageTypes:
-        rtcmTypeCount[messageType] = [0] * len(dts)
-    numMessagesPerTime = [0] * len(dts)
-
-    for i, dt in enumerate(dts):
-        numMessagesPerTime[i] = len(rtcmTimeTypes[dt])
-        for msgType in rtcmTimeTypes[dt]:
-            rtcmTypeCount[msgType][i] += 1
+    nav = data['NAV-PVT']
+    dts = utcTimes(nav)
+
+    curUtm  = transform(projectionLatLong, projectionUtm, nav['LON']/1e7, nav['LAT']/1e7)
+    distanceToBaseStation = np.sqrt((curUtm[0] - startUtm[0])**2 + (curUtm[1] - startUtm[1])**2)
+
+    carrierPhaseSolutionStatus = nav['Flags'] >> 6
+
+    # NAV-PVT epoch of each RTCM message. Times converted from pickle files are
+    # rounded to the microsecond, so allow for that.
+    rtcm = data['RXM-RTCM']
+    rtcm = rtcm[~np.isnat(rtcm['lastPvtUtc'])]
+    epochIndex = np.searchsorted(dts, rtcm['lastPvtUtc'] + np.timedelta64(1, 'us'), side='right') - 1
+    rtcm = rtcm[epochIndex >= 0]
+    epochIndex = epochIndex[epochIndex >= 0]
+
+    numMessagesPerTime = np.bincount(epochIndex, minlength=len(dts))
+    for messageType in np.unique(rtcm['MsgType']).tolist():
+        rtcmTypeCount[messageType] = np.bincount(epochIndex[rtcm['MsgType'] == messageType], minlength=len(dts))
 
     fig, axes = plt.subplots(len(rtcmTypeCount) + 1, sharex=True)
     axes[0].plot(dts, numMessagesPerTime)
@@ -2,85 +2,78 @@
 
 import pickle
 import numpy as np
+from ubxArrays import loadArrays, repeatedSlices
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator
 import struct
 
-def parseSvInfo(svInfo):
-    epoch = []
-    numSats = []
-    avgCNO = []
-    for info in svInfo:
-        cno = []
-        for sv in info[1:]:
-            if sv['Flags'] & 1:
-                cno.append(sv['CNO'])
-        epoch.append(info[0]['ITOW']/1e3)
-        numSats.append(len(cno))
-        if len(cno):
-            avgCNO.append(np.mean(cno))
-        else:
-            avgCNO.append(0)
+def parseSvInfo(svInfo, svs):
+    # svInfo is the NAV-SVINFO table and svs its repeated (per satellite) table
+    used = (svs['Flags'] & 1).astype(bool)
+    epoch = svInfo['ITOW']/1e3
+    numSats = np.bincount(svs['msgIndex'][used], minlength=len(svInfo))
+    cnoSum = np.bincount(svs['msgIndex'][used], weights=svs['CNO'][used], minlength=len(svInfo))
+    avgCNO = np.where(numSats > 0, cnoSum / np.maximum(numSats, 1), 0)
 
     return epoch, numSats, avgCNO
 
 def parseDopInfo(dopInfo):
-    epoch = [packet[0]['ITOW']/1e3 for packet in dopInfo] 
-    hdop = [packet[0]['HDOP']/100. for packet in dopInfo]
-    vdop = [packet[0]['VDOP']/100. for packet in dopInfo]
-    pdop = [packet[0]['PDOP']/100. for packet in dopInfo]
+    epoch = dopInfo['ITOW']/1e3
+    hdop = dopInfo['HDOP']/100.
+    vdop = dopInfo['VDOP']/100.
+    pdop = dopInfo['PDOP']/100.
     return epoch, hdop, vdop, pdop
 
 def parsePvtInfo(pvtInfo):
-    epoch = [packet[0]['ITOW']/1e3 for packet in pvtInfo]
-    lat = [packet[0]['LAT']/1e7 for packet in pvtInfo]
-    lon = [packet[0]['LON']/1e7 for packet in pvtInfo]
-    alt = [packet[0]['HEIGHT']/1e3 for packet in pvtInfo]
-    heading = [packet[0]['HeadVeh']/1e5 for packet in pvtInfo]
-    speed = [packet[0]['Speed']/1e3 for packet in pvtInfo]
-    hAcc = [packet[0]['Hacc']/1e3 for packet in pvtInfo]
-    hAcc = [packet[0]['Hacc']/1e3 for packet in pvtInfo]
-    vAcc = [packet[0]['Vacc']/1e3 for packet in pvtInfo]
-    sAcc = [packet[0]['SAcc']/1e3 for packet in pvtInfo]
-    headAcc = [packet[0]['HeadAcc']/1e5 for packet in pvtInfo]
+    epoch = pvtInfo['ITOW']/1e3
+    lat = pvtInfo['LAT']/1e7
+    lon = pvtInfo['LON']/1e7
+    alt = pvtInfo['HEIGHT']/1e3
+    heading = pvtInfo['HeadVeh']/1e5
+    speed = pvtInfo['Speed']/1e3
+    hAcc = pvtInfo['Hacc']/1e3
+    vAcc = pvtInfo['Vacc']/1e3
+    sAcc = pvtInfo['SAcc']/1e3
+    headAcc = pvtInfo['HeadAcc']/1e5
     return epoch, lat, lon, alt, heading, speed, hAcc, vAcc, sAcc, headAcc
 
 def parseAttInfo(attInfo):
-    epoch = [packet[0]['ITOW']/1e3 for packet in attInfo]
-    roll = [packet[0]['Roll']/1e5 for packet in attInfo]
-    pitch = [packet[0]['Pitch']/1e5 for packet in attInfo]
-    heading = [packet[0]['Heading']/1e5 for packet in attInfo]
-    rollAcc = [packet[0]['AccRoll']/1e5 for packet in attInfo]
-    pitchAcc = [packet[0]['AccPitch']/1e5 for packet in attInfo]
-    headingAcc = [packet[0]['AccHeading']/1e5 for packet in attInfo]
+    epoch = attInfo['ITOW']/1e3
+    roll = attInfo['Roll']/1e5
+    pitch = attInfo['Pitch']/1e5
+    heading = attInfo['Heading']/1e5
+    rollAcc = attInfo['AccRoll']/1e5
+    pitchAcc = attInfo['AccPitch']/1e5
+    headingAcc = attInfo['AccHeading']/1e5
 
     return epoch, roll, pitch, heading, rollAcc, pitchAcc, headingAcc
 
 def parseInsInfo(insInfo, offset):
-    epoch = [packet[0]['ITOW']/1e3 + offset for packet in insInfo] 
-    reserved = [packet[0]['Reserved'] for packet in insInfo]
-    xAngRate = [packet[0]['XAngRate']/1e3 for packet in insInfo]
-    yAngRate = [packet[0]['YAngRate']/1e3 for packet in insInfo]
-    zAngRate = [packet[0]['ZAngRate']/1e3 for packet in insInfo]
-    xAccel = [packet[0]['XAccel']/1e3 for packet in insInfo]
-    yAccel = [packet[0]['YAccel']/1e3 for packet in insInfo]
-    zAccel = [packet[0]['ZAccel']/1e3 for packet in insInfo]
-    bitfields = [packet[0]['Bitfield0'] for packet in insInfo]
-    version = [bf & 0xF for bf in bitfields]
-    angRateValid = [(bool(bf & 0x10), bool(bf & 0x20), bool(bf & 0x40)) for bf in bitfields]
-    accelValid = [(bool(bf & 0x80), bool(bf & 0x100), bool(bf & 0x200)) for bf in bitfields]
+    epoch = insInfo['ITOW']/1e3 + offset
+    reserved = insInfo['Reserved']
+    xAngRate = insInfo['XAngRate']/1e3
+    yAngRate = insInfo['YAngRate']/1e3
+    zAngRate = insInfo['ZAngRate']/1e3
+    xAccel = insInfo['XAccel']/1e3
+    yAccel = insInfo['YAccel']/1e3
+    zAccel = insInfo['ZAccel']/1e3
+    bitfields = insInfo['Bitfield0']
+    version = bitfields & 0xF
+    angRateValid = np.vstack([bitfields & 0x10, bitfields & 0x20, bitfields & 0x40]).transpose().astype(bool)
+    accelValid = np.vstack([bitfields & 0x80, bitfields & 0x100, bitfields & 0x200]).transpose().astype(bool)
 
     return epoch, xAngRate, yAngRate, zAngRate, xAccel, yAccel, zAccel, version, angRateValid, accelValid, reserved
 
-def parseMeasInfo(measInfo, sssToEpochPoly, offset):
-    timeTag = [packet[0]['TimeTag']/1e3 for packet in measInfo]
+def parseMeasInfo(measInfo, measData, sssToEpochPoly, offset):
+    timeTag = measInfo['TimeTag']/1e3
     epoch = sssToEpochPoly(timeTag) + offset
-    flags = [packet[0]['Flags'] for packet in measInfo]
-    calibTagValid = [bool(f & 0x8) for f in flags]
-    timeMarkSent = [f & 0x3 for f in flags]
-    timeMarkEdge = [bool(f & 0x4) for f in flags]
+    flags = measInfo['Flags']
+    calibTagValid = (flags & 0x8).astype(bool)
+    timeMarkSent = flags & 0x3
+    timeMarkEdge = (flags & 0x4).astype(bool)
     timeMarkData = {'epoch': epoch, 'timeTag': timeTag, 'timeMarkSent': timeMarkSent, 'timeMarkEdge': timeMarkSent}
-    data = [[subpacket['Data'] for subpacket in packet[1:]] for packet in measInfo]
+    starts, ends = repeatedSlices(measData, len(measInfo))
+    data = [measData['Data'][start:end] for start, end in zip(starts, ends)]
     calibTimeTag = []
     gyroData = {'epoch': [], 'timeTag': [], 'calibTimeTag': []}
     accelData = {'epoch': [], 'timeTag': [], 'calibTimeTag': []}
@@ -88,9 +81,9 @@ def parseMeasInfo(measInfo, sssToEpochPoly, offset):
     for ep, tTag, dSet, valid in zip(epoch, timeTag, data, calibTagValid):
         d, cTag = parseMeasData(dSet, valid)
 
-        if 'Acceleration' in d.keys()[0]:
+        if 'Acceleration' in list(d.keys())[0]:
             dataDict = accelData
-        elif 'Angular' in d.keys()[0] or 'gyro' in d.keys()[0]:
+        elif 'Angular' in list(d.keys())[0] or 'gyro' in list(d.keys())[0]:
             dataDict = gyroData
         else:
             dataDict = tickData
@@ -118,17 +111,15 @@ def parseMeasData(dSet, timeTagPresent=True):
 
     return dataDict, timeTag
 
-def parseRawInfo(rawInfo, sssToEpochPoly, offset):
+def parseRawInfo(rawInfo, rawData, sssToEpochPoly, offset):
     # Each message contains 10 sets of 7 measurements (3 axis accel, 3 axis gyro, gyro temp)
     # The time for each set of 7 measurements appear to be the same
-    timeTag = [packet[0]['Reserved']/1e3 for packet in rawInfo]
+    timeTag = rawInfo['Reserved']/1e3
     epoch = sssToEpochPoly(timeTag) + offset
-    data = [[subpacket['Data'] for subpacket in packet[1:]] for packet in rawInfo]
-    sensorTimeTag = [[subpacket['STimeTag'] for subpacket in packet[1:]] for packet in rawInfo]
-    sensorTimeTag = np.array(sensorTimeTag)
+    data = rawData['Data']
 
     # Unwrap sensorTimeTag (roll over every 2^24)
-    sensorTimeTag = sensorTimeTag.flatten()
+    sensorTimeTag = rawData['STimeTag'].astype(np.int64)
     deltaTimeTag = np.diff(sensorTimeTag)
     for i in np.where(deltaTimeTag < 0)[0]:
         sensorTimeTag[i+1:] = sensorTimeTag[i+1:] + 2**24
@@ -147,7 +138,7 @@ def parseRawInfo(rawInfo, sssToEpochPoly, offset):
 
     # plt.plot(np.diff(sensorEpoch.flatten()))
     # plt.show()
-    data = np.array(data).reshape(-1, 7)
+    data = data.reshape(-1, 7)
     dataDict = {'sensorTimeTag': [], 'epoch': []}
     for timeSet, epochSet, dataSet in zip(sensorTimeTag, sensorEpoch, data):
         if not np.all(timeSet == timeSet[0]):
@@ -221,12 +212,12 @@ def parseEsfData(data):
     return dataType, dataTypeName, value
 
 def parseNavStatus(status):
-    epoch = [packet[0]['ITOW']/1e3 for packet in status] 
-    fixType = [packet[0]['GPSfix'] for packet in status]
-    flags = [packet[0]['Flags'] for packet in status]
-    fixStatus = [packet[0]['DiffS'] for packet in status]
-    ttff = [packet[0]['TTFF'] for packet in status]
-    msss = [packet[0]['MSSS'] for packet in status]
+    epoch = status['ITOW']/1e3
+    fixType = status['GPSfix']
+    flags = status['Flags']
+    fixStatus = status['DiffS']
+    ttff = status['TTFF']
+    msss = status['MSSS']
     return epoch, fixType, flags, fixStatus, ttff, msss
 
 def piecewiseAccumulation(pose, delta, offsetTime=0):
@@ -273,8 +264,8 @@ if __name__=='__main__':
     parser.add_argument('input')
     args = parser.parse_args()
 
-    f = open(args.input, 'rb')
-    data = pickle.load(f)
+    # .npz from parseToPickle.py --columnar, or a pickle file
+    data = loadArrays(args.input)
 
     measOffset = -0.5
     insOffset = -0.5
@@ -282,7 +273,7 @@ if __name__=='__main__':
     numSats = avgCNO = None
     try:
         svInfo = data['NAV-SVINFO']
-        epoch, numSats, avgCNO = parseSvInfo(svInfo)
+        epoch, numSats, avgCNO = parseSvInfo(svInfo, data['NAV-SVINFO.repeated'])
     except KeyError:
         print('*** NO NAV-SVINFO messages!')
         epoch = numSats = avgCNO = []
@@ -323,7 +314,7 @@ if __name__=='__main__':
         epochIns = xAngRate = yAngRate = zAngRate = xAccel = yAccel = zAccel = version = angRateValid = accelValid = reservedIns = []
     try:
         measInfo = data['ESF-MEAS']
-        accelDataMeas, gyroDataMeas, tickDataMeas, timeMarkData = parseMeasInfo(measInfo, sssToEpochPoly, measOffset)
+        accelDataMeas, gyroDataMeas, tickDataMeas, timeMarkData = parseMeasInfo(measInfo, data['ESF-MEAS.repeated'], sssToEpochPoly, measOffset)
         print('Length of ESF-MEAS data (s): {:.3f}'.format(accelDataMeas['timeTag'][-1] - accelDataMeas['timeTag'][0]))
         print('--> First timestamp: {}'.format(accelDataMeas['timeTag'][0]))
 
@@ -332,7 +323,7 @@ if __name__=='__main__':
         accelDataMeas = gyroDataMeas = tickDataMeas = {}
     try:
         rawInfo = data['ESF-RAW']
-        rawData = parseRawInfo(rawInfo, sssToEpochPoly, measOffset)
+        rawData = parseRawInfo(rawInfo, data['ESF-RAW.repeated'], sssToEpochPoly, measOffset)
         print('Length of ESF-RAW data (s): {:.3f}'.format(rawData['epoch'][-1] - rawData['epoch'][0]))
         print('--> First timestamp: {}'.format(rawData['epoch'][0]))
     except KeyError:
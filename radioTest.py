@@ -3,6 +3,7 @@
 import serial
 import time
 from readRtcm import *
+from frameScanner import FrameScanner
 
 if __name__=='__main__':
     import argparse
@@ -12,17 +13,10 @@ if __name__=='__main__':
     parser.add_argument('--device2')
     args = parser.parse_args()
 
-    f = open(args.file, 'rb')
-    buf = f.read()
-
-    messages = []
-    while len(buf) > 0:
-        try:
-            message, buf = parseMessage(buf)
-            if message['messageType'].startswith('RTCM3'):
-                messages.append(message)
-        except:
-            raise
+    with open(args.file, 'rb') as f:
+        buf = f.read()
+
+    messages = [message for message in readMessages(FrameScanner(maxLength=4096), buf) if message['messageType'].startswith('RTCM3')]
 
     print('Parsed {} RTCM3 messages'.format(len(messages)))
 
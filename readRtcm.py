@@ -1,95 +1,76 @@
 #!/usr/bin/env python3
 
 import datetime
-import bitstring
-import crcmod
+import collections
 import serial
-from ubloxMessage import UbloxMessage
+from ubloxMessage import CLIDPAIR_INV
+from frameScanner import FrameScanner, findFrame
+from rtcmFramer import findRtcmFrame, messageType, RTCM3_PREAMBLE, RTCM3_OVERHEAD, RTCM3_MESSAGE_TYPES
 
-RTCM3_PREAMBLE = 0xD3
 UBX_PREAMBLE = b'\xB5\x62'
-RTCM3_MESSAGE_TYPES = {1005: 'Stationary RTK reference station ARP',
-                      1074: 'GPS MSM4',
-                      1077: 'GPS MSM7',
-                      1084: 'GLONASS MSM4',
-                      1087: 'GLONASS MSM7',
-                      1094: 'Galileo MSM4',
-                      1097: 'Galileo MSM7',
-                      1124: 'BeiDou MSM4',
-                      1127: 'BeiDou MSM7',
-                      1230: 'GLONASS code-phase biases',
-                      4072: 'Reference station information'
-                      }
+# Bytes read from the device per call
+READ_SIZE = 4096
+
+
+def rtcmMessage(msgType, frame):
+    # Message dict for a complete RTCM3 frame
+    name = RTCM3_MESSAGE_TYPES.get(msgType, 'Unknown')
+    return {'messageType': 'RTCM3-{}: {}'.format(msgType, name), 'type': msgType,
+            'payload': bytes(frame[3:-3]), 'fullMessage': bytes(frame)}
+
+def ubxMessage(msgClass, msgId, payload):
+    msgFormat = CLIDPAIR_INV.get((msgClass, msgId), '0x{:02x}-0x{:02x}'.format(msgClass, msgId))
+    return {'messageType': 'UBX-{}'.format(msgFormat), 'payload': bytes(payload)}
+
+
+def readMessages(scanner, data):
+    # Feed data to a FrameScanner and yield the message dicts of the UBX and RTCM3 frames
+    # completed, in stream order. The scanner keeps partial frames for the next call.
+    rtcm = collections.deque()
+    scanner.rtcmCallback = lambda msgType, frame, offset: rtcm.append(rtcmMessage(msgType, frame))
+    scanner.feed(data)
+    for msgClass, msgId, payload, offset in scanner.frames():
+        while rtcm:
+            yield rtcm.popleft()
+        yield ubxMessage(msgClass, msgId, payload)
+    while rtcm:
+        yield rtcm.popleft()
+
 
 def parseMessage(buf):
-    while len(buf) > 1:
-        if buf[0] == RTCM3_PREAMBLE:
-            try:
-                message, buf = parseRtcm3(buf)
-                return message, buf
-            except:
-                raise
-        elif buf[:2] == UBX_PREAMBLE:
-            try:
-                message, buf = parseUbx(buf)
-                return message, buf
-            except:
-                raise
-        print('First character(s) [{}] do not match preamble, skipping...'.format(buf[:2]))
-        buf = buf[1:]
-    return None, buf
-
-# CRC-24Q (Qualcomm) for RTCM parity check
-# Mask 0x1864CFB, not reversed, not XOR'd
-crc24q = crcmod.mkCrcFun(0x1864CFB, initCrc=0, rev=False, xorOut=0)
-        
+    # First UBX or RTCM3 message in buf. Returns (message, remaining data), or (None, data
+    # from the first possible frame) if more data is needed.
+    offset, msgClass, msgId, length = findFrame(buf, 0, len(buf), 4096)
+    rtcmOffset, rtcmLength = findRtcmFrame(buf, 0, offset, partial=msgClass is None)
+    if rtcmLength is not None:
+        frameEnd = rtcmOffset + rtcmLength + RTCM3_OVERHEAD
+        return rtcmMessage(messageType(buf, rtcmOffset) if rtcmLength >= 2 else None, buf[rtcmOffset:frameEnd]), buf[frameEnd:]
+    if msgClass is not None:
+        frameEnd = offset + length + 8
+        return ubxMessage(msgClass, msgId, buf[offset+6:frameEnd-2]), buf[frameEnd:]
+    return None, buf[min(offset, rtcmOffset):]
+
 def parseRtcm3(buf):
-    # rtcm3 message format:
-    # +----------+--------+-----------+--------------------+----------+
-    # | preamble | 000000 |  length   |    data message    |  parity  |
-    # +----------+--------+-----------+--------------------+----------+
-    # |<-- 8 --->|<- 6 -->|<-- 10 --->|<--- length x 8 --->|<-- 24 -->|
-
-    if buf[0] == RTCM3_PREAMBLE:
-        receivedDt = datetime.datetime.now()
-        length = (buf[1] << 8) + buf[2]
-        if length > 300:
-            print('Invalid length! ({})'.format(length))
-            buf = buf[:1]
-            return None, buf
-        elif len(buf) < (length + 6):
-            # print('Not enough data! Got {}, need {}'.format(len(buf), length+6))
-            return None, buf
-        message = buf[:length+3]
-        parity = buf[length+3:length+6]
-
-        # Check parity
-        crc = crc24q(message)
-        crcBytes = crc.to_bytes(3, byteorder='big')
-        if crcBytes != parity:
-            print('**** PARITY MISMATCH reading RTCM message!')
-            buf = buf[1:]
+    # RTCM3 frame at the start of buf. Returns (message, remaining data), or (None, buf) if
+    # the frame is not complete yet. Raises ValueError if buf does not start with a valid frame.
+    if not len(buf) or buf[0] != RTCM3_PREAMBLE:
+        raise ValueError('Preamble mismatch!')
+    offset, length = findRtcmFrame(buf, 0, 1)
+    if length is None:
+        if offset == 0:
             return None, buf
+        raise ValueError('Invalid RTCM3 frame!')
+    frameEnd = length + RTCM3_OVERHEAD
+    return rtcmMessage(messageType(buf) if length >= 2 else None, buf[:frameEnd]), buf[frameEnd:]
 
-        # Get payload and message type
-        payload = bitstring.BitArray(message[3:])
-        messageType = payload[:12].uint
-        if messageType == 1074:
-            print('')
-        print('[{}] RTCM3 {} ({}) | Length: {} ({})'.format(receivedDt.strftime('%H:%M:%S.%f'), messageType, RTCM3_MESSAGE_TYPES[messageType], length, length+6))
-        output = {'messageType': 'RTCM3-{}: {}'.format(messageType, RTCM3_MESSAGE_TYPES[messageType]), 'payload': payload, 'fullMessage': message+parity}
-
-        # Remove processed data
-        buf = buf[length+6:]
-        return output, buf
-    else:
-        raise ValueError('Preamble mismatch!')
 
-def parseUbx(buf):
-    msgFormat, msgData, remainder = UbloxMessage.parse(buf, raw=True)
-    print('\nUBX {} | Length: {}'.format(msgFormat, len(msgData)))
-    output = {'messageType': 'UBX-{}'.format(msgFormat), 'payload': msgData}
-    return output, remainder
+def printMessage(message):
+    receivedDt = datetime.datetime.now()
+    if message['messageType'].startswith('RTCM3'):
+        print('[{}] {} | Length: {} ({})'.format(receivedDt.strftime('%H:%M:%S.%f'), message['messageType'],
+                                                 len(message['payload']), len(message['fullMessage'])))
+    else:
+        print('[{}] {} | Length: {}'.format(receivedDt.strftime('%H:%M:%S.%f'), message['messageType'], len(message['payload'])))
 
 
 if __name__=='__main__':
@@ -97,26 +78,24 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--file', '-f')
     parser.add_argument('--device', '-d')
+    parser.add_argument('--baudrate', '-b', type=int, default=9600)
     args = parser.parse_args()
 
+    scanner = FrameScanner(maxLength=4096)
     if args.file is not None:
-        f = open(args.input, 'rb')
-        buf = f.read()
-
-        while len(buf) > 0:
-            try:
-                message, buf = parseMessage(buf)
-            except:
-                raise
+        with open(args.file, 'rb') as f:
+            buf = f.read()
+        numMessages = 0
+        for message in readMessages(scanner, buf):
+            printMessage(message)
+            numMessages += 1
+        print('{} messages, {} RTCM3, {} CRC/checksum errors'.format(numMessages, scanner.rtcmFrameCount, scanner.checksumErrors))
 
     elif args.device is not None:
-        with serial.Serial(args.device, 9600, timeout=0) as ser:
-            buf = b''
+        with serial.Serial(args.device, args.baudrate, timeout=0.1) as ser:
             while True:
-                buf += ser.read(200)
                 try:
-                    message, buf = parseMessage(buf)
+                    for message in readMessages(scanner, ser.read(READ_SIZE)):
+                        printMessage(message)
                 except KeyboardInterrupt:
                     break
-                except (ValueError, IndexError):
-                    pass
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+RTCM3 framing
+
+Finds RTCM3 frames in a buffer with an offset cursor, like frameScanner does
+for UBX, so noise between frames costs one bytes.find per candidate preamble
+instead of a slice per byte. The CRC-24Q parity is checked with a precomputed
+table, and the message type is read from the first 12 bits of the payload
+with integer operations.
+
+FrameScanner finds RTCM3 frames interleaved with UBX in the same buffer when
+it is given an rtcmCallback.
+
+    +----------+--------+-----------+--------------------+----------+
+    | preamble | 000000 |  length   |    data message    |  parity  |
+    +----------+--------+-----------+--------------------+----------+
+    |<-- 8 --->|<- 6 -->|<-- 10 --->|<--- length x 8 --->|<-- 24 -->|
+"""
+
+RTCM3_PREAMBLE = 0xD3
+RTCM3_SYNC = b'\xd3'
+RTCM3_MAX_LENGTH = 1023
+# Preamble and length before the payload, CRC after it
+RTCM3_HEADER_SIZE = 3
+RTCM3_OVERHEAD = 6
+
+RTCM3_MESSAGE_TYPES = {1005: 'Stationary RTK reference station ARP',
+                       1006: 'Stationary RTK reference station ARP with antenna height',
+                       1033: 'Receiver and antenna descriptors',
+                       1074: 'GPS MSM4',
+                       1077: 'GPS MSM7',
+                       1084: 'GLONASS MSM4',
+                       1087: 'GLONASS MSM7',
+                       1094: 'Galileo MSM4',
+                       1097: 'Galileo MSM7',
+                       1124: 'BeiDou MSM4',
+                       1127: 'BeiDou MSM7',
+                       1230: 'GLONASS code-phase biases',
+                       4072: 'Reference station information'
+                       }
+
+# CRC-24Q (Qualcomm) - polynomial 0x1864CFB, not reflected, no final XOR
+CRC24Q_POLY = 0x1864CFB
+
+
+def _crc24qTable():
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= CRC24Q_POLY
+        table.append(crc & 0xffffff)
+    return table
+
+CRC24Q_TABLE = _crc24qTable()
+
+
+def crc24q(data, crc=0):
+    table = CRC24Q_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xffffff) ^ table[(crc >> 16) ^ byte]
+    return crc
+
+
+def messageType(buf, offset=0):
+    # Message type of the frame at offset - the first 12 bits of the payload
+    return (buf[offset+3] << 4) | (buf[offset+4] >> 4)
+
+
+def findRtcmFrame(buf, start=0, limit=None, end=None, partial=True, stats=None):
+    # Search buf for the next valid RTCM3 frame starting in [start, limit) and ending by end.
+    # buf must support find(), e.g. bytes, bytearray or mmap. If stats is given, its
+    # checksumErrors attribute counts the frames failing the CRC (e.g. a FrameScanner).
+    #
+    # Returns (offset, length), with length the payload length. If no complete frame was
+    # found, length is None and offset is where the search should resume once more data is
+    # available - the first candidate that runs past end if partial, otherwise limit.
+    if end is None:
+        end = len(buf)
+    if limit is None:
+        limit = end
+
+    while True:
+        start = buf.find(RTCM3_SYNC, start, limit)
+        if start < 0:
+            return limit, None
+
+        if start + RTCM3_HEADER_SIZE > end:
+            if partial:
+                return start, None
+            start += 1
+            continue
+
+        # The 6 bits after the preamble are reserved and always 0
+        if buf[start+1] & 0xfc:
+            start += 1
+            continue
+
+        length = ((buf[start+1] & 0x03) << 8) | buf[start+2]
+        frameEnd = start + length + RTCM3_OVERHEAD
+        if frameEnd > end:
+            if partial:
+                return start, None
+            start += 1
+            continue
+
+        # The CRC of a frame including its parity is 0
+        if crc24q(buf[start:frameEnd]):
+            if stats is not None:
+                stats.checksumErrors += 1
+            start += 1
+            continue
+
+        return start, length
+
+
+def buildFrame(payload):
+    # Complete RTCM3 frame for a payload
+    header = bytes([RTCM3_PREAMBLE, (len(payload) >> 8) & 0x03, len(payload) & 0xff])
+    crc = crc24q(payload, crc24q(header))
+    return header + bytes(payload) + crc.to_bytes(3, byteorder='big')
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+RTCM3 MSM4/MSM7 decoder
+
+Decodes the Multiple Signal Messages (1074/1077 GPS, 1084/1087 GLONASS,
+1094/1097 Galileo, 1104/1107 SBAS, 1114/1117 QZSS, 1124/1127 BeiDou) into
+columnar tables, like ubxArrays does for UBX:
+
+    RTCM-MSM            one row per message - header, satellite/signal counts
+    RTCM-MSM.repeated   one row per cell (satellite and signal), msgIndex is
+                        the row of its message
+    RTCM-MSM.epochs     one row per epoch - the messages of all constellations
+                        with the same epoch time, ended by a message with the
+                        multiple message bit clear
+
+The fixed header is read with integer shifts. The masks, satellite data and
+cell data are unpacked with np.unpackbits and each field array is assembled
+with one dot product over its bit weights, so there is no per-field loop.
+
+Epoch times are converted to GPS time of week (ms) for every constellation,
+so epochs can be compared with NAV-PVT iTOW. MsmMonitor takes RTCM3 frames
+(e.g. as a FrameScanner rtcmCallback) and NAV-PVT from a reader, and reports
+the satellites and signals delivered per epoch and the correction latency.
+"""
+import time
+import logging
+import collections
+import numpy as np
+
+from rtcmFramer import messageType, RTCM3_OVERHEAD
+from ubxArrays import REPEATED_SUFFIX
+from gpsTimestamps import GPSMinusUTC
+
+# Message type -> (system, MSM number)
+MSM_TYPES = {1074: ('G', 4), 1077: ('G', 7),
+             1084: ('R', 4), 1087: ('R', 7),
+             1094: ('E', 4), 1097: ('E', 7),
+             1104: ('S', 4), 1107: ('S', 7),
+             1114: ('J', 4), 1117: ('J', 7),
+             1124: ('C', 4), 1127: ('C', 7)}
+SYSTEM_NAMES = {'G': 'GPS', 'R': 'GLONASS', 'E': 'Galileo', 'S': 'SBAS', 'J': 'QZSS', 'C': 'BeiDou'}
+
+# RINEX observation codes of the MSM signal IDs (RTCM 10403.3 tables 3.5-91 to 3.5-108)
+MSM_SIGNALS = {'G': {2: '1C', 3: '1P', 4: '1W', 8: '2C', 9: '2P', 10: '2W', 15: '2S', 16: '2L', 17: '2X',
+                     22: '5I', 23: '5Q', 24: '5X', 30: '1S', 31: '1L', 32: '1X'},
+               'R': {2: '1C', 3: '1P', 8: '2C', 9: '2P'},
+               'E': {2: '1C', 3: '1A', 4: '1B', 5: '1X', 6: '1Z', 8: '6C', 9: '6A', 10: '6B', 11: '6X', 12: '6Z',
+                     14: '7I', 15: '7Q', 16: '7X', 18: '8I', 19: '8Q', 20: '8X', 22: '5I', 23: '5Q', 24: '5X'},
+               'S': {2: '1C', 22: '5I', 23: '5Q', 24: '5X'},
+               'J': {2: '1C', 9: '6S', 10: '6L', 11: '6X', 15: '2S', 16: '2L', 17: '2X', 22: '5I', 23: '5Q',
+                     24: '5X', 30: '1S', 31: '1L', 32: '1X'},
+               'C': {2: '2I', 3: '2Q', 4: '2X', 8: '6I', 9: '6Q', 10: '6X', 14: '7I', 15: '7Q', 16: '7X',
+                     22: '5D', 23: '5P', 24: '5X', 25: '7D', 30: '1D', 31: '1P', 32: '1X'}}
+
+# Distance light travels in 1 ms
+LIGHT_MS = 299792.458
+WEEK_MS = 604800000
+DAY_MS = 86400000
+# BeiDou time is GPS time - 14 s, GLONASS time is UTC + 3 h
+BDT_OFFSET_MS = 14000
+GLONASS_OFFSET_MS = 3*3600000
+
+# Fixed header - 12 bits type, 12 station, 30 epoch, 1 multiple message, 3 IODS, 7 reserved,
+# 2 clock steering, 2 external clock, 1 smoothing, 3 smoothing interval, then the 64 bit
+# satellite mask, 32 bit signal mask and the cell mask
+HEADER_BITS = 169
+SAT_MASK_BIT = 73
+SIGNAL_MASK_BIT = 137
+MAX_CELLS = 64
+
+# Satellite and cell fields as (name, bits, signed), in message order
+MSM_SAT_FIELDS = {4: [('roughInt', 8, False), ('roughMod', 10, False)],
+                  7: [('roughInt', 8, False), ('extInfo', 4, False), ('roughMod', 10, False), ('roughRate', 14, True)]}
+MSM_CELL_FIELDS = {4: [('finePr', 15, True), ('finePhase', 22, True), ('lock', 4, False), ('halfCycle', 1, False), ('cno', 6, False)],
+                   7: [('finePr', 20, True), ('finePhase', 24, True), ('lock', 10, False), ('halfCycle', 1, False), ('cno', 10, False),
+                       ('fineRate', 15, True)]}
+# Scales of the fine pseudorange, fine phase range (ms) and CNR (dB-Hz)
+MSM_SCALES = {4: (2.0**-24, 2.0**-29, 1.0), 7: (2.0**-29, 2.0**-31, 2.0**-4)}
+ROUGH_INVALID = 255
+ROUGH_RATE_INVALID = -8192
+FINE_RATE_INVALID = -16384
+
+MSM_DTYPE = np.dtype([('msgType', '<u2'), ('system', 'S1'), ('station', '<u2'), ('epoch', '<u4'), ('tow', '<i8'),
+                      ('multipleMessage', '?'), ('iods', 'u1'), ('clockSteering', 'u1'), ('externalClock', 'u1'),
+                      ('smoothing', '?'), ('smoothingInterval', 'u1'), ('numSats', 'u1'), ('numSignals', 'u1'),
+                      ('numCells', 'u1'), ('arrivalTime', '<f8')])
+CELL_DTYPE = np.dtype([('msgIndex', '<i8'), ('system', 'S1'), ('svId', 'u1'), ('signalId', 'u1'),
+                       ('pseudorange', '<f8'), ('phaseRange', '<f8'), ('phaseRangeRate', '<f8'),
+                       ('lockTime', '<u2'), ('halfCycle', '?'), ('cno', '<f4')])
+EPOCH_DTYPE = np.dtype([('tow', '<i8'), ('station', '<u2'), ('numMessages', 'u1'), ('systems', 'S8'), ('numSats', '<u2'),
+                        ('numCells', '<u2'), ('meanCno', '<f4'), ('complete', '?'), ('arrivalTime', '<f8'), ('latency', '<f8')])
+
+_BIT_WEIGHTS = dict((width, 1 << np.arange(width - 1, -1, -1, dtype=np.int64)) for width in range(1, 33))
+
+
+def unpackFields(bits, start, fields, count):
+    # Arrays of count consecutive values of each (name, bits, signed) field, from bit start
+    # of an unpacked bit array. Returns ({name: int64 array}, end bit).
+    values = {}
+    for name, width, signed in fields:
+        end = start + width*count
+        field = bits[start:end].reshape(count, width).dot(_BIT_WEIGHTS[width])
+        if signed:
+            field -= (field >> (width - 1)) << width
+        values[name] = field
+        start = end
+    return values, start
+
+
+def msmTow(system, epoch, leapSeconds=GPSMinusUTC):
+    # GPS time of week (ms) of an MSM epoch time field
+    if system == 'R':
+        dayOfWeek = epoch >> 27
+        tow = dayOfWeek*DAY_MS + (epoch & 0x7ffffff) - GLONASS_OFFSET_MS + leapSeconds*1000
+    elif system == 'C':
+        tow = epoch + BDT_OFFSET_MS
+    else:
+        tow = epoch
+    return tow % WEEK_MS
+
+
+def decodeMsm(payload, leapSeconds=GPSMinusUTC):
+    # Decode an MSM4/MSM7 payload (the frame without the 3 byte header and the CRC). Returns
+    # (header, cells) - a 0-d MSM_DTYPE array and a CELL_DTYPE array with msgIndex 0.
+    # Raises ValueError if the message is not MSM4/MSM7 or is truncated.
+    if len(payload) < (HEADER_BITS + 7)//8:
+        raise ValueError('MSM message too short')
+    header = int.from_bytes(payload[:22], 'big')
+
+    def field(offset, width):
+        return (header >> (176 - offset - width)) & ((1 << width) - 1)
+
+    msgType = field(0, 12)
+    if msgType not in MSM_TYPES:
+        raise ValueError('Not an MSM4/MSM7 message: {}'.format(msgType))
+    system, msm = MSM_TYPES[msgType]
+    epoch = field(24, 30)
+
+    bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8))
+    svIds = np.flatnonzero(bits[SAT_MASK_BIT:SIGNAL_MASK_BIT]) + 1
+    signalIds = np.flatnonzero(bits[SIGNAL_MASK_BIT:HEADER_BITS]) + 1
+    numSats = len(svIds)
+    numSignals = len(signalIds)
+    if numSats*numSignals > MAX_CELLS:
+        raise ValueError('MSM cell mask too large: {} satellites x {} signals'.format(numSats, numSignals))
+    cellMaskEnd = HEADER_BITS + numSats*numSignals
+    if cellMaskEnd > len(bits):
+        raise ValueError('MSM message truncated')
+    satIndex, signalIndex = np.nonzero(bits[HEADER_BITS:cellMaskEnd].reshape(numSats, numSignals))
+    numCells = len(satIndex)
+
+    satBits = sum(width for _, width, _ in MSM_SAT_FIELDS[msm])*numSats
+    cellBits = sum(width for _, width, _ in MSM_CELL_FIELDS[msm])*numCells
+    if cellMaskEnd + satBits + cellBits > len(bits):
+        raise ValueError('MSM message truncated')
+    sats, start = unpackFields(bits, cellMaskEnd, MSM_SAT_FIELDS[msm], numSats)
+    cells, _ = unpackFields(bits, start, MSM_CELL_FIELDS[msm], numCells)
+
+    prScale, phaseScale, cnoScale = MSM_SCALES[msm]
+    finePrWidth = MSM_CELL_FIELDS[msm][0][1]
+    finePhaseWidth = MSM_CELL_FIELDS[msm][1][1]
+    # Rough range of each cell's satellite (ms), NaN if the satellite has none
+    rough = np.where(sats['roughInt'] == ROUGH_INVALID, np.nan, sats['roughInt'] + sats['roughMod']/1024.)[satIndex]
+    finePr = np.where(cells['finePr'] == -(1 << (finePrWidth - 1)), np.nan, cells['finePr']*prScale)
+    finePhase = np.where(cells['finePhase'] == -(1 << (finePhaseWidth - 1)), np.nan, cells['finePhase']*phaseScale)
+
+    result = np.zeros(numCells, dtype=CELL_DTYPE)
+    result['system'] = system
+    result['svId'] = svIds[satIndex]
+    result['signalId'] = signalIds[signalIndex]
+    result['pseudorange'] = (rough + finePr)*LIGHT_MS
+    result['phaseRange'] = (rough + finePhase)*LIGHT_MS
+    if msm == 7:
+        roughRate = np.where(sats['roughRate'] == ROUGH_RATE_INVALID, np.nan, sats['roughRate'])[satIndex]
+        result['phaseRangeRate'] = roughRate + np.where(cells['fineRate'] == FINE_RATE_INVALID, np.nan, cells['fineRate']*0.0001)
+    else:
+        result['phaseRangeRate'] = np.nan
+    result['lockTime'] = cells['lock']
+    result['halfCycle'] = cells['halfCycle'].astype(bool)
+    result['cno'] = np.where(cells['cno'] == 0, np.nan, cells['cno']*cnoScale)
+
+    header = np.array((msgType, system, field(12, 12), epoch, msmTow(system, epoch, leapSeconds), field(54, 1), field(55, 3),
+                       field(65, 2), field(67, 2), field(69, 1), field(70, 3), numSats, numSignals, numCells, np.nan), dtype=MSM_DTYPE)
+    return header, result
+
+
+def towDifference(a, b):
+    # a - b in ms, for times of week, in [-half a week, half a week)
+    return (a - b + WEEK_MS//2) % WEEK_MS - WEEK_MS//2
+
+
+class MsmCollector(object):
+    def __init__(self, leapSeconds=GPSMinusUTC, maxEpochs=None):
+        self.leapSeconds = leapSeconds
+        # Decoded messages and cells, as lists of headers and cell arrays
+        self.messages = []
+        self.cells = []
+        # Epoch summaries, the oldest dropped past maxEpochs
+        self.epochs = collections.deque(maxlen=maxEpochs)
+        # Messages of the epoch being received, as (header, cells, arrival time)
+        self.current = []
+        self.decodeErrors = 0
+        # Called with each EPOCH_DTYPE record as it completes
+        self.epochCallback = None
+
+    def addMessage(self, payload, arrivalTime=None):
+        # Decode an MSM payload. Returns the header, or None if it could not be decoded.
+        try:
+            header, cells = decodeMsm(payload, self.leapSeconds)
+        except ValueError as exc:
+            logging.debug('MSM decode failed: {}'.format(exc))
+            self.decodeErrors += 1
+            return None
+        if self.current and (self.current[0][0]['tow'] != header['tow'] or self.current[0][0]['station'] != header['station']):
+            # A new epoch started without the last message of the previous one
+            self.finishEpoch(False)
+        if arrivalTime is not None:
+            header['arrivalTime'] = arrivalTime
+        cells['msgIndex'] = len(self.messages)
+        self.messages.append(header)
+        self.cells.append(cells)
+        self.current.append((header, cells, arrivalTime))
+        if not header['multipleMessage']:
+            self.finishEpoch(True)
+        return header
+
+    def addFrame(self, frame, arrivalTime=None):
+        # Add a complete RTCM3 frame if it is an MSM4/MSM7 message
+        if len(frame) >= RTCM3_OVERHEAD + 2 and messageType(frame) in MSM_TYPES:
+            return self.addMessage(bytes(frame[3:-3]), arrivalTime)
+        return None
+
+    def latency(self, tow, arrivalTime):
+        # Latency (ms) of an epoch at arrivalTime, NaN unless a subclass knows the receiver time
+        return np.nan
+
+    def finishEpoch(self, complete):
+        messages = self.current
+        self.current = []
+        if not messages:
+            return None
+        header = messages[0][0]
+        cells = np.concatenate([cells for _, cells, _ in messages])
+        arrivalTimes = [arrivalTime for _, _, arrivalTime in messages if arrivalTime is not None]
+        arrivalTime = max(arrivalTimes) if arrivalTimes else np.nan
+        cno = cells['cno'][~np.isnan(cells['cno'])]
+        systems = b''.join(sorted(set(bytes(h['system']) for h, _, _ in messages)))
+        record = np.array((header['tow'], header['station'], len(messages), systems, sum(int(h['numSats']) for h, _, _ in messages),
+                           len(cells), cno.mean() if len(cno) else np.nan, complete, arrivalTime,
+                           self.latency(int(header['tow']), arrivalTime)), dtype=EPOCH_DTYPE)[()]
+        self.epochs.append(record)
+        if self.epochCallback is not None:
+            self.epochCallback(record)
+        return record
+
+    def tables(self):
+        # {'RTCM-MSM': messages, 'RTCM-MSM.repeated': cells, 'RTCM-MSM.epochs': epochs}, e.g. for ubxArrays.saveArrays
+        return {'RTCM-MSM': np.array(self.messages, dtype=MSM_DTYPE).reshape(-1),
+                'RTCM-MSM' + REPEATED_SUFFIX: np.concatenate(self.cells) if self.cells else np.zeros(0, dtype=CELL_DTYPE),
+                'RTCM-MSM.epochs': np.array(list(self.epochs), dtype=EPOCH_DTYPE).reshape(-1)}
+
+
+class MsmMonitor(MsmCollector):
+    def __init__(self, reader=None, leapSeconds=GPSMinusUTC, maxEpochs=3600):
+        # reader (UbloxReader or AsyncUbloxReader) gives the receiver time from NAV-PVT
+        MsmCollector.__init__(self, leapSeconds, maxEpochs)
+        self.reader = reader
+        # (iTOW, host time) of the last NAV-PVT
+        self.pvt = None
+        # Only the epoch summaries are needed to monitor
+        self.keepCells = False
+        if reader is not None:
+            reader.subscribe('NAV-PVT', self.handleMessage)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.unsubscribe(self.handleMessage)
+
+    def handleMessage(self, msgTime, msgFormat, msgData, rawMessage):
+        self.pvt = (msgData[0]['ITOW'], msgTime)
+
+    def handleFrame(self, msgType, frame, offset):
+        # FrameScanner.rtcmCallback
+        if msgType in MSM_TYPES:
+            self.addMessage(bytes(frame[3:-3]), time.time())
+
+    def addMessage(self, payload, arrivalTime=None):
+        header = MsmCollector.addMessage(self, payload, arrivalTime)
+        if not self.keepCells:
+            self.messages = []
+            self.cells = []
+        return header
+
+    def latency(self, tow, arrivalTime):
+        # Receiver time of week at arrival, from the last NAV-PVT, minus the epoch time
+        if self.pvt is None or np.isnan(arrivalTime):
+            return np.nan
+        iTOW, pvtTime = self.pvt
+        return towDifference(iTOW + (arrivalTime - pvtTime)*1000., tow)
+
+    def reset(self):
+        # Start a new summary interval
+        self.epochs.clear()
+        self.decodeErrors = 0
+
+    def summary(self):
+        # Statistics over the epochs since the last reset, or None if there are none
+        epochs = np.array(list(self.epochs), dtype=EPOCH_DTYPE).reshape(-1)
+        if not len(epochs):
+            return None
+        latency = epochs['latency'][~np.isnan(epochs['latency'])]
+        gaps = np.diff(epochs['tow']) % WEEK_MS
+        return {'epochs': len(epochs),
+                'incomplete': int((~epochs['complete']).sum()),
+                'meanSats': float(epochs['numSats'].mean()),
+                'minSats': int(epochs['numSats'].min()),
+                'meanCells': float(epochs['numCells'].mean()),
+                'meanCno': float(np.nanmean(epochs['meanCno'])) if not np.isnan(epochs['meanCno']).all() else np.nan,
+                'meanLatency': float(latency.mean()) if len(latency) else np.nan,
+                'maxLatency': float(latency.max()) if len(latency) else np.nan,
+                # Epochs missing, taking the most common interval as the rate
+                'missedEpochs': int((gaps//np.median(gaps) - 1).clip(0).sum()) if len(gaps) and np.median(gaps) > 0 else 0,
+                'decodeErrors': self.decodeErrors}
+
+    @staticmethod
+    def formatEpoch(record):
+        text = 'TOW {:.1f} s station {}: {} messages ({}), {} satellites, {} signals, C/N0 {:.1f} dB-Hz'.format(
+            record['tow']/1e3, record['station'], record['numMessages'], record['systems'].decode(), record['numSats'],
+            record['numCells'], record['meanCno'])
+        if not np.isnan(record['latency']):
+            text += ', latency {:.0f} ms'.format(record['latency'])
+        if not record['complete']:
+            text += ' (incomplete)'
+        return text
+
+
+def decodeFile(path, leapSeconds=GPSMinusUTC):
+    # Collector with every MSM message of a file of RTCM3 frames, possibly mixed with UBX
+    from frameScanner import FrameScanner
+    collector = MsmCollector(leapSeconds)
+    scanner = FrameScanner(maxLength=4096, rtcmCallback=lambda msgType, frame, offset: collector.addFrame(frame))
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            scanner.feed(data)
+            for _ in scanner.frames():
+                pass
+    collector.finishEpoch(False)
+    return collector
+
+
+if __name__=='__main__':
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(description='Decode RTCM3 MSM4/MSM7 messages to columnar tables, or monitor a correction stream')
+    parser.add_argument('--file', '-f', help='File of RTCM3 frames (UBX frames in between are skipped)')
+    parser.add_argument('--output', '-o', help='.npz file for the tables, default is next to the input file')
+    parser.add_argument('--rtcm-device', help='Serial port the corrections arrive on, e.g. the radio')
+    parser.add_argument('--rtcm-baudrate', type=int, default=57600)
+    parser.add_argument('--device', '-d', help='Receiver serial port, for the NAV-PVT time to measure latency')
+    parser.add_argument('--baudrate', '-b', type=int, default=115200)
+    parser.add_argument('--interval', '-i', type=float, default=10, help='Seconds between summaries when monitoring')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Print every epoch')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.file is not None:
+        from ubxArrays import saveArrays
+        collector = decodeFile(args.file)
+        tables = collector.tables()
+        if args.verbose:
+            for record in tables['RTCM-MSM.epochs']:
+                print(MsmMonitor.formatEpoch(record))
+        for name in sorted(tables):
+            print('{}: {}'.format(name, len(tables[name])))
+        saveArrays(args.output or os.path.splitext(args.file)[0] + '.npz', tables)
+
+    elif args.rtcm_device is not None:
+        import serial
+        import serial.threaded
+        from frameScanner import FrameScanner
+        from ublox2 import UbloxReader
+        rtcmPort = serial.Serial(args.rtcm_device, args.rtcm_baudrate, timeout=0.1)
+        receiver = None
+        reader = None
+        if args.device is not None:
+            receiver = serial.threaded.ReaderThread(serial.Serial(args.device, args.baudrate, timeout=1), UbloxReader)
+            receiver.start()
+            reader = receiver.connect()[1]
+        monitor = MsmMonitor(reader)
+        if args.verbose:
+            monitor.epochCallback = lambda record: print(MsmMonitor.formatEpoch(record))
+        scanner = FrameScanner(maxLength=4096, rtcmCallback=monitor.handleFrame)
+        lastReport = time.time()
+        try:
+            while True:
+                scanner.feed(rtcmPort.read(4096))
+                for _ in scanner.frames():
+                    pass
+                if time.time() - lastReport >= args.interval:
+                    lastReport = time.time()
+                    summary = monitor.summary()
+                    monitor.reset()
+                    if summary is None:
+                        print('No MSM epochs received')
+                        continue
+                    print('{epochs} epochs ({incomplete} incomplete, {missedEpochs} missed): {meanSats:.1f} satellites (min {minSats}), '
+                          '{meanCells:.1f} signals, C/N0 {meanCno:.1f} dB-Hz, latency {meanLatency:.0f} ms (max {maxLatency:.0f} ms), '
+                          '{decodeErrors} decode errors'.format(**summary))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            monitor.close()
+            if receiver is not None:
+                receiver.close()
+            rtcmPort.close()
+    else:
+        parser.error('Give --file or --rtcm-device')
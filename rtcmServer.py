@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+"""
+RTCM3 correction server
+
+Serves the RTCM3 frames of a base station's receiver stream to many rovers
+over TCP, in one thread. CorrectionServer.handleFrame is a FrameScanner
+rtcmCallback, so the frames come straight out of the capture path, and the
+listening socket and every client are multiplexed with selectors.
+
+Rovers connect with an NTRIP request (GET /<mountpoint>, NTRIP 1.0 or 2.0,
+optionally with basic authentication) as they would to a caster, and GET /
+returns the source table. Each mountpoint can forward only some message
+types and decimate others, e.g. send the station position (1005) every 10th
+time it is output:
+
+    LITE:1005,1077,1087:1005/10
+
+Each client has a bounded send queue. A client that falls too far behind
+(more than maxQueueBytes queued, or data waiting longer than maxQueueAge
+seconds) is disconnected rather than allowed to slow everyone else down or
+be sent stale corrections.
+"""
+import os
+import time
+import errno
+import base64
+import socket
+import logging
+import selectors
+import threading
+import collections
+
+import serial
+
+from frameScanner import FrameScanner
+from rtcmFramer import RTCM3_MESSAGE_TYPES
+
+DEFAULT_PORT = 2101
+DEFAULT_MAX_CLIENTS = 500
+# Queued bytes and seconds before a slow client is disconnected
+DEFAULT_MAX_QUEUE_BYTES = 64*1024
+DEFAULT_MAX_QUEUE_AGE = 5.0
+# Seconds a new connection has to send its request
+REQUEST_TIMEOUT = 10.0
+MAX_REQUEST_SIZE = 4096
+# Buffers per sendmsg call, well under IOV_MAX
+MAX_SEND_BUFFERS = 64
+SERVER_NAME = 'NTRIP ubx rtcmServer/1.0'
+# Bytes read per readable receiver port, and seconds between attempts to reopen a port that failed
+READ_SIZE = 65536
+RETRY_INTERVAL = 5
+
+
+class Mountpoint(object):
+    def __init__(self, name, messageTypes=None, decimation=None):
+        self.name = name
+        # Message types forwarded, None for all
+        self.messageTypes = set(messageTypes) if messageTypes is not None else None
+        # {message type: n} forwards every nth frame of that type. Frames are counted,
+        # so a type split over several messages per epoch should not be decimated.
+        self.decimation = dict(decimation or {})
+        self.counts = collections.Counter()
+        self.clients = set()
+
+    def accepts(self, msgType):
+        if self.messageTypes is not None and msgType not in self.messageTypes:
+            return False
+        n = self.decimation.get(msgType)
+        if n is None:
+            return True
+        count = self.counts[msgType]
+        self.counts[msgType] = count + 1
+        return count % n == 0
+
+    def sourceTableEntry(self):
+        types = sorted(self.messageTypes) if self.messageTypes is not None else sorted(RTCM3_MESSAGE_TYPES)
+        details = ','.join('{}({})'.format(msgType, self.decimation[msgType]) if msgType in self.decimation else str(msgType)
+                           for msgType in types)
+        return 'STR;{0};{0};RTCM 3;{1};2;GPS+GLO+GAL+BDS;;;0.00;0.00;0;0;{2};none;B;N;0;'.format(self.name, details, SERVER_NAME.split()[1])
+
+
+def parseMountpoint(spec):
+    # NAME[:TYPES][:DECIMATION], e.g. LITE:1005,1077,1087:1005/10
+    parts = spec.split(':')
+    if not parts[0] or len(parts) > 3:
+        raise ValueError('Invalid mountpoint: {}'.format(spec))
+    messageTypes = [int(msgType) for msgType in parts[1].split(',')] if len(parts) > 1 and parts[1] else None
+    decimation = {}
+    if len(parts) > 2 and parts[2]:
+        for item in parts[2].split(','):
+            msgType, n = item.split('/')
+            if int(n) < 1:
+                raise ValueError('Invalid decimation: {}'.format(item))
+            decimation[int(msgType)] = int(n)
+    return Mountpoint(parts[0], messageTypes, decimation)
+
+
+class Client(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.connectTime = time.time()
+        self.request = b''
+        self.mountpoint = None
+        # NTRIP 2.0 clients get the data as HTTP chunks
+        self.chunked = False
+        # Bytes objects waiting to be sent, and how much of the first one was
+        self.queue = collections.deque()
+        self.queueBytes = 0
+        self.sentOffset = 0
+        # Time the oldest queued data was queued, None if the queue is empty
+        self.backlogTime = None
+        self.bytesSent = 0
+        self.framesQueued = 0
+
+    def name(self):
+        return '{}:{}'.format(*self.address[:2])
+
+
+class CorrectionServer(object):
+    def __init__(self, mountpoints, host='', port=DEFAULT_PORT, maxClients=DEFAULT_MAX_CLIENTS, maxQueueBytes=DEFAULT_MAX_QUEUE_BYTES,
+                 maxQueueAge=DEFAULT_MAX_QUEUE_AGE, credentials=None, logger=logging):
+        self.mountpoints = collections.OrderedDict((mountpoint.name, mountpoint) for mountpoint in mountpoints)
+        self.maxClients = maxClients
+        self.maxQueueBytes = maxQueueBytes
+        self.maxQueueAge = maxQueueAge
+        # 'user:password' required from the clients, None for no authentication
+        self.authorization = 'Basic ' + base64.b64encode(credentials.encode()).decode() if credentials is not None else None
+        self.logger = logger
+
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(socket.SOMAXCONN)
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+
+        # Frames from handleFrame, fanned out by the serving thread. A reader thread (e.g.
+        # serial.threaded.ReaderThread) wakes the serving thread through a socket pair.
+        self.incoming = collections.deque()
+        self.wakeupReceiver, self.wakeupSender = socket.socketpair()
+        self.wakeupReceiver.setblocking(False)
+        self.wakeupSender.setblocking(False)
+        self.selector.register(self.wakeupReceiver, selectors.EVENT_READ, self.wakeupReceiver)
+        self.thread = threading.get_ident()
+
+        self.clients = set()
+        self.resetStats()
+        self.logger.info('Correction server listening on {}:{}, mountpoints {}'.format(self.address[0], self.address[1], ', '.join(self.mountpoints)))
+
+    def resetStats(self):
+        self.framesReceived = 0
+        self.bytesSent = 0
+        self.connections = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.statsStartTime = time.time()
+
+    def addSource(self, fileobj, callback):
+        # Call callback() from poll when fileobj is readable, e.g. to read the receiver
+        # port in the same thread
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def removeSource(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def handleFrame(self, msgType, frame, offset):
+        # FrameScanner.rtcmCallback. frame is only valid during the call, so it is copied.
+        self.incoming.append((msgType, bytes(frame)))
+        if threading.get_ident() != self.thread:
+            try:
+                self.wakeupSender.send(b'\0')
+            except BlockingIOError:
+                # Already signalled
+                pass
+
+    def poll(self, timeout=None):
+        # Serve connections and queued frames for up to timeout seconds
+        self.thread = threading.get_ident()
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self.accept()
+            elif key.data is self.wakeupReceiver:
+                try:
+                    while self.wakeupReceiver.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            elif isinstance(key.data, Client):
+                client = key.data
+                if client not in self.clients:
+                    # Closed while handling an earlier event
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.readReady(client)
+                if events & selectors.EVENT_WRITE and client in self.clients:
+                    self.writeReady(client)
+            else:
+                key.data()
+        while self.incoming:
+            self.broadcast(*self.incoming.popleft())
+        self.checkClients()
+
+    def serve(self, duration=None):
+        # Serve until duration seconds have passed, or forever
+        endTime = time.time() + duration if duration is not None else None
+        while endTime is None or time.time() < endTime:
+            self.poll(1.0 if endTime is None else max(min(endTime - time.time(), 1.0), 0))
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                # e.g. out of file descriptors - the connection stays in the backlog
+                self.logger.error('Correction server accept failed: {}'.format(exc))
+                return
+            if len(self.clients) >= self.maxClients:
+                self.rejected += 1
+                sock.close()
+                self.logger.warning('Correction server full, rejected {}:{}'.format(*address[:2]))
+                continue
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = Client(sock, address)
+            self.clients.add(client)
+            self.connections += 1
+            self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def readReady(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self.closeClient(client, str(exc))
+            return
+        if not data:
+            self.closeClient(client, 'disconnected')
+            return
+        if client.mountpoint is not None:
+            # e.g. GGA sentences from the rover, which are not used
+            return
+        client.request += data
+        if b'\r\n\r\n' in client.request or b'\n\n' in client.request:
+            self.handleRequest(client)
+        elif len(client.request) > MAX_REQUEST_SIZE:
+            self.closeClient(client, 'request too long')
+
+    def handleRequest(self, client):
+        lines = client.request.decode('latin-1').splitlines()
+        fields = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        version2 = 'ntrip/2' in headers.get('ntrip-version', '').lower()
+
+        if len(fields) < 2 or fields[0] != 'GET':
+            self.reply(client, version2, '400 Bad Request')
+            self.closeClient(client, 'bad request: {}'.format(lines[0] if lines else ''))
+            return
+        name = fields[1].lstrip('/')
+        if not name:
+            self.sendSourceTable(client, version2)
+            self.closeClient(client, 'sent source table')
+            return
+        if name not in self.mountpoints:
+            if version2:
+                self.reply(client, True, '404 Not Found')
+            else:
+                # NTRIP 1.0 casters answer an unknown mountpoint with the source table
+                self.sendSourceTable(client, False)
+            self.closeClient(client, 'unknown mountpoint {}'.format(name))
+            return
+        if self.authorization is not None and headers.get('authorization') != self.authorization:
+            self.reply(client, version2, '401 Unauthorized', 'WWW-Authenticate: Basic realm="/{}"\r\n'.format(name))
+            self.closeClient(client, 'not authorized for {}'.format(name))
+            return
+
+        client.request = None
+        client.mountpoint = self.mountpoints[name]
+        client.mountpoint.clients.add(client)
+        client.chunked = version2
+        if version2:
+            header = 'HTTP/1.1 200 OK\r\nNtrip-Version: Ntrip/2.0\r\nServer: {}\r\nContent-Type: gnss/data\r\nCache-Control: no-store, no-cache, max-age=0\r\nPragma: no-cache\r\nConnection: close\r\nTransfer-Encoding: chunked\r\n\r\n'.format(SERVER_NAME)
+        else:
+            header = 'ICY 200 OK\r\n\r\n'
+        self.send(client, header.encode())
+        self.logger.info('Correction client {} connected to {} ({} clients)'.format(client.name(), name, len(self.clients)))
+
+    def reply(self, client, version2, status, headers=''):
+        protocol = 'HTTP/1.1' if version2 else 'HTTP/1.0'
+        self.sendNow(client, '{} {}\r\nServer: {}\r\n{}Connection: close\r\n\r\n'.format(protocol, status, SERVER_NAME, headers).encode())
+
+    def sendSourceTable(self, client, version2):
+        table = ''.join(mountpoint.sourceTableEntry() + '\r\n' for mountpoint in self.mountpoints.values()) + 'ENDSOURCETABLE\r\n'
+        if version2:
+            header = 'HTTP/1.1 200 OK\r\nNtrip-Version: Ntrip/2.0\r\nServer: {}\r\nContent-Type: gnss/sourcetable\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+        else:
+            header = 'SOURCETABLE 200 OK\r\nServer: {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n\r\n'
+        self.sendNow(client, header.format(SERVER_NAME, len(table)).encode() + table.encode())
+
+    def sendNow(self, client, data):
+        # Best effort send of a short reply before closing the connection
+        try:
+            client.sock.send(data)
+        except OSError:
+            pass
+
+    def broadcast(self, msgType, frame):
+        self.framesReceived += 1
+        chunk = None
+        for mountpoint in self.mountpoints.values():
+            if not mountpoint.clients or not mountpoint.accepts(msgType):
+                continue
+            for client in list(mountpoint.clients):
+                if client.chunked:
+                    if chunk is None:
+                        chunk = '{:x}\r\n'.format(len(frame)).encode() + frame + b'\r\n'
+                    self.send(client, chunk)
+                else:
+                    self.send(client, frame)
+                client.framesQueued += 1
+
+    def send(self, client, data):
+        if client.queueBytes + len(data) > self.maxQueueBytes:
+            self.evict(client, '{} bytes queued'.format(client.queueBytes))
+            return
+        if not client.queue:
+            # Usually the socket buffer has room and the data goes out without queueing
+            try:
+                sent = client.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as exc:
+                self.closeClient(client, str(exc))
+                return
+            client.bytesSent += sent
+            self.bytesSent += sent
+            if sent == len(data):
+                return
+            client.sentOffset = sent
+            client.backlogTime = time.time()
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        client.queue.append(data)
+        client.queueBytes += len(data)
+
+    def writeReady(self, client):
+        buffers = [memoryview(client.queue[0])[client.sentOffset:]]
+        buffers.extend(client.queue[i] for i in range(1, min(len(client.queue), MAX_SEND_BUFFERS)))
+        try:
+            sent = client.sock.sendmsg(buffers)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self.closeClient(client, str(exc))
+            return
+        client.bytesSent += sent
+        self.bytesSent += sent
+        sent += client.sentOffset
+        while client.queue and sent >= len(client.queue[0]):
+            data = client.queue.popleft()
+            sent -= len(data)
+            client.queueBytes -= len(data)
+        client.sentOffset = sent
+        if client.queue:
+            client.backlogTime = time.time()
+        else:
+            client.backlogTime = None
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def checkClients(self):
+        # Drop clients that never sent a request or whose queue is not draining
+        now = time.time()
+        for client in list(self.clients):
+            if client.mountpoint is None and now - client.connectTime > REQUEST_TIMEOUT:
+                self.closeClient(client, 'no request')
+            elif client.backlogTime is not None and now - client.backlogTime > self.maxQueueAge:
+                self.evict(client, 'no data sent for {:.1f} s'.format(now - client.backlogTime))
+
+    def evict(self, client, reason):
+        self.evicted += 1
+        self.logger.warning('Correction client {} too slow, disconnecting: {}'.format(client.name(), reason))
+        self.closeClient(client)
+
+    def closeClient(self, client, reason=None):
+        if client not in self.clients:
+            return
+        self.clients.discard(client)
+        if client.mountpoint is not None:
+            client.mountpoint.clients.discard(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+        client.queue.clear()
+        client.queueBytes = 0
+        if reason is not None:
+            self.logger.debug('Correction client {} closed: {}'.format(client.name(), reason))
+
+    def stats(self, reset=False):
+        elapsed = max(time.time() - self.statsStartTime, 1e-9)
+        stats = {'clients': len(self.clients),
+                 'mountpoints': dict((name, len(mountpoint.clients)) for name, mountpoint in self.mountpoints.items()),
+                 'framesReceived': self.framesReceived,
+                 'sendRate': self.bytesSent/elapsed,
+                 'queueBytes': sum(client.queueBytes for client in self.clients),
+                 'connections': self.connections,
+                 'rejected': self.rejected,
+                 'evicted': self.evicted}
+        if reset:
+            self.resetStats()
+        return stats
+
+    @staticmethod
+    def formatStats(stats):
+        mountpoints = ', '.join('{}: {}'.format(name, count) for name, count in stats['mountpoints'].items())
+        return 'correction server: {} clients ({}), {} frames in, {:.1f} KB/s out, {} B queued, {} connections, {} rejected, {} evicted'.format(
+            stats['clients'], mountpoints, stats['framesReceived'], stats['sendRate']/1e3, stats['queueBytes'],
+            stats['connections'], stats['rejected'], stats['evicted'])
+
+    def close(self):
+        for client in list(self.clients):
+            self.closeClient(client)
+        self.selector.close()
+        self.listener.close()
+        self.wakeupReceiver.close()
+        self.wakeupSender.close()
+
+
+class PortSource(object):
+    # Reads a receiver port from CorrectionServer.poll, in the serving thread, and feeds its
+    # RTCM3 frames to the server. A port that fails (e.g. an unplugged USB receiver) is
+    # closed and reopened by check().
+    def __init__(self, server, device, baudRate, logger=logging):
+        self.server = server
+        self.device = device
+        self.baudRate = baudRate
+        self.logger = logger
+        self.scanner = FrameScanner(maxLength=4096, rtcmCallback=server.handleFrame)
+        self.ser = None
+        self.retryTime = 0
+
+    def open(self):
+        try:
+            self.ser = serial.Serial(self.device, self.baudRate, timeout=0)
+            self.server.addSource(self.ser.fileno(), self.readReady)
+        except (OSError, serial.SerialException) as exc:
+            if self.retryTime:
+                self.logger.debug('{}: reopen failed: {}'.format(self.device, exc))
+            else:
+                self.logger.error('{}: {}'.format(self.device, exc))
+            self.close()
+            self.retryTime = time.time() + RETRY_INTERVAL
+            return
+        self.logger.info('Opened {} at {} baud'.format(self.device, self.baudRate))
+
+    def readReady(self):
+        try:
+            data = os.read(self.ser.fileno(), READ_SIZE)
+            if not data:
+                raise OSError(errno.EIO, 'Device closed')
+        except OSError as exc:
+            self.fail(exc)
+            return
+        self.scanner.feed(data)
+        for frame in self.scanner.frames():
+            pass
+
+    def fail(self, exc):
+        self.logger.error('{}: {}'.format(self.device, exc))
+        self.close()
+        self.retryTime = time.time() + RETRY_INTERVAL
+
+    def check(self):
+        # Reopen the port if it failed
+        if self.ser is None and time.time() >= self.retryTime:
+            self.open()
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.server.removeSource(self.ser.fileno())
+            except (KeyError, ValueError):
+                # Failed before it was registered
+                pass
+            self.ser.close()
+            self.ser = None
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve the RTCM3 corrections of a receiver or file to NTRIP clients')
+    parser.add_argument('--device', '-d', help='Receiver serial port')
+    parser.add_argument('--baudrate', '-b', type=int, default=921600)
+    parser.add_argument('--file', '-f', help='Replay the RTCM3 frames of a capture file instead, at --replay-rate')
+    parser.add_argument('--replay-rate', type=float, default=1.0, help='Frames per second when replaying a file')
+    parser.add_argument('--host', default='', help='Address to listen on')
+    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--mountpoint', '-m', action='append', help='NAME[:TYPES][:TYPE/N,...], e.g. LITE:1005,1077,1087:1005/10. Default BASE with all types.')
+    parser.add_argument('--max-clients', type=int, default=DEFAULT_MAX_CLIENTS)
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE_BYTES, help='Bytes queued for a client before it is disconnected')
+    parser.add_argument('--credentials', help='user:password the clients must give')
+    parser.add_argument('--stats-interval', '-s', type=float, default=10)
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.DEBUG if args.debug else logging.INFO)
+    try:
+        mountpoints = [parseMountpoint(spec) for spec in args.mountpoint or ['BASE']]
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    server = CorrectionServer(mountpoints, args.host, args.port, args.max_clients, args.max_queue, credentials=args.credentials)
+    port = None
+    try:
+        if args.device is not None:
+            port = PortSource(server, args.device, args.baudrate)
+            port.open()
+            frames = None
+        elif args.file is not None:
+            frames = []
+            replayScanner = FrameScanner(maxLength=4096, rtcmCallback=lambda msgType, frame, offset: frames.append((msgType, bytes(frame))))
+            with open(args.file, 'rb') as f:
+                replayScanner.feed(f.read())
+            for frame in replayScanner.frames():
+                pass
+            logging.info('Replaying {} RTCM3 frames from {}'.format(len(frames), args.file))
+        else:
+            parser.error('Give --device or --file')
+
+        lastStatsTime = nextFrameTime = time.time()
+        index = 0
+        while True:
+            if frames is not None:
+                now = time.time()
+                while frames and now >= nextFrameTime:
+                    server.handleFrame(frames[index][0], frames[index][1], None)
+                    index = (index + 1) % len(frames)
+                    nextFrameTime += 1/args.replay_rate
+                server.poll(max(nextFrameTime - time.time(), 0) if frames else 1.0)
+            else:
+                server.poll(1.0)
+                port.check()
+            if time.time() - lastStatsTime > args.stats_interval:
+                logging.info(CorrectionServer.formatStats(server.stats(reset=True)))
+                lastStatsTime = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if port is not None:
+            port.close()
+        server.close()
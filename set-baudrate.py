@@ -24,11 +24,12 @@
 # Set baudrate
 import logging
 from ublox import Ublox
+from ubxBaudRate import BAUD_RATES
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('baudRate', type=int, choices=[9600, 115200], help='Specify the baudrate. Must be 9600 or 115200')
+    parser.add_argument('baudRate', type=int, choices=BAUD_RATES, help='Specify the baudrate, from 9600 to 921600')
     parser.add_argument('--device', '-d', help='Specify the serial port device to communicate with. e.g. /dev/ttyO5')
     parser.add_argument('--verbose', '-v', action='store_true')
     parser.add_argument('--debug', action='store_true')
@@ -1,66 +1,60 @@
 #!/usr/bin/env python3
 
-from ubloxMessage import UbloxMessage
+from ubxCompressed import openCapture, compressRange, UbzFile
 import datetime
 import os.path
 
-if __name__=='__main__':
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument('input')
-    parser.add_argument('--datetime', help="UTC datetime in ISO8601 format YYYYMMDDTHHMMSS.fff")
-    args = parser.parse_args()
+# Bytes copied per write when splitting
+COPY_CHUNK_SIZE = 1 << 24
 
-    index = args.datetime.find('.')
+def parseDatetime(value):
+    index = value.find('.')
     if index >= 0:
-        dtString = args.datetime[:index]
-        fractionalSeconds = float(args.datetime[index:])
+        dtString = value[:index]
+        fractionalSeconds = float(value[index:])
     else:
-        dtString = args.datetime
+        dtString = value
         fractionalSeconds = 0
 
     dt = datetime.datetime.strptime(dtString, '%Y%m%dT%H%M%S')
     dt += datetime.timedelta(seconds=fractionalSeconds)
+    return dt
+
+def splitFile(ubxFile, splitTimes, outputPaths):
+    # Cut the file at the first epoch after each split time and copy the raw byte
+    # ranges to len(splitTimes) + 1 output files. Returns the frame count of each part.
+    # The parts of a .ubz file are compressed again with the same codec.
+    cuts = [ubxFile.seek(dt, after=True) for dt in sorted(splitTimes)]
+    frameCuts = [0] + cuts + [len(ubxFile)]
+    byteCuts = [0] + [int(ubxFile.index['offset'][i]) if i < len(ubxFile) else ubxFile.size for i in cuts] + [ubxFile.size]
+
+    for outputPath, start, end in zip(outputPaths, byteCuts[:-1], byteCuts[1:]):
+        if isinstance(ubxFile, UbzFile):
+            compressRange(ubxFile, outputPath, start, end, ubxFile.codec)
+            continue
+        with open(outputPath, 'wb') as outputFile:
+            for chunkStart in range(start, end, COPY_CHUNK_SIZE):
+                outputFile.write(ubxFile.buffer[chunkStart:min(chunkStart + COPY_CHUNK_SIZE, end)])
+
+    return [last - first for first, last in zip(frameCuts[:-1], frameCuts[1:])]
 
-    print('Split time: {}'.format(dt.strftime('%Y-%m-%d %H:%M:%S.%f')))
-
-    filenameNoExt, ext = os.path.splitext(args.input)
-    f = open(args.input, 'rb')
-    data = f.read()
-
-    outputFile = open('{}_part1'.format(filenameNoExt) + ext, 'wb')
-    start = 0
-    numMessages = 0
-    split = False
-    while start < (len(data) - 8):
-        rawMessage, msgClass, msgId, length, start = UbloxMessage.getMessageFromBuffer(data, start)
-        if rawMessage is not None:
-            payload = rawMessage[6:length+6]
-            try:
-                msgFormat, msgData = UbloxMessage.decode(msgClass, msgId, length, payload)
-            except ValueError:
-                continue
-
-            UbloxMessage.printMessage(msgFormat, msgData, None, fmt='short')
-
-            if msgFormat == 'NAV-PVT':
-                curDt = datetime.datetime(msgData[0]['Year'], msgData[0]['Month'], msgData[0]['Day'], 
-                                          msgData[0]['Hour'], msgData[0]['Min'], msgData[0]['Sec'])
-                curDt += datetime.timedelta(microseconds=msgData[0]['Nano']/1e3)
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input')
+    parser.add_argument('--datetime', nargs='+', help="UTC datetime(s) in ISO8601 format YYYYMMDDTHHMMSS.fff")
+    args = parser.parse_args()
 
-                if not split and (curDt > dt):
-                    # print('splitDt: {}, curDt: {}'.format(dt, curDt))
-                    print('**** SPLIT ****')
-                    outputFile.close()
-                    numMessages1 = numMessages
-                    numMessages = 0
-                    outputFile = open('{}_part2'.format(filenameNoExt) + ext, 'wb')
-                    split = True
+    splitTimes = sorted(parseDatetime(value) for value in args.datetime)
+    for dt in splitTimes:
+        print('Split time: {}'.format(dt.strftime('%Y-%m-%d %H:%M:%S.%f')))
 
-            numMessages += 1
-            outputFile.write(rawMessage)
+    filenameNoExt, ext = os.path.splitext(args.input)
+    outputPaths = ['{}_part{}'.format(filenameNoExt, i) + ext for i in range(1, len(splitTimes) + 2)]
 
-    numMessages2 = numMessages
-    outputFile.close()
+    with openCapture(args.input) as ubxFile:
+        numMessages = splitFile(ubxFile, splitTimes, outputPaths)
 
-    print('\n# messages before split: {}, after: {}'.format(numMessages1, numMessages2))
\ No newline at end of file
+    print('')
+    for outputPath, count in zip(outputPaths, numMessages):
+        print('{}: {} messages'.format(outputPath, count))
@@ -188,8 +188,12 @@ if __name__ == "__main__":
     if args.output is not None:
         outputFile = open(args.output, 'wb')
 
+    # Only the messages used by callback are decoded, unless all are printed with --raw
+    messageTypes = None if args.raw else ['HNR-PVT', 'NAV-ATT', 'NAV-DOP', 'NAV-STATUS', 'NAV-SVINFO', 'ESF-STATUS']
+
     if args.device:
-        t = ubx.Parser(callback, device=args.device, rawCallback=rawCallback)
+        t = ubx.Parser(device=args.device, rawCallback=rawCallback, lazy=True)
+        t.subscribe(messageTypes, callback)
         try:
             gobject.MainLoop().run()
         except KeyboardInterrupt:
@@ -197,7 +201,8 @@ if __name__ == "__main__":
             if outputFile is not None:
                 outputFile.close()
     else:
-        t = ubx.Parser(callback, device=False)
+        t = ubx.Parser(device=False, lazy=True)
+        t.subscribe(messageTypes, callback)
         binFile = args.file
         data = open(binFile,'r').read()
         t.parse(data)
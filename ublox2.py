@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
-from ubloxMessage import UbloxMessage, CLIDPAIR
+from ubloxMessage import UbloxMessage, CLIDPAIR, CLIDPAIR_INV
+from frameScanner import FrameScanner
+from ubxDispatch import Dispatcher
+from ubxIndex import EPOCH_MESSAGES
+from ubxWriter import CaptureWriter
+from ubxRequests import RequestTable, pollKey, ackKey
 import serial
 import serial.threaded
+import concurrent.futures
 import time
 import traceback
 import logging
@@ -11,24 +17,63 @@ import datetime
 
 class UbloxReader(serial.threaded.Protocol):
     def __init__(self):
-        self.buffer = b''
-        self.start = 0
-        self.pollResult = None
-        self.pollTarget = None
+        self.scanner = FrameScanner(maxLength=4096)
+        # Pass LazyMessage views as msgData instead of lists of dicts
+        self.lazyDecode = False
+        # Pass compact records from MSGRECORD as msgData, e.g. to keep many messages in memory
+        self.recordDecode = False
+        # Handlers subscribed to message types. Messages that no subscriber, poll, print
+        # or save needs are not decoded, unless userHandler is set.
+        self.dispatcher = Dispatcher()
+        # Setting this False skips checksumming frames nobody subscribed to, when no
+        # stream is being saved and there is no userHandler
+        self.checksumUnsubscribed = True
+        # Outstanding polls and config messages, resolved by the parser thread
+        self.requests = RequestTable()
         self.printMessageFlag = False
         self.printMessageFilter = None
         self.saveStreamFlag = False
         self.saveStreamFilter = None
         self.saveFormat = 'ubx'
-        self.saveFile = None
         self.saveFileName = 'ublox'
+        self.saveInterval = None
+        # Start a new save file before one grows past this many bytes, None for no limit
+        self.saveMaxFileSize = None
+        # Seconds between fsyncs of the save file, 0 for every write, None to leave it to the OS
+        self.saveFsyncInterval = None
+        # Write a sidecar index (<save file>.idx) next to UBX save files
+        self.saveIndexFlag = True
+        # 'zlib' or 'lzma' to save seekable compressed .ubz files (see ubxCompressed), None for .ubx
+        self.saveCompression = None
+        # Writes the save files from its own thread, created on the first saved message
+        self.saveWriter = None
         # self.userHandler = None
-        self.lastFlushTime = None
         self.logger = logging
 
     def userHandler(self, msgTime, msgFormat, msgData, rawMessage):
         pass
 
+    def hasUserHandler(self):
+        # userHandler was assigned or overridden, so it gets every message decoded
+        return self.userHandler is not None and getattr(self.userHandler, '__func__', None) is not UbloxReader.userHandler
+
+    def subscribe(self, msgTypes, handler, decode=True):
+        # Call handler(msgTime, msgFormat, msgData, rawMessage) for each message of
+        # msgTypes, see Dispatcher.subscribe
+        self.dispatcher.subscribe(msgTypes, handler, decode)
+
+    def unsubscribe(self, handler, msgTypes=None):
+        self.dispatcher.unsubscribe(handler, msgTypes)
+
+    def needsDecode(self, msgClass, msgId, msgFormat):
+        # Whether a message must be decoded for a request, print or save
+        if self.requests.wants(msgClass, msgId):
+            return True
+        if self.printMessageFlag and (self.printMessageFilter is None or msgFormat in self.printMessageFilter):
+            return True
+        # Saving uses the epoch time for the file interval and the sidecar index
+        return self.saveStreamFlag and msgFormat in EPOCH_MESSAGES
+
     # Required for serial.threaded.Protocol
     def connection_made(self, transport):
         super(UbloxReader, self).connection_made(transport)
@@ -37,8 +82,8 @@ class UbloxReader(serial.threaded.Protocol):
     # Required for serial.threaded.Protocol
     def data_received(self, data):
         self.logger.debug('Received {} bytes'.format(len(data)))
-        self.buffer = self.buffer + data
-        self.logger.debug('Buffer size: {} bytes'.format(len(self.buffer)))
+        self.scanner.feed(data)
+        self.logger.debug('Buffer size: {} bytes'.format(self.scanner.pending()))
         self.parse()
 
     # Required for serial.threaded.Protocol
@@ -46,160 +91,124 @@ class UbloxReader(serial.threaded.Protocol):
         if exc:
             self.logger.error('*** EXCEPTION *** {}'.format(exc))
         self.logger.debug('Serial port closed.')
-        if self.saveFile is not None:
-            self.saveFile.close()
-            self.saveFile = None
+        if self.saveWriter is not None:
+            self.closeSaveFile()
             self.logger.debug('Save file closed.')
+        self.requests.failAll(ConnectionError('Serial port closed'))
 
     # Parse buffer looking for messages
     def parse(self):
         self.logger.debug('in UbloxReader.parse()')
-        if len(self.buffer) < 8:
-            self.logger.debug('UbloxReader.parse(): not enough data in buffer')
-            return
-        index = self.buffer.find(b'\xb5\x62')
-        if index >= 0:
-            self.start += index
-            msgTime = time.time()
-            self.logger.debug('UbloxReader.parse(): sending for validation')
-            result = UbloxMessage.validate(self.buffer[self.start:])
-            if result['valid']:
-                rawMessage = self.buffer[self.start:]
-                self.logger.debug('UbloxReader.parse(): sending to UbloxMessage.parse()')
-                msgFormat, msgData, remainder = UbloxMessage.parse(rawMessage)
-                rawMessage = rawMessage[:len(rawMessage) - len(remainder)] if remainder is not None else rawMessage[:len(rawMessage)]
-                self.buffer = remainder if remainder is not None else b''
-                self.start = 0
-                if msgFormat is not None:
-                    self.logger.debug('UbloxReader.parse(): sending to UbloxReader.handleMessage()')
-                    self.handleMessage(msgTime, msgFormat, msgData, rawMessage)
-                    return
-            else:
-                # Invalid message, move past sync bytes
-                if result['lengthMatch'] or ((result['length'] is not None) and (result['length'] > 4096)):
-                    if result['lengthMatch']:
-                        self.logger.debug('UbloxReader.parse(): invalid message in buffer, moving past sync')
-                    else:
-                        self.logger.debug('UbloxReader.parse(): invalid length ({}) - enforcing max length of 4096 bytes'.format(result['length']))
-                    self.buffer = self.buffer[self.start+2:]
-                    return
-                else:
-                    self.logger.debug('Ublox.parse(): Header indicates a message of length {}, buffer only has {} bytes'.format(result['length'], len(self.buffer)))
-                    return
-        # Discard all but the last byte
+        decode = UbloxMessage.decodeRecord if self.recordDecode else UbloxMessage.decodeLazy if self.lazyDecode else UbloxMessage.decode
+        route = self.dispatcher.route
+        decodeAll = self.hasUserHandler()
+        if self.checksumUnsubscribed or decodeAll or self.saveStreamFlag:
+            self.scanner.checksumKeys = None
         else:
-            self.logger.debug('UbloxReader.parse(): could not find sync in buffer, discarding all but the last byte')
-            self.buffer = self.buffer[-1:]
-            self.start = 0
-            return
-
-    # Handle a received message
-    def handleMessage(self, msgTime, msgFormat, msgData, rawMessage):
-        # This is a polled message
-        if (self.pollTarget is not None) and (msgFormat in self.pollTarget):
-            self.pollResult = (msgFormat, msgData)
-            self.pollTarget = None
+            self.scanner.checksumKeys = self.dispatcher.checksumKeys
+        for msgClass, msgId, payload, offset in self.scanner.frames():
+            msgTime = time.time()
+            length = len(payload)
+            msgFormat = CLIDPAIR_INV.get((msgClass, msgId))
+            if msgFormat is None:
+                continue
+            handlers, decodeFrame = route((msgClass, msgId))
+            msgData = None
+            if decodeAll or decodeFrame or self.needsDecode(msgClass, msgId, msgFormat):
+                try:
+                    msgFormat, msgData = decode(msgClass, msgId, length, payload)
+                except ValueError:
+                    continue
+            elif not handlers and not self.saveStreamFlag:
+                continue
+            rawMessage = bytes(self.scanner.rawFrame(offset, length))
+            self.logger.debug('UbloxReader.parse(): sending to UbloxReader.handleMessage()')
+            self.handleMessage(msgTime, msgFormat, msgData, rawMessage, handlers)
+
+    # Handle a received message. msgData is None if the message was not decoded.
+    def handleMessage(self, msgTime, msgFormat, msgData, rawMessage, handlers=()):
+        # Response to a poll or config message
+        if msgData is not None and self.requests.pending:
+            self.requests.resolve(msgFormat, msgData)
 
         # Save message
         if self.saveStreamFlag and (self.saveStreamFilter is None or msgFormat in self.saveStreamFilter):
             self.saveMessage(msgTime, msgFormat, msgData, rawMessage)
 
         # Print message to screen
-        if self.printMessageFlag and (self.printMessageFilter is None or msgFormat in self.printMessageFilter):
+        if self.printMessageFlag and (self.printMessageFilter is None or msgFormat in self.printMessageFilter) and msgData is not None:
             self.printMessage(msgTime, msgFormat, msgData)
 
         # Call user handler
         if self.userHandler is not None:
             self.userHandler(msgTime, msgFormat, msgData, rawMessage)
 
+        # Call subscribers
+        for handler in handlers:
+            handler(msgTime, msgFormat, msgData, rawMessage)
+
     def printMessage(self, msgTime, msgFormat, msgData):
         UbloxMessage.printMessage(msgFormat, msgData, msgTime, fmt='short')
 
     def saveMessage(self, msgTime, msgFormat, msgData, rawMessage):
-        if self.saveInterval is not None:
-            if msgFormat == 'NAV-PVT':
-                year = msgData[0]['Year']
-                month = msgData[0]['Month']
-                day = msgData[0]['Day']
-                hour = msgData[0]['Hour']
-                minute = msgData[0]['Min']
-                second = msgData[0]['Sec']
-                newFile = False
-                if self.saveInterval == 'hourly' and hour != self.curInterval:
-                    self.curInterval = hour
-                    newFile = True
-                elif self.saveInterval == 'daily' and day != self.curInterval:
-                    self.curInterval = day
-                    newFile = True
-
-                if newFile:
-                    if self.saveFile is not None:
-                        self.saveFile.close()
-                    dt = datetime.datetime(year, month, day, hour, minute, second)
-                    filename = '{}_{}.{}'.format(self.saveFileName, dt.strftime('%Y%m%dT%H%M%SZ'), self.saveFormat)
-                    self.logger.info('*** Opening save file {} for write'.format(filename))
-                    self.saveFile = open(filename, 'wb')
-                    self.lastFlushTime = time.time()
-        else:
-            if self.saveFile is None:
-                filename = '{}_{}.{}'.format(self.saveFileName, datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'), self.saveFormat)
-                self.logger.info('*** Opening save file {} for write'.format(filename))
-                self.saveFile = open(filename, 'wb')
-                self.lastFlushTime = time.time()
-        if self.saveFormat == 'ubx' and self.saveFile is not None:
-            self.logger.debug('Saving {} message of raw length {}'.format(msgFormat, len(rawMessage)))
-            self.saveFile.write(rawMessage)
-            if (time.time() - self.lastFlushTime) > 60:
-                self.saveFile.flush()
-                self.lastFlushTime = time.time()
-
-    def poll(self, ser, msgFormat, length=0, data=[], timeout=0.5, maxRetries=20):
-        retries = 0
-        while retries < maxRetries:        
-            self.pollResult = None
-            self.pollTarget = [msgFormat]
-
-            self.logger.info('Polling for {} (attempt {})'.format(msgFormat, retries+1))
-            self.sendMessage(ser, msgFormat, length, data)
-
-            startTime = time.time()
-            while self.pollResult is None:
-                time.sleep(0.01)
-                if (time.time() - startTime) > timeout:
-                    self.logger.warn('Timeout waiting for response!')
-                    break
-
-            if self.pollResult is not None:
-                return self.pollResult
-
-            retries += 1
-
-        raise Exception('Failed to get response!')
+        # Queued for the writer thread, which also rotates the files and writes the index
+        if self.saveFormat != 'ubx':
+            return
+        if self.saveWriter is None:
+            self.saveWriter = CaptureWriter(self.saveFileName, self.saveInterval, self.saveMaxFileSize, self.saveIndexFlag,
+                                            self.saveFsyncInterval, logger=self.logger, compression=self.saveCompression)
+        self.saveWriter.put(msgTime, msgFormat, msgData, rawMessage)
+
+    def closeSaveFile(self):
+        # Write out everything queued and close the save file and index
+        self.saveWriter.close()
+        self.saveWriter = None
+
+    def requestPoll(self, ser, msgFormat, length=0, data=[], match=None):
+        # Send a poll and return a future for the (msgFormat, msgData) response.
+        # See RequestTable.add for match.
+        future = self.requests.add(pollKey(msgFormat), match)
+        self.sendMessage(ser, msgFormat, length, data)
+        return future
+
+    def requestConfig(self, ser, msgFormat, length, data):
+        # Send a config message and return a future for its ('ACK-ACK' or 'ACK-NACK', msgData)
+        future = self.requests.add(ackKey(msgFormat))
+        self.sendMessage(ser, msgFormat, length, data)
+        return future
+
+    def waitRequest(self, ser, future, key, msgFormat, length, data, timeout=0.5, maxRetries=20):
+        # Wait for the response to a request, resending the message after each timeout.
+        # Returns None if there is no response.
+        try:
+            for retries in range(maxRetries):
+                if retries:
+                    self.logger.info('Resending {} (attempt {})'.format(msgFormat, retries+1))
+                    self.sendMessage(ser, msgFormat, length, data)
+                try:
+                    return future.result(timeout)
+                except concurrent.futures.TimeoutError:
+                    self.logger.warn('Timeout waiting for response to {}!'.format(msgFormat))
+            return None
+        finally:
+            self.requests.remove(key, future)
+
+    def poll(self, ser, msgFormat, length=0, data=[], timeout=0.5, maxRetries=20, match=None):
+        self.logger.info('Polling for {}'.format(msgFormat))
+        future = self.requestPoll(ser, msgFormat, length, data, match)
+        result = self.waitRequest(ser, future, pollKey(msgFormat), msgFormat, length, data, timeout, maxRetries)
+        if result is None:
+            raise Exception('Failed to get response!')
+        return result
 
     def sendConfig(self, ser, msgFormat, length, data, timeout=0.5, maxRetries=20):
-        retries = 0
-        while retries < maxRetries:
-            self.pollResult = None
-            self.pollTarget = ['ACK-ACK', 'ACK-NACK']
-
-            self.logger.info('Sending config message {} (attempt {})'.format(msgFormat, retries+1))
-            self.sendMessage(ser, msgFormat, length, data)
-
-            startTime = time.time()
-            while self.pollResult is None:
-                time.sleep(0.01)
-                if (time.time() - startTime) > timeout:
-                    self.logger.warn('Timeout waiting for ACK')
-                    break
-
-            if self.pollResult is not None:
-                if self.checkAck(self.pollResult[0], self.pollResult[1], msgFormat):
-                    self.logger.info('Config message ACKed by ublox')
-                return
-
-            retries += 1
-
-        raise Exception('Failed to set configuration!')
+        self.logger.info('Sending config message {}'.format(msgFormat))
+        future = self.requestConfig(ser, msgFormat, length, data)
+        result = self.waitRequest(ser, future, ackKey(msgFormat), msgFormat, length, data, timeout, maxRetries)
+        if result is None:
+            raise Exception('Failed to set configuration!')
+        if self.checkAck(result[0], result[1], msgFormat):
+            self.logger.info('Config message ACKed by ublox')
 
     def sendMessage(self, ser, msgFormat, length, data):
         message = UbloxMessage.buildMessage(msgFormat, length, data)
@@ -222,7 +231,8 @@ class UbloxReader(serial.threaded.Protocol):
         if interval not in ['daily', 'hourly', None]:
             raise Exception('Invalid save interval!')
         self.saveInterval = interval
-        self.curInterval = None
+        if self.saveWriter is not None:
+            self.saveWriter.interval = interval
 
 
 
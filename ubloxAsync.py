@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+asyncio transport for u-blox receivers
+
+AsyncUbloxReader is an asyncio.Protocol counterpart to ublox2.UbloxReader.
+poll() and sendConfig() are coroutines that resolve as soon as the response
+(or ACK) is parsed, rather than by sleep polling, and messages() is an async
+iterator of decoded messages. Many receivers can share one event loop.
+"""
+import asyncio
+import logging
+import time
+
+import serial
+
+from ubloxMessage import UbloxMessage, CLIDPAIR_INV
+from frameScanner import FrameScanner
+from ubxDispatch import Dispatcher
+from ubxRequests import RequestTable, pollKey, ackKey
+
+
+class AsyncUbloxReader(asyncio.Protocol):
+    def __init__(self):
+        self.scanner = FrameScanner(maxLength=4096)
+        # Handlers subscribed to message types, called with (msgTime, msgFormat, msgData, rawMessage)
+        self.dispatcher = Dispatcher()
+        self.transport = None
+        # Transport used for writes, if different from the read transport (see openReceiver)
+        self.writeTransport = None
+        self.serial = None
+        # Outstanding polls and config messages
+        self.requests = None
+        # Queues of the running messages() iterators
+        self.queues = set()
+        self.closed = None
+        self.logger = logging
+
+    # Required for asyncio.Protocol
+    def connection_made(self, transport):
+        self.transport = transport
+        self.closed = asyncio.get_event_loop().create_future()
+        self.requests = RequestTable(asyncio.get_event_loop().create_future)
+        self.logger.debug('Connection opened')
+
+    # Required for asyncio.Protocol
+    def data_received(self, data):
+        self.scanner.feed(data)
+        self.parse()
+
+    # Required for asyncio.Protocol
+    def connection_lost(self, exc):
+        if exc:
+            self.logger.error('*** EXCEPTION *** {}'.format(exc))
+        self.logger.debug('Connection closed')
+        self.requests.failAll(ConnectionError('Connection to receiver lost'))
+        for queue in self.queues:
+            # End the iterators, dropping the oldest message of a full queue like messages() does
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        if self.writeTransport is not None:
+            self.writeTransport.close()
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+    def subscribe(self, msgTypes, handler, decode=True):
+        # Call handler(msgTime, msgFormat, msgData, rawMessage) for each message of
+        # msgTypes, see Dispatcher.subscribe
+        self.dispatcher.subscribe(msgTypes, handler, decode)
+
+    def unsubscribe(self, handler, msgTypes=None):
+        self.dispatcher.unsubscribe(handler, msgTypes)
+
+    # Parse buffer looking for messages
+    def parse(self):
+        route = self.dispatcher.route
+        for msgClass, msgId, payload, offset in self.scanner.frames():
+            msgTime = time.time()
+            length = len(payload)
+            msgFormat = CLIDPAIR_INV.get((msgClass, msgId))
+            if msgFormat is None:
+                continue
+            handlers, decodeFrame = route((msgClass, msgId))
+            # Only decode messages that are waited on or subscribed to
+            if not (decodeFrame or self.requests.wants(msgClass, msgId)):
+                if handlers:
+                    rawMessage = bytes(self.scanner.rawFrame(offset, length))
+                    for handler in handlers:
+                        handler(msgTime, msgFormat, None, rawMessage)
+                continue
+            try:
+                msgFormat, msgData = UbloxMessage.decode(msgClass, msgId, length, payload)
+            except ValueError:
+                continue
+            self.handleMessage(msgTime, msgFormat, msgData, bytes(self.scanner.rawFrame(offset, length)), handlers)
+
+    # Handle a received message
+    def handleMessage(self, msgTime, msgFormat, msgData, rawMessage, handlers=()):
+        # Response to a poll or config message
+        if self.requests.pending:
+            self.requests.resolve(msgFormat, msgData)
+
+        for handler in handlers:
+            handler(msgTime, msgFormat, msgData, rawMessage)
+
+    def sendMessage(self, msgFormat, length, data):
+        message = UbloxMessage.buildMessage(msgFormat, length, data)
+        (self.writeTransport or self.transport).write(message)
+
+    async def _request(self, key, msgFormat, length, data, timeout, maxRetries, match=None):
+        # Send a message and wait for the response, resending on timeout. Returns None if there is none.
+        future = self.requests.add(key, match)
+        try:
+            for retries in range(maxRetries):
+                self.logger.info('Sending {} (attempt {})'.format(msgFormat, retries+1))
+                self.sendMessage(msgFormat, length, data)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    self.logger.warning('Timeout waiting for response to {}!'.format(msgFormat))
+            return None
+        finally:
+            self.requests.remove(key, future)
+
+    async def poll(self, msgFormat, length=0, data=[], timeout=0.5, maxRetries=20, match=None):
+        # Returns (msgFormat, msgData) of the response. See RequestTable.add for match.
+        result = await self._request(pollKey(msgFormat), msgFormat, length, data, timeout, maxRetries, match)
+        if result is None:
+            raise Exception('Failed to get response!')
+        return result
+
+    async def sendConfig(self, msgFormat, length, data, timeout=0.5, maxRetries=20):
+        # Returns once the receiver ACKs the message. Raises if it NACKs or never answers.
+        result = await self._request(ackKey(msgFormat), msgFormat, length, data, timeout, maxRetries)
+        if result is None:
+            raise Exception('Failed to set configuration!')
+        if result[0] == 'ACK-NACK':
+            raise Exception('ublox receiver responded with ACK-NACK!')
+        self.logger.info('Config message ACKed by ublox')
+
+    async def messages(self, msgTypes=None, maxQueue=1000):
+        # Async iterator of (msgFormat, msgData) for msgTypes, or all messages if None.
+        # If the consumer falls behind by more than maxQueue messages, the oldest are dropped.
+        # Ends when the connection is closed.
+        queue = asyncio.Queue(maxQueue)
+
+        def handler(msgTime, msgFormat, msgData, rawMessage):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((msgFormat, msgData))
+
+        self.subscribe(msgTypes, handler)
+        self.queues.add(queue)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.queues.discard(queue)
+            self.unsubscribe(handler)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def openReceiver(device, baudRate=115200, protocolFactory=AsyncUbloxReader):
+    # Open a serial port or pty and connect a new protocol to it. pyserial sets up the
+    # port, and the fd is then read and written by asyncio pipe transports.
+    loop = asyncio.get_event_loop()
+    ser = serial.Serial(device, baudRate, timeout=0)
+    transport, protocol = await loop.connect_read_pipe(protocolFactory, ser)
+    protocol.serial = ser
+    protocol.writeTransport, _ = await loop.connect_write_pipe(asyncio.BaseProtocol, ser)
+    return protocol
+
+
+if __name__=='__main__':
+    import argparse
+    import datetime
+    parser = argparse.ArgumentParser(description='Poll MON-VER from one or more receivers on a single event loop')
+    parser.add_argument('--device', '-d', nargs='+', default=['/dev/ttyHS1'], help='Serial port devices, e.g. /dev/ttyO5')
+    parser.add_argument('--baudrate', '-b', type=int, default=115200)
+    parser.add_argument('--loop', '-l', action='store_true', help='Keep sending requests in a loop')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    async def pollDevice(device):
+        ublox = await openReceiver(device, args.baudrate)
+        try:
+            while True:
+                startTime = time.time()
+                msgFormat, msgData = await ublox.poll('MON-VER')
+                header = '[{} {} {:.1f} ms]\n'.format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), device, (time.time() - startTime)*1e3)
+                UbloxMessage.printMessage(msgFormat, msgData, header=header)
+                if not args.loop:
+                    break
+                await asyncio.sleep(0.1)
+        finally:
+            ublox.close()
+
+    async def main():
+        await asyncio.gather(*[pollDevice(device) for device in args.device])
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
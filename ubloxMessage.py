@@ -1,6 +1,9 @@
+import re
 import struct
 import logging
 import datetime
+from frameScanner import findFrame
+from ubxChecksum import fletcher8
 
 SYNC1=0xb5
 SYNC2=0x62
@@ -350,6 +353,12 @@ MSGFMT = {
         ["<I16sII", ["HNDLRINST", "LASTEVENT", "IRQINST", "IRQCALL"]],
     ("MON-EXCEPT", 316) :
         ["<" + ("I" * 79), ["code", "num", "ur0", "ur1", "ur2", "ur3", "ur4", "ur5", "ur6", "ur7", "ur8", "ur9", "ur10", "ur11", "ur12", "usp", "ulr", "fr8", "fr9", "fr10", "fr11", "fr12", "fsp", "flr", "fspsr", "isp", "ilr", "ispsr", "cpsr", "pc", "us0", "us1", "us2", "us3", "us4", "us5", "us6", "us7", "us8", "us9", "us10", "us11", "us12", "us13", "us14", "us15", "res", "is0", "is1", "is2", "is3", "is4", "is5", "is6", "is7", "is8", "is9", "is10", "is11", "is12", "is13", "is14", "is15", "fs0", "fs1", "fs2", "fs3", "fs4", "fs5", "fs6", "fs7", "fs8", "fs9", "fs10", "fs11", "fs12", "fs13", "fs14", "fs15"]],
+    ("MON-IO", None) :
+        [0, "", [], 20, "<IIHHHHBBxx", ["rxBytes", "txBytes", "parityErrs", "framingErrs", "overrunErrs", "breakCond", "rxBusy", "txBusy"]],
+    ("MON-TXBUF", 28) :
+        ["<" + ("H" * 6) + ("B" * 12) + "BBBx", ["pending0", "pending1", "pending2", "pending3", "pending4", "pending5", "usage0", "usage1", "usage2", "usage3", "usage4", "usage5", "peakUsage0", "peakUsage1", "peakUsage2", "peakUsage3", "peakUsage4", "peakUsage5", "tUsage", "tPeakUsage", "errors"]],
+    ("MON-RXBUF", 24) :
+        ["<" + ("H" * 6) + ("B" * 12), ["pending0", "pending1", "pending2", "pending3", "pending4", "pending5", "usage0", "usage1", "usage2", "usage3", "usage4", "usage5", "peakUsage0", "peakUsage1", "peakUsage2", "peakUsage3", "peakUsage4", "peakUsage5"]],
     ("AID-INI", 48) :
         ["<iiiIHHIiIIiII", ["X", "Y", "Z", "POSACC", "TM_CFG", "WN", "TOW", "TOW_NS", "TACC_MS", "TACC_NS", "CLKD", "CLKDACC", "FLAGS"]],
     ("AID-DATA", 0) :
@@ -385,6 +394,9 @@ MSGFMT = {
 # HNR - High Rate Navigation
     ("HNR-PVT", 72) :
         ["<IHBBBBBBiBBxxiiiiiiiiIIIIxxxx", ["ITOW", "Year", "Month", "Day", "Hour", "Min", "Sec", "Valid", "Nano", "GPSFix", "Flags", "LON", "LAT", "HEIGHT", "HMSL", "GSpeed", "Speed", "HeadMot", "HeadVeh", "Hacc", "Vacc", "SAcc", "HeadAcc"]],
+# SEC - Security
+    ("SEC-UNIQID", 9) :
+        ["<Bxxx5s", ["version", "uniqueId"]],
 # MGA - High Rate Navigation
     ("MGA-GPS-EPH", 68) :
         ["<BBBxBBBbHHxbhihhihhIIHhihhiiihxx", ["Type", "Version", "SVID", "FitInterval", "URAIndex", "SvHealth", "TGD", "IODC", "TOC", "AF2", "AF1", "AF0", "CRS", "DeltaN", "M0", "CUC", "CUS", "E", "SqrtA", "TOE", "CIC", "Omega0", "CIS", "CRC", "I0", "Omega", "OmegaDot", "IDot"]],
@@ -400,6 +412,363 @@ MSGFMT = {
 
 MSGFMT_INV = dict( [ [(CLIDPAIR[clid], le),v + [clid]] for (clid, le),v in MSGFMT.items() ] )
 
+# MSGDECODE - Precompiled decoders, built once from MSGFMT at import time.
+# The key is the same as MSGFMT_INV, ((class, id), length), with a length of
+# None for the variable length messages. Each value is a tuple of
+# (name, base size, base struct, base fields, repeated size, repeated struct,
+# repeated fields). The repeated entries are None for fixed length messages.
+def _buildDecoders():
+    decoders = {}
+    for (clid, length), fmt in MSGFMT.items():
+        if length is None:
+            baseSize, baseFmt, baseFields, repSize, repFmt, repFields = fmt
+            decoders[(CLIDPAIR[clid], None)] = (clid, baseSize, struct.Struct(baseFmt), tuple(baseFields),
+                                                repSize, struct.Struct(repFmt), tuple(repFields))
+        else:
+            decoders[(CLIDPAIR[clid], length)] = (clid, length, struct.Struct(fmt[0]), tuple(fmt[1]), None, None, None)
+    return decoders
+
+MSGDECODE = _buildDecoders()
+
+# MSGFIELDS - Field offsets for lazy decoding, with the same keys as MSGDECODE.
+# Each value is a tuple of (name, base size, base fields, repeated size,
+# repeated fields), where the fields are dicts of field name to (offset in the
+# block, struct for the field). The repeated entries are None for fixed length
+# messages.
+_fieldStructs = {}
+
+def _fieldOffsets(fmt, fields):
+    offsets = {}
+    names = iter(fields)
+    offset = 0
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', fmt):
+        count = int(count) if count else 1
+        if code == 'x':
+            offset += count
+            continue
+        if code == 's':
+            code = '{}s'.format(count)
+            count = 1
+        fieldStruct = _fieldStructs.setdefault(code, struct.Struct('<' + code))
+        for i in range(count):
+            offsets[next(names)] = (offset, fieldStruct)
+            offset += fieldStruct.size
+    return offsets
+
+def _buildFieldOffsets():
+    fieldOffsets = {}
+    for key, (clid, baseSize, baseStruct, baseFields, repSize, repStruct, repFields) in MSGDECODE.items():
+        if key[1] is None:
+            baseSize, baseFmt, _, repSize, repFmt, _ = MSGFMT[(clid, None)]
+            fieldOffsets[key] = (clid, baseSize, _fieldOffsets(baseFmt, baseFields), repSize, _fieldOffsets(repFmt, repFields))
+        else:
+            fieldOffsets[key] = (clid, baseSize, _fieldOffsets(MSGFMT[(clid, key[1])][0], baseFields), None, None)
+    return fieldOffsets
+
+MSGFIELDS = _buildFieldOffsets()
+
+
+class LazyBlock(object):
+    # One block (the base or a repeated section) of a lazily decoded message.
+    # Fields are unpacked from the payload when read, by key or attribute.
+    __slots__ = ('_payload', '_offset', '_fields')
+
+    def __init__(self, payload, offset, fields):
+        self._payload = payload
+        self._offset = offset
+        self._fields = fields
+
+    def __getitem__(self, name):
+        offset, fieldStruct = self._fields[name]
+        return fieldStruct.unpack_from(self._payload, self._offset + offset)[0]
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self._fields else default
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return self._fields.keys()
+
+    def items(self):
+        return [(name, self[name]) for name in self._fields]
+
+    def toDict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.toDict())
+
+
+class LazyMessage(object):
+    # Lazily decoded message, indexed like the list of dicts from UbloxMessage.decode:
+    # message[0] is the base block and message[1:] the repeated blocks. Field names
+    # read the base block, e.g. message['ITOW'] or message.ITOW.
+    #
+    # The payload is usually a memoryview into the parser buffer. Call detach()
+    # (or toList()) before keeping a message past the callback, so the buffer
+    # can be released.
+    __slots__ = ('_payload', '_baseSize', '_baseFields', '_repSize', '_repFields', '_count')
+
+    def __init__(self, payload, baseSize, baseFields, repSize=None, repFields=None, count=0):
+        self._payload = payload
+        self._baseSize = baseSize
+        self._baseFields = baseFields
+        self._repSize = repSize
+        self._repFields = repFields
+        self._count = count
+
+    def __len__(self):
+        return self._count + 1
+
+    def block(self, i):
+        if i == 0:
+            return LazyBlock(self._payload, 0, self._baseFields)
+        return LazyBlock(self._payload, self._baseSize + (i-1)*self._repSize, self._repFields)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            offset, fieldStruct = self._baseFields[key]
+            return fieldStruct.unpack_from(self._payload, offset)[0]
+        if isinstance(key, slice):
+            return [self.block(i) for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('message block index out of range')
+        return self.block(key)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.block(i)
+
+    def detach(self):
+        # Copy the payload so the message no longer references the parser buffer
+        self._payload = bytes(self._payload)
+        return self
+
+    def toList(self):
+        # Same as the output of UbloxMessage.decode
+        return [block.toDict() for block in self]
+
+    def __repr__(self):
+        return repr(self.toList())
+
+
+class Record(object):
+    # Compact record for one fixed length message or block, holding only the raw
+    # bytes. The subclasses generated from MSGFMT (see MSGRECORD) have a property
+    # per field, e.g. record.ITOW, and also support record['ITOW'] so code written
+    # for the decoded dicts keeps working. A fixed length record is its own
+    # message, so record[0] returns the record like msgData[0] does for a list.
+    __slots__ = ('_data',)
+    _fields = ()
+    _key = None
+    _part = None
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        if key in (0, -1):
+            return self
+        raise IndexError('message block index out of range')
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self._fields else default
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return [getattr(self, name) for name in self._fields]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self._fields]
+
+    def toDict(self):
+        return dict(self.items())
+
+    def toList(self):
+        # Same as the output of UbloxMessage.decode
+        return [self.toDict()]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._data == other._data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._data)
+
+    def __reduce__(self):
+        return (_loadRecord, (self._key, self._data, self._part))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(name, value) for name, value in self.items()))
+
+
+class BlockRecord(Record):
+    # Record for one repeated block, at an offset into the payload of its message
+    __slots__ = ('_offset',)
+
+    def __init__(self, data, offset):
+        self._data = data
+        self._offset = offset
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __hash__(self):
+        return hash(tuple(self.values()))
+
+    def __reduce__(self):
+        return (_loadRecord, (self._key, self._data, self._offset))
+
+
+class RecordList(object):
+    # Container for a variable length message, indexed like the list of dicts from
+    # UbloxMessage.decode: records[0] is the base record and records[1:] the
+    # repeated block records. Field names read the base block, e.g. records.ITOW.
+    __slots__ = ('_data',)
+    _baseClass = None
+    _blockClass = None
+    _baseSize = 0
+    _repSize = 1
+    _key = None
+
+    def __init__(self, data):
+        self._data = data
+
+    def __len__(self):
+        return (len(self._data) - self._baseSize)//self._repSize + 1
+
+    def block(self, i):
+        if i == 0:
+            return self._baseClass(self._data)
+        return self._blockClass(self._data, self._baseSize + (i-1)*self._repSize)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.block(0)[key]
+        if isinstance(key, slice):
+            return [self.block(i) for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('message block index out of range')
+        return self.block(key)
+
+    def __getattr__(self, name):
+        if name in self._baseClass._fields:
+            return getattr(self.block(0), name)
+        raise AttributeError(name)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.block(i)
+
+    def toList(self):
+        # Same as the output of UbloxMessage.decode
+        return [block.toDict() for block in self]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._data == other._data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._data)
+
+    def __reduce__(self):
+        return (_loadRecord, (self._key, self._data))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, list(self))
+
+
+def _fieldProperty(name, offset, fieldStruct, block):
+    unpack = fieldStruct.unpack_from
+    if block:
+        return property(lambda self: unpack(self._data, self._offset + offset)[0], doc=name)
+    return property(lambda self: unpack(self._data, offset)[0], doc=name)
+
+def _recordClass(className, base, fields, block=False):
+    # Record subclass with a property per field, in message order
+    names = sorted(fields, key=lambda name: fields[name][0])
+    attrs = {'__slots__': (), '_fields': tuple(names)}
+    for name in names:
+        offset, fieldStruct = fields[name]
+        attrs[name] = _fieldProperty(name, offset, fieldStruct, block)
+    return type(className, (base,), attrs)
+
+# MSGRECORD - Record classes generated from MSGFIELDS, with the same keys as
+# MSGDECODE. Each value is a tuple of (name, class), where the class is a
+# Record subclass for fixed length messages and a RecordList subclass, with
+# its base and block record classes, for variable length messages.
+def _buildRecordClasses():
+    recordClasses = {}
+    for key, (clid, baseSize, baseFields, repSize, repFields) in MSGFIELDS.items():
+        className = clid.replace('-', '_')
+        if repFields is None:
+            cls = _recordClass(className, Record, baseFields)
+        else:
+            cls = type(className + '_List', (RecordList,), {
+                '__slots__': (),
+                '_baseClass': _recordClass(className, Record, baseFields),
+                '_blockClass': _recordClass(className + '_Block', BlockRecord, repFields, block=True),
+                '_baseSize': baseSize,
+                '_repSize': repSize})
+            cls._baseClass._key = key
+            cls._baseClass._part = 'base'
+            cls._blockClass._key = key
+        cls._key = key
+        recordClasses[key] = (clid, cls)
+    return recordClasses
+
+MSGRECORD = _buildRecordClasses()
+
+def _loadRecord(key, data, part=None):
+    # Unpickle a record from its MSGRECORD key and raw bytes. part is 'base' for
+    # the base record of a variable length message, or the offset of a block.
+    cls = MSGRECORD[key][1]
+    if part == 'base':
+        return cls._baseClass(data)
+    if part is not None:
+        return cls._blockClass(data, part)
+    return cls(data)
+
 GNSSID = {'GPS': 0,
           'SBAS': 1,
           'Galileo': 2,
@@ -492,32 +861,16 @@ class UbloxMessage(object):
 
     @staticmethod
     def getMessageFromBuffer(buf, start=0):
-        while start < len(buf) - 1:
-            index = buf[start:].find(b'\xb5\x62')
-            if index >= 0:
-                start += index
-                result = UbloxMessage.validate(buf[start:])
-                if result['valid']:
-                    msgClass = result['class']
-                    msgId = result['id']
-                    length = result['length']
-                    rawLength = length + 8
-                    rawMessage = buf[start:start+rawLength]
-                    start += rawLength
-
-                    return rawMessage, msgClass, msgId, length, start
-                else:
-                    # Not enough data
-                    if not result['lengthMatch']:
-                        return None, None, None, None, start
-                    # Invalid message, move past sync bytes and continue search
-                    elif not result['checksum']:
-                        start += 2
-            # No sync bytes found, move start to the last byte
-            else:
-                start = len(buf) - 1
-
-        return None, None, None, None, start
+        start, msgClass, msgId, length = findFrame(buf, start)
+        if msgClass is None:
+            # Not enough data, or no sync bytes found
+            return None, None, None, None, start
+
+        rawLength = length + 8
+        rawMessage = buf[start:start+rawLength]
+        start += rawLength
+
+        return rawMessage, msgClass, msgId, length, start
 
     @staticmethod
     def parse(message, raw=False):
@@ -602,44 +955,98 @@ class UbloxMessage(object):
     @staticmethod
     def getMessageFormat(cl, id, length):
         # This will raise a KeyError if it cannot determine the format
-        try:
-            msgFormat = MSGFMT_INV[((cl, id), length)]
-            fmt_base = None
-            fmt_rep = None
-        except KeyError:
-            # Try if this is one of the variable field messages
-            msgFormat = MSGFMT_INV[((cl, id), None)]
-            fmt_base = msgFormat[:3]
-            fmt_rep = msgFormat[3:]
-            # Check if the length matches
-            if (length - fmt_base[0])%fmt_rep[0] != 0:
-                logging.warning( "Variable length message class 0x%x, id 0x%x \
-                    has wrong length %i" % ( cl, id, length ) )
-                raise ValueError( "Variable length message class 0x%x, id 0x%x \
-                    has wrong length %i" % ( cl, id, length ) )
+        msgFormat = MSGFMT_INV.get(((cl, id), length))
+        if msgFormat is not None:
+            return msgFormat, None, None
+
+        # Try if this is one of the variable field messages
+        msgFormat = MSGFMT_INV[((cl, id), None)]
+        fmt_base = msgFormat[:3]
+        fmt_rep = msgFormat[3:]
+        # Check if the length matches
+        if (length - fmt_base[0])%fmt_rep[0] != 0:
+            logging.warning( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+            raise ValueError( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
 
         return msgFormat, fmt_base, fmt_rep
 
+    @staticmethod
+    def getDecoder(cl, id, length):
+        # Returns the precompiled decoder from MSGDECODE, or None if the format is unknown
+        decoder = MSGDECODE.get(((cl, id), length))
+        if decoder is None:
+            decoder = MSGDECODE.get(((cl, id), None))
+        return decoder
+
     @staticmethod
     def decode(cl, id, length, payload):
-        data = []
+        decoder = UbloxMessage.getDecoder(cl, id, length)
+        if decoder is None:
+            logging.warning( "Don't know how to parse message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+            raise ValueError( "Don't know how to parse message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
 
-        try:
-            msgFormat, fmt_base, fmt_rep = UbloxMessage.getMessageFormat(cl, id, length)
+        msgFormat, baseSize, baseStruct, baseFields, repSize, repStruct, repFields = decoder
 
-            if fmt_base is None:
-                data.append(dict(zip(msgFormat[1], struct.unpack(msgFormat[0], payload))))
-            else:
-                data.append(dict(zip(fmt_base[2], struct.unpack(fmt_base[1], payload[:fmt_base[0]]))))
-                for i in range(0, (length - fmt_base[0])//fmt_rep[0]):
-                    offset = fmt_base[0] + fmt_rep[0] * i
-                    data.append(dict(zip(fmt_rep[2], struct.unpack(fmt_rep[1], payload[offset:offset+fmt_rep[0]]))))
+        if repStruct is None:
+            return msgFormat, [dict(zip(baseFields, baseStruct.unpack_from(payload)))]
 
-        except KeyError:
+        # Variable length message - check if the length matches
+        if length < baseSize or (length - baseSize)%repSize != 0:
+            logging.warning( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+            raise ValueError( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+
+        data = [dict(zip(baseFields, baseStruct.unpack_from(payload)))]
+        # Repeated blocks are unpacked straight from a view of the payload
+        for values in repStruct.iter_unpack(memoryview(payload)[baseSize:length]):
+            data.append(dict(zip(repFields, values)))
+
+        return msgFormat, data
+
+    @staticmethod
+    def decodeLazy(cl, id, length, payload):
+        # Like decode, but returns a LazyMessage that unpacks fields when they are read
+        fields = MSGFIELDS.get(((cl, id), length))
+        if fields is None:
+            fields = MSGFIELDS.get(((cl, id), None))
+        if fields is None:
+            logging.warning( "Don't know how to parse message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+            raise ValueError( "Don't know how to parse message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
+
+        msgFormat, baseSize, baseFields, repSize, repFields = fields
+        if repFields is None:
+            return msgFormat, LazyMessage(payload, baseSize, baseFields)
+
+        if length < baseSize or (length - baseSize)%repSize != 0:
+            logging.warning( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+            raise ValueError( "Variable length message class 0x%x, id 0x%x \
+                has wrong length %i" % ( cl, id, length ) )
+
+        return msgFormat, LazyMessage(payload, baseSize, baseFields, repSize, repFields, (length - baseSize)//repSize)
+
+    @staticmethod
+    def decodeRecord(cl, id, length, payload):
+        # Like decode, but returns a compact record from MSGRECORD holding a copy of the payload
+        record = MSGRECORD.get(((cl, id), length))
+        if record is None:
+            record = MSGRECORD.get(((cl, id), None))
+        if record is None:
             logging.warning( "Don't know how to parse message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
             raise ValueError( "Don't know how to parse message class 0x%x, id 0x%x, length %i" % ( cl, id, length ) )
 
-        return msgFormat[-1], data
+        msgFormat, cls = record
+        if issubclass(cls, RecordList):
+            if length < cls._baseSize or (length - cls._baseSize)%cls._repSize != 0:
+                logging.warning( "Variable length message class 0x%x, id 0x%x \
+                    has wrong length %i" % ( cl, id, length ) )
+                raise ValueError( "Variable length message class 0x%x, id 0x%x \
+                    has wrong length %i" % ( cl, id, length ) )
+
+        return msgFormat, cls(bytes(payload[:length]))
 
     @staticmethod
     def buildMessage(clid, length, payload):
@@ -709,15 +1116,7 @@ class UbloxMessage(object):
 
     @staticmethod
     def checksum(msg):
-        msg = bytearray(msg)
-        ck_a = 0
-        ck_b = 0
-        for i in msg:
-            ck_a = ck_a + i
-            ck_b = ck_b + ck_a
-        ck_a = ck_a % 256
-        ck_b = ck_b % 256
-        return (ck_a, ck_b)
+        return fletcher8(msg)
 
     @staticmethod
     def buildMask(enabledBits, shiftDict):
@@ -785,6 +1184,8 @@ class UbloxMessage(object):
             print('    Hardware version: {}'.format(data[0]['HWVersion'].decode('ascii').strip()))
             for i in range(1, len(data)):
                 print('    Extension: {}'.format(data[i]['Extension'].decode('ascii').strip()))
+        elif messageType == 'SEC-UNIQID':
+            print('    Unique chip ID: {}'.format(data[0]['uniqueId'].hex()))
         elif messageType == 'NAV-PVT':
             print('    ITOW: {}'.format(data[0]['ITOW']))
             seconds = data[0]['Sec'] + data[0]['Nano']/1e9
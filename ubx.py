@@ -8,7 +8,6 @@ Open GPS Daemon - UBX parser class
 (C) 2008 Openmoko, Inc.
 GPLv2
 """
-import struct
 import calendar
 import os
 import gobject
@@ -16,19 +15,35 @@ import logging
 import sys
 import socket
 import time
-from ubloxMessage import UbloxMessage, SYNC1, SYNC2, clearMaskShiftDict, navBbrMaskShiftDict, resetModeDict, powerSetupValueDict, timeRefDict
+import tty
+import ubxBaudRate
+from ubloxMessage import UbloxMessage, CLIDPAIR_INV, SYNC1, SYNC2, clearMaskShiftDict, navBbrMaskShiftDict, resetModeDict, powerSetupValueDict, timeRefDict
+from frameScanner import FrameScanner
+from ubxDispatch import Dispatcher
+from ubxChecksum import fletcher8
 
 class Parser():
-    def __init__(self, callback, rawCallback=None, device="/dev/ttyO5"):
+    def __init__(self, callback=None, rawCallback=None, device="/dev/ttyO5", lazy=False, records=False, checksumUnsubscribed=True):
+        # Called with every message. Use subscribe() instead to only decode the messages needed.
         self.callback = callback
+        # Handlers subscribed to message types
+        self.dispatcher = Dispatcher()
+        # Without a callback, setting this False skips checksumming frames nobody subscribed to.
+        # Faster, but a corrupted header can then hide the frames after it.
+        self.checksumUnsubscribed = checksumUnsubscribed
+        # Pass LazyMessage views to the callback instead of lists of dicts
+        self.lazy = lazy
+        # Pass compact records from MSGRECORD to the callback instead of lists of dicts
+        self.records = records
         self.rawCallback = rawCallback
         self.device = device
         if device:
-            os.system("stty -F %s raw" % device)
             self.fd = os.open(device, os.O_NONBLOCK | os.O_RDWR)
+            tty.setraw(self.fd)
             self.flush()
             gobject.io_add_watch(self.fd, gobject.IO_IN, self.cbDeviceReadable)
-        self.buffer = ""
+        self.scanner = FrameScanner(unframedCallback=self.handleUnframed)
+        self.useRawCallback = False
         self.ack = {"CFG-PRT" : 0}
         self.ubx = {}
 
@@ -40,11 +55,8 @@ class Parser():
         return True
 
     def setBaudRate(self, baudRate):
-        os.close(self.fd)
-        os.system('stty -F {} {} cs8 -cstopb -parenb'.format(self.device, baudRate))
-        self.fd = os.open(self.device, os.O_NONBLOCK | os.O_RDWR)
-        self.flush()
-        # time.sleep(0.1)
+        # Set with termios on the open fd, so the main loop watch stays valid
+        ubxBaudRate.setBaudRate(self.fd, baudRate)
 
     def flush(self, quiet=True):
         try:
@@ -54,65 +66,61 @@ class Parser():
         except:
             pass
 
-    def parse(self, data, useRawCallback=False):
-        self.buffer += data
-        buffer_offset = 0
-        # Minimum packet length is 8
-        while len(self.buffer) >= buffer_offset + 8:
-            # Find the beginning of a UBX message
-            start = self.buffer.find( chr( SYNC1 ) + chr( SYNC2 ), buffer_offset )
-
-            # Could not find message - keep data because there may be a whole or partial NMEA message
-            # Consider limiting max buffer size
-            if start == -1:
-                return True
-
-            # Message shorter than minimum length - return and wait for additional data
-            # Consider limiting max buffer size
-            if start + 8 > len(self.buffer):
-                return True
-
-            # Decode header - message class, id, and length
-            (cl, id, length) = struct.unpack("<BBH", self.buffer[start+2:start+6])
-
-            # Check that there is enough data in the buffer to match the length
-            # If not, return and wait for additional data
-            if len(self.buffer) < start + length + 8:
-                return True
-
-            # Validate checksum  - if fail, skip past the sync
-            if self.checksum(self.buffer[start+2:start+length+6]) != struct.unpack("<BB", self.buffer[start+length+6:start+length+8]):
-                buffer_offset = start + 2
-                continue
+    def subscribe(self, msgTypes, handler, decode=True):
+        # Call handler(msgFormat, msgData) for each message of msgTypes, see Dispatcher.subscribe
+        self.dispatcher.subscribe(msgTypes, handler, decode)
 
-            # At this point, we should have a valid message at the start position
+    def unsubscribe(self, handler, msgTypes=None):
+        self.dispatcher.unsubscribe(handler, msgTypes)
 
-            # Handle data prior to UBX message
-            if start > 0:
-                logging.debug("Discarded data not UBX %s" % repr(self.buffer[:start]) )
-                # Attempt to decode NMEA on discarded data
-                self.decodeNmeaBuffer(self.buffer[:start])
+    def parse(self, data, useRawCallback=False):
+        self.useRawCallback = useRawCallback
+        decode = UbloxMessage.decodeRecord if self.records else UbloxMessage.decodeLazy if self.lazy else UbloxMessage.decode
+        route = self.dispatcher.route
+        if self.checksumUnsubscribed or self.callback is not None:
+            self.scanner.checksumKeys = None
+        else:
+            self.scanner.checksumKeys = self.dispatcher.checksumKeys
+        self.scanner.feed(data)
+        for cl, id, payload, offset in self.scanner.frames():
+            length = len(payload)
+            handlers, decodeFrame = route((cl, id))
 
             if length == 0:
                 logging.warning('Zero length packet of class {}, id {}!'.format(hex(cl), hex(id)))
-            else:
+            elif self.callback is not None or decodeFrame:
                 # Decode UBX message
                 try:
-                    msgFormat, data = UbloxMessage.decode(cl, id, length, self.buffer[start+6:start+length+6])
+                    msgFormat, data = decode(cl, id, length, payload)
                 except ValueError:
                     data = None
                     pass
 
                 if data is not None:
                     logging.debug("Got UBX packet of type %s: %s" % (msgFormat, data))
-                    self.callback(msgFormat, data)
-                
+                    if self.callback is not None:
+                        self.callback(msgFormat, data)
+                    for handler in handlers:
+                        handler(msgFormat, data)
+            elif handlers:
+                # Only subscribers that don't need the payload decoded
+                msgFormat = CLIDPAIR_INV.get((cl, id))
+                if msgFormat is not None:
+                    for handler in handlers:
+                        handler(msgFormat, None)
+
             if useRawCallback and (self.rawCallback is not None):
-                self.rawCallback(self.buffer[:start+length+8])
+                self.rawCallback(bytes(self.scanner.rawFrame(offset, length)))
+        return True
 
-            # Discard packet
-            self.buffer = self.buffer[start+length+8:]
-            buffer_offset = 0
+    def handleUnframed(self, data):
+        # Data prior to a UBX message
+        data = bytes(data)
+        logging.debug("Discarded data not UBX %s" % repr(data) )
+        # Attempt to decode NMEA on discarded data
+        self.decodeNmeaBuffer(data.decode('ascii', 'replace'))
+        if self.useRawCallback and (self.rawCallback is not None):
+            self.rawCallback(data)
 
     def send( self, clid, length, payload ):
         logging.debug("Sending UBX packet of type %s: %s" % ( clid, payload ) )
@@ -125,14 +133,7 @@ class Parser():
         os.write(self.fd, data)
 
     def checksum( self, msg ):
-        ck_a = 0
-        ck_b = 0
-        for i in msg:
-            ck_a = ck_a + ord(i)
-            ck_b = ck_b + ck_a
-        ck_a = ck_a % 256
-        ck_b = ck_b % 256
-        return (ck_a, ck_b)
+        return fletcher8(bytearray(msg))
 
     def seekToNextUbxMessage(self, buf):
         start = buf.find(chr( SYNC1 ) + chr( SYNC2 ))
@@ -148,5 +149,8 @@ class Parser():
 
             start = message.find(',')
 
-            self.callback(message[:start], message)
+            if self.callback is not None:
+                self.callback(message[:start], message)
+            for handler in self.dispatcher.route(message[:start])[0]:
+                handler(message[:start], message)
 
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Columnar (NumPy structured array) extraction of UBX logs
+
+Each message type is decoded into one structured array, with a dtype derived
+from its MSGFMT struct format, instead of a list of dicts per message. The
+repeated sections of variable length messages (e.g. the satellites of NAV-SAT
+or the measurements of RXM-RAWX) go into a child table, NAV-SAT.repeated, with
+a msgIndex column giving the row of the message they belong to.
+
+Every message table also has a lastPvtUtc column, the UTC time (datetime64[ns])
+of the most recent NAV-PVT/HNR-PVT at or before the message, taken from the
+date and time fields whether or not the receiver flagged them valid.
+
+Frames are decoded straight from the memory-mapped file without a per-frame
+Python step. decodeFrames lays a strided (bytes x record size) view over the
+buffer and gathers the records of all frames of a type with one fancy index.
+
+The tables are saved as a .npz file, e.g. by parseToPickle.py --columnar, and
+loaded with loadArrays, which also converts parseToPickle pickle files.
+"""
+import re
+import struct
+import pickle
+import logging
+import numpy as np
+
+from ubloxMessage import MSGFMT, CLIDPAIR
+
+REPEATED_SUFFIX = '.repeated'
+# Messages whose time goes into lastPvtUtc, as for lastPvtDt in parseToPickle
+PVT_MESSAGES = ['NAV-PVT', 'HNR-PVT']
+
+# struct format characters to NumPy types. Multi-byte UBX fields are little endian.
+STRUCT_DTYPES = {'c': 'S1', 'b': 'i1', 'B': 'u1', '?': '?', 'h': '<i2', 'H': '<u2',
+                 'i': '<i4', 'I': '<u4', 'l': '<i4', 'L': '<u4', 'q': '<i8', 'Q': '<u8',
+                 'e': '<f2', 'f': '<f4', 'd': '<f8'}
+
+
+def structDtype(fmt, fields):
+    # Structured dtype matching a struct format. Pad bytes are left out of the
+    # fields but kept in the offsets and itemsize, so the dtype can be laid
+    # directly over the payload bytes.
+    names = []
+    formats = []
+    offsets = []
+    fieldNames = iter(fields)
+    offset = 0
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', fmt):
+        count = int(count) if count else 1
+        if code == 'x':
+            offset += count
+        elif code == 's':
+            names.append(next(fieldNames))
+            formats.append('S{}'.format(count))
+            offsets.append(offset)
+            offset += count
+        else:
+            for _ in range(count):
+                names.append(next(fieldNames))
+                formats.append(STRUCT_DTYPES[code])
+                offsets.append(offset)
+                offset += np.dtype(STRUCT_DTYPES[code]).itemsize
+
+    if offset != struct.calcsize(fmt) or len(names) != len(fields):
+        raise ValueError('Unable to convert struct format {} with fields {}'.format(fmt, fields))
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': offset})
+
+
+def _buildDtypes():
+    # MSGDTYPE has the same keys as MSGDECODE, ((class, id), length). Each value
+    # is (name, base dtype, repeated dtype), with a repeated dtype of None for
+    # fixed length messages.
+    dtypes = {}
+    for (clid, length), fmt in MSGFMT.items():
+        if length is None:
+            baseSize, baseFmt, baseFields, repSize, repFmt, repFields = fmt
+            dtypes[(CLIDPAIR[clid], None)] = (clid, structDtype(baseFmt, baseFields), structDtype(repFmt, repFields))
+        else:
+            dtypes[(CLIDPAIR[clid], length)] = (clid, structDtype(fmt[0], fmt[1]), None)
+    return dtypes
+
+MSGDTYPE = _buildDtypes()
+
+# Message names with more than one MSGFMT entry get the length in their table name
+_LENGTHS = {}
+for _clid, _length in MSGFMT:
+    _LENGTHS.setdefault(_clid, []).append(_length)
+
+
+def tableName(msgFormat, length):
+    if len(_LENGTHS[msgFormat]) == 1:
+        return msgFormat
+    return '{}.{}'.format(msgFormat, 'var' if length is None else length)
+
+
+def packedDtype(dtype, extra=()):
+    # dtype without the pad bytes, after the (name, type) pairs in extra
+    return np.dtype(list(extra) + [(name, dtype.fields[name][0]) for name in dtype.names])
+
+
+def utcTimes(records):
+    # datetime64[ns] times from the Year ... Sec and Nano fields of NAV-PVT, HNR-PVT or NAV-TIMEUTC records
+    months = (records['Year'].astype(np.int64) - 1970).astype('M8[Y]').astype('M8[M]')
+    days = (months + (records['Month'].astype(np.int64) - 1).astype('m8[M]')).astype('M8[D]')
+    days = days + (records['Day'].astype(np.int64) - 1).astype('m8[D]')
+    seconds = (records['Hour'].astype(np.int64) * 60 + records['Min']) * 60 + records['Sec']
+    return days.astype('M8[ns]') + seconds.astype('m8[s]') + records['Nano'].astype(np.int64).astype('m8[ns]')
+
+
+def decodeFrames(buf, offsets, dtype):
+    # Records of dtype at each of the buffer offsets, gathered in one fancy
+    # indexing pass over a (len(buf), itemsize) strided view of the buffer
+    data = np.frombuffer(buf, dtype=np.uint8)
+    rows = np.lib.stride_tricks.as_strided(data, shape=(max(len(data) - dtype.itemsize + 1, 0), dtype.itemsize),
+                                           strides=(1, 1), writeable=False)
+    return rows[np.asarray(offsets, dtype=np.int64)].view(dtype).reshape(-1)
+
+
+def decodeFixed(ubxFile, frameNumbers, dtype):
+    # Raw records (dtype with pad bytes) of fixed length frames
+    return ubxFile.rawRecords(ubxFile.index['offset'][frameNumbers] + 6, dtype)
+
+
+def decodeVariable(ubxFile, frameNumbers, baseDtype, repDtype):
+    # Raw base records, repeated records, and the number of repeated records of each frame
+    payloads = ubxFile.index['offset'][frameNumbers] + 6
+    lengths = ubxFile.index['length'][frameNumbers].astype(np.int64)
+    counts = (lengths - baseDtype.itemsize) // repDtype.itemsize
+    base = ubxFile.rawRecords(payloads, baseDtype) if baseDtype.itemsize else None
+
+    # Offset of each repeated record - the frame's first record plus its position within the frame
+    firsts = np.cumsum(counts) - counts
+    positions = np.arange(int(counts.sum()), dtype=np.int64) - np.repeat(firsts, counts)
+    offsets = np.repeat(payloads + baseDtype.itemsize, counts) + positions * repDtype.itemsize
+    repeated = ubxFile.rawRecords(offsets, repDtype)
+    return base, repeated, counts
+
+
+def _table(records, dtype, extra):
+    # Copy raw records into a packed table with the extra columns filled in
+    extra = list(extra.items())
+    table = np.zeros(len(extra[0][1]), dtype=packedDtype(dtype, [(name, values.dtype) for name, values in extra]))
+    for name, values in extra:
+        table[name] = values
+    if records is not None:
+        for name in dtype.names:
+            table[name] = records[name]
+    return table
+
+
+def pvtTimes(ubxFile, validOnly=True):
+    # Frame numbers and UTC times of the NAV-PVT/HNR-PVT epochs, in file order
+    epochFrames = []
+    epochTimes = []
+    for msgFormat in PVT_MESSAGES:
+        _, dtype, _ = MSGDTYPE[(CLIDPAIR[msgFormat], _LENGTHS[msgFormat][0])]
+        frameNumbers = ubxFile.frameNumbers([msgFormat], validOnly)
+        frameNumbers = frameNumbers[ubxFile.index['length'][frameNumbers] == dtype.itemsize]
+        epochFrames.append(frameNumbers)
+        epochTimes.append(utcTimes(decodeFixed(ubxFile, frameNumbers, dtype)))
+    epochFrames = np.concatenate(epochFrames)
+    order = np.argsort(epochFrames, kind='stable')
+    return epochFrames[order], np.concatenate(epochTimes)[order]
+
+
+def extractArrays(ubxFile, msgFormats=None, validOnly=True):
+    # Decode the frames of an UbxFile into a dict of table name to structured array.
+    # Frames of unknown types, or with a length that matches no format, are skipped.
+    index = ubxFile.index
+
+    epochFrames, epochTimes = pvtTimes(ubxFile, validOnly)
+
+    def lastPvtUtc(frameNumbers):
+        last = np.searchsorted(epochFrames, frameNumbers, side='right') - 1
+        times = np.full(len(frameNumbers), np.datetime64('NaT'), dtype='M8[ns]')
+        times[last >= 0] = epochTimes[last[last >= 0]]
+        return times
+
+    frameNumbers = ubxFile.frameNumbers(msgFormats, validOnly)
+    keys = (index['msgClass'][frameNumbers].astype(np.uint16) << 8) | index['msgId'][frameNumbers]
+    lengths = index['length'][frameNumbers].astype(np.int64)
+
+    tables = {}
+    for key in np.unique(keys).tolist():
+        clid = (key >> 8, key & 0xff)
+        remaining = keys == key
+
+        # Fixed lengths first, as UbloxMessage.getDecoder does
+        formats = [(length, dtypes) for (c, length), dtypes in MSGDTYPE.items() if c == clid]
+        formats.sort(key=lambda item: item[0] is None)
+        for length, (msgFormat, baseDtype, repDtype) in formats:
+            if length is not None:
+                selected = remaining & (lengths == length)
+            else:
+                selected = remaining & (lengths >= baseDtype.itemsize) & ((lengths - baseDtype.itemsize) % repDtype.itemsize == 0)
+            remaining &= ~selected
+            typeFrames = frameNumbers[selected]
+            if not len(typeFrames):
+                continue
+
+            name = tableName(msgFormat, length)
+            if repDtype is None:
+                records = decodeFixed(ubxFile, typeFrames, baseDtype)
+                tables[name] = _table(records, baseDtype, {'lastPvtUtc': lastPvtUtc(typeFrames)})
+            else:
+                base, repeated, counts = decodeVariable(ubxFile, typeFrames, baseDtype, repDtype)
+                tables[name] = _table(base, baseDtype, {'lastPvtUtc': lastPvtUtc(typeFrames)})
+                msgIndex = np.repeat(np.arange(len(typeFrames), dtype=np.uint32), counts)
+                tables[name + REPEATED_SUFFIX] = _table(repeated, repDtype, {'msgIndex': msgIndex})
+
+        if remaining.any():
+            logging.warning('Skipped {} frames of class 0x{:02x}, id 0x{:02x} with an unknown format'.format(int(remaining.sum()), clid[0], clid[1]))
+
+    return tables
+
+
+def arraysFromPackets(data):
+    # Convert parseToPickle output (message name to list of decoded messages) to tables
+    tables = {}
+    for msgFormat, packets in data.items():
+        if msgFormat not in _LENGTHS or not len(packets):
+            continue
+        baseFields = set(packets[0][0]) - {'lastPvtDt'}
+        for length in _LENGTHS[msgFormat]:
+            _, baseDtype, repDtype = MSGDTYPE[(CLIDPAIR[msgFormat], length)]
+            if set(baseDtype.names) == baseFields:
+                break
+        else:
+            logging.warning('No format for {} with fields {}'.format(msgFormat, sorted(baseFields)))
+            continue
+
+        name = tableName(msgFormat, length)
+        lastPvtDt = [packet[0].get('lastPvtDt') for packet in packets]
+        lastPvtUtc = np.array([np.datetime64('NaT') if dt is None else np.datetime64(dt) for dt in lastPvtDt], dtype='M8[ns]')
+        table = np.zeros(len(packets), dtype=packedDtype(baseDtype, [('lastPvtUtc', 'M8[ns]')]))
+        table['lastPvtUtc'] = lastPvtUtc
+        for field in baseDtype.names:
+            table[field] = [packet[0][field] for packet in packets]
+        tables[name] = table
+
+        if repDtype is not None:
+            counts = [len(packet) - 1 for packet in packets]
+            repeated = np.zeros(sum(counts), dtype=packedDtype(repDtype, [('msgIndex', 'u4')]))
+            repeated['msgIndex'] = np.repeat(np.arange(len(packets), dtype=np.uint32), counts)
+            for field in repDtype.names:
+                repeated[field] = [rep[field] for packet in packets for rep in packet[1:]]
+            tables[name + REPEATED_SUFFIX] = repeated
+
+    return tables
+
+
+def saveArrays(path, tables):
+    np.savez(path, **tables)
+
+
+def loadArrays(path):
+    # Tables from a .npz file written by saveArrays, or converted from a parseToPickle pickle file
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return dict((key, f[key]) for key in f.files)
+    with open(path, 'rb') as f:
+        return arraysFromPackets(pickle.load(f, encoding='latin1'))
+
+
+def repeatedSlices(repeated, numMessages):
+    # Start and end rows in a child table of each message's repeated records
+    starts = np.searchsorted(repeated['msgIndex'], np.arange(numMessages), side='left')
+    ends = np.searchsorted(repeated['msgIndex'], np.arange(numMessages), side='right')
+    return starts, ends
+
+
+if __name__=='__main__':
+    import argparse
+    import os
+    from ubxFile import UbxFile
+    parser = argparse.ArgumentParser(description='Extract UBX messages to NumPy structured arrays')
+    parser.add_argument('input', help='UBX file')
+    parser.add_argument('--output', '-o', default=None, help='Output .npz file')
+    parser.add_argument('--messages', '-m', nargs='+', default=None, help='Message types to extract, e.g. NAV-PVT NAV-SAT')
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = os.path.splitext(args.input)[0] + '.npz'
+
+    with UbxFile(args.input) as ubxFile:
+        tables = extractArrays(ubxFile, args.messages)
+
+    for name in sorted(tables):
+        print('{}: {}'.format(name, len(tables[name])))
+    saveArrays(args.output, tables)
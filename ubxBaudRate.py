@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Baud rate detection and negotiation for u-blox UART links
+
+The port is set up with termios on the open file descriptor, so changing
+rate needs no stty subprocess and no reopen. BaudRateManager.detect polls
+the receiver's port config at each rate while sniffing the input for valid
+UBX frames and NMEA sentences, so a receiver that is already streaming is
+found without waiting for the poll response. BaudRateManager.negotiate then
+moves the link to the highest rate that passes a throughput test.
+"""
+import os
+import re
+import time
+import tty
+import select
+import termios
+import logging
+import functools
+
+from ubloxMessage import UbloxMessage, CLIDPAIR_INV
+from frameScanner import FrameScanner
+
+BAUD_RATES = [9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600]
+# Order to try the rates when detecting - the u-blox default and the rates the scripts here use first
+DETECT_ORDER = [9600, 115200, 921600, 460800, 230400, 57600, 38400, 19200]
+# Valid UBX frames or NMEA sentences needed to accept a rate without a poll response
+SNIFF_MESSAGES = 2
+# Number of MON-VER polls in the throughput test
+TEST_POLLS = 20
+# Ports that have a baud rate
+UART_PORTS = (1, 2)
+
+NMEA_SENTENCE = re.compile(rb'\$([A-Z]{2}[A-Z0-9]{1,4},[ -~]*?)\*([0-9A-F]{2})\r\n')
+
+
+def setBaudRate(fd, baudRate):
+    # Raw 8N1 at baudRate. Anything buffered at the old rate is discarded.
+    tty.setraw(fd)
+    attrs = termios.tcgetattr(fd)
+    attrs[2] &= ~(termios.CSIZE | termios.CSTOPB | termios.PARENB | getattr(termios, 'CRTSCTS', 0))
+    attrs[2] |= termios.CS8 | termios.CLOCAL | termios.CREAD
+    attrs[4] = attrs[5] = getattr(termios, 'B{}'.format(baudRate))
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    termios.tcflush(fd, termios.TCIOFLUSH)
+
+def getBaudRate(fd):
+    speed = termios.tcgetattr(fd)[5]
+    for baudRate in BAUD_RATES:
+        if getattr(termios, 'B{}'.format(baudRate)) == speed:
+            return baudRate
+    return None
+
+def countNmea(data):
+    # Number of NMEA sentences with a valid checksum
+    count = 0
+    for match in NMEA_SENTENCE.finditer(data):
+        if functools.reduce(lambda a, b: a ^ b, match.group(1), 0) == int(match.group(2), 16):
+            count += 1
+    return count
+
+def transferTime(numBytes, baudRate):
+    # Seconds to send numBytes at 10 bits per byte
+    return numBytes*10.0/baudRate
+
+
+class BaudRateManager(object):
+    def __init__(self, fd):
+        # A file descriptor opened with O_NONBLOCK, e.g. os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        self.fd = fd
+        self.baudRate = getBaudRate(fd)
+        # CFG-PRT of the port the receiver is connected through, from the last detect
+        self.portConfig = None
+
+    def setHostRate(self, baudRate):
+        logging.info('Setting host baud rate to {}...'.format(baudRate))
+        setBaudRate(self.fd, baudRate)
+        self.baudRate = baudRate
+
+    def send(self, msgFormat, length, data):
+        os.write(self.fd, UbloxMessage.buildMessage(msgFormat, length, data))
+
+    def exchange(self, messages, timeout, wanted=None, count=1):
+        # Send messages (a list of (msgFormat, length, data)) and read until count frames of
+        # the wanted type arrive or timeout. Returns (frames, nmea, bytes read), where frames
+        # is the list of (msgFormat, msgData) of the valid UBX frames.
+        scanner = FrameScanner(maxLength=4096)
+        frames = []
+        nmea = 0
+        unframed = bytearray()
+        scanner.unframedCallback = unframed.extend
+        total = 0
+        for msgFormat, length, data in messages:
+            self.send(msgFormat, length, data)
+        endTime = time.time() + timeout
+        while True:
+            remaining = endTime - time.time()
+            if remaining <= 0:
+                break
+            if not select.select([self.fd], [], [], remaining)[0]:
+                continue
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                continue
+            total += len(data)
+            scanner.feed(data)
+            for msgClass, msgId, payload, offset in scanner.frames():
+                msgFormat = CLIDPAIR_INV.get((msgClass, msgId))
+                if msgFormat is None:
+                    continue
+                try:
+                    frames.append(UbloxMessage.decode(msgClass, msgId, len(payload), payload))
+                except ValueError:
+                    frames.append((msgFormat, None))
+            # NMEA between frames, and whatever follows the last one
+            nmea += countNmea(bytes(unframed))
+            del unframed[:unframed.rfind(b'\n') + 1]
+            if wanted is not None and sum(msgFormat == wanted for msgFormat, _ in frames) >= count:
+                break
+        return frames, nmea, total
+
+    def probe(self, baudRate, timeout=None):
+        # Whether the receiver talks at baudRate. Polls the current port config, and accepts
+        # the rate as soon as the poll is answered or SNIFF_MESSAGES valid messages are seen.
+        self.setHostRate(baudRate)
+        # Long enough for a CFG-PRT response queued behind some periodic output at this rate
+        timeout = timeout if timeout is not None else 0.1 + transferTime(256, baudRate)
+        frames, nmea, total = self.exchange([('CFG-PRT', 0, [])], timeout, wanted='CFG-PRT')
+        for msgFormat, msgData in frames:
+            if msgFormat == 'CFG-PRT' and msgData is not None and len(msgData) > 1:
+                self.portConfig = msgData
+                return True
+        if len(frames) + nmea >= SNIFF_MESSAGES:
+            logging.info('{} UBX and {} NMEA messages seen at {} baud'.format(len(frames), nmea, baudRate))
+            return True
+        logging.info('No valid data at {} baud ({} bytes)'.format(baudRate, total))
+        return False
+
+    def detect(self, rates=DETECT_ORDER):
+        # Find the receiver's baud rate, trying the current host rate first. Returns it, or None.
+        rates = list(rates)
+        if self.baudRate in rates:
+            rates.remove(self.baudRate)
+            rates.insert(0, self.baudRate)
+        self.portConfig = None
+        for baudRate in rates:
+            if self.probe(baudRate):
+                logging.info('Receiver found at {} baud'.format(baudRate))
+                if self.portConfig is None:
+                    self.pollPort()
+                return baudRate
+        return None
+
+    def pollPort(self):
+        # Poll the current port config again, e.g. when the receiver was found by sniffing
+        # and the poll answer was lost in its output
+        frames, _, _ = self.exchange([('CFG-PRT', 0, [])], 0.2 + transferTime(4096, self.baudRate), wanted='CFG-PRT')
+        self.portConfig = next((msgData for msgFormat, msgData in frames if msgFormat == 'CFG-PRT' and msgData and len(msgData) > 1), None)
+        return self.portConfig
+
+    def test(self, polls=TEST_POLLS):
+        # Throughput/error test at the current rate - every one of a burst of MON-VER polls must
+        # be answered with a valid frame. Returns (passed, seconds).
+        startTime = time.time()
+        frames, _, total = self.exchange([('MON-VER', 0, [])]*polls, 0.2 + transferTime(polls*200, self.baudRate),
+                                         wanted='MON-VER', count=polls)
+        elapsed = time.time() - startTime
+        answers = [msgData for msgFormat, msgData in frames if msgFormat == 'MON-VER']
+        passed = len(answers) == polls and all(msgData == answers[0] for msgData in answers)
+        logging.info('{} baud test: {}/{} polls answered, {} bytes in {:.3f} s'.format(self.baudRate, len(answers), polls, total, elapsed))
+        return passed, elapsed
+
+    def setReceiverRate(self, baudRate):
+        # Switch the receiver and host to baudRate. Returns whether the receiver answers at the new rate.
+        if self.portConfig is None or self.portConfig[1]['PortID'] not in UART_PORTS:
+            raise ValueError('The receiver is not connected through a UART')
+        if self.portConfig[1]['Baudrate'] == baudRate and self.baudRate == baudRate:
+            return True
+        oldRate = self.baudRate
+        portConfig = [dict(block) for block in self.portConfig]
+        portConfig[1]['Baudrate'] = baudRate
+        logging.info('Switching the receiver to {} baud...'.format(baudRate))
+        # The ACK comes at either rate, so it is not waited for
+        self.send('CFG-PRT', 20, portConfig)
+        termios.tcdrain(self.fd)
+        # Give the receiver time to switch
+        time.sleep(0.05 + transferTime(100, oldRate))
+        self.portConfig = None
+        if self.probe(baudRate) and (self.portConfig or self.pollPort()) and self.portConfig[1]['Baudrate'] == baudRate:
+            return True
+        logging.info('No answer at {} baud'.format(baudRate))
+        return False
+
+    def negotiate(self, rates=BAUD_RATES, polls=TEST_POLLS):
+        # Move the link to the highest of rates that passes test(). Returns the rate.
+        if self.detect() is None:
+            raise Exception('No receiver found at any baud rate!')
+        if self.portConfig is None or self.portConfig[1]['PortID'] not in UART_PORTS:
+            logging.info('The receiver is not connected through a UART, leaving the rate at {}'.format(self.baudRate))
+            return self.baudRate
+        for baudRate in sorted(rates, reverse=True):
+            if baudRate < self.baudRate and self.test(polls)[0]:
+                # The current rate is faster and works
+                break
+            if self.setReceiverRate(baudRate) and self.test(polls)[0]:
+                break
+            # Find the receiver again, it may have switched even if it did not answer
+            if self.detect() is None:
+                raise Exception('Lost the receiver while switching to {} baud!'.format(baudRate))
+        logging.info('Link running at {} baud'.format(self.baudRate))
+        return self.baudRate
+
+
+def openPort(device):
+    return os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Detect the baud rate of a receiver and optionally move it to another rate')
+    parser.add_argument('baudRate', nargs='?', help='Rate to set, or "auto" for the highest rate that passes a throughput test. Only detects if not given.')
+    parser.add_argument('--device', '-d', default='/dev/ttyHS1', help='Specify the serial port device to communicate with. e.g. /dev/ttyO5')
+    parser.add_argument('--max-rate', '-m', type=int, default=BAUD_RATES[-1], help='Highest rate to try with auto')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    fd = openPort(args.device)
+    try:
+        manager = BaudRateManager(fd)
+        startTime = time.time()
+        if args.baudRate is None:
+            baudRate = manager.detect()
+            if baudRate is None:
+                print('No receiver found')
+                raise SystemExit(1)
+        elif args.baudRate == 'auto':
+            baudRate = manager.negotiate([rate for rate in BAUD_RATES if rate <= args.max_rate])
+        else:
+            if manager.detect() is None:
+                print('No receiver found')
+                raise SystemExit(1)
+            baudRate = int(args.baudRate)
+            if baudRate not in BAUD_RATES:
+                parser.error('Baud rate must be one of {}'.format(BAUD_RATES))
+            if not manager.setReceiverRate(baudRate):
+                print('Failed to set the baud rate!')
+                raise SystemExit(1)
+        print('{} baud ({:.2f} s)'.format(baudRate, time.time() - startTime))
+    finally:
+        os.close(fd)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+UBX checksum (8-bit Fletcher) backends
+
+fletcher8Reference is the original per-byte loop and is kept as the reference
+implementation. fletcher8 does the same sums at C speed, with sum() and
+itertools.accumulate for short messages and a NumPy dot product for long
+ones. validateFrames checks many frames of one buffer in a single call using
+NumPy, falling back to fletcher8 if NumPy is not installed.
+"""
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Messages at least this long are checksummed with NumPy when it is available
+NUMPY_MIN_LENGTH = 160
+
+# Frames are validated in windows of at most this many bytes to bound memory use
+VALIDATE_CHUNK_SIZE = 1 << 24
+
+# Byte weights for ck_b, ending in 1 for the last byte. Covers the largest UBX frame.
+_weights = np.arange(65536 + 8, 0, -1, dtype=np.int64) if np is not None else None
+
+
+def fletcher8Reference(msg):
+    msg = bytearray(msg)
+    ck_a = 0
+    ck_b = 0
+    for i in msg:
+        ck_a = ck_a + i
+        ck_b = ck_b + ck_a
+    ck_a = ck_a % 256
+    ck_b = ck_b % 256
+    return (ck_a, ck_b)
+
+
+def fletcher8(msg, start=0, end=None):
+    # Checksum of msg[start:end]. ck_a is the sum of the bytes and ck_b is the sum of the
+    # running ck_a values, i.e. each byte weighted by its distance from the end of the message.
+    # With NumPy, long messages are read in place, so a frame in a larger buffer (e.g. a
+    # bytearray or mmap) is checksummed without copying it.
+    if end is None:
+        end = len(msg)
+    length = end - start
+    if np is not None and NUMPY_MIN_LENGTH <= length <= len(_weights):
+        data = np.frombuffer(msg, dtype=np.uint8, count=length, offset=start)
+        return (int(data.sum()) & 0xff, int(np.dot(data, _weights[-length:])) & 0xff)
+    if start or end != len(msg):
+        # Copying a short message is cheaper than iterating a memoryview of it
+        msg = msg[start:end]
+    return (sum(msg) & 0xff, sum(itertools.accumulate(msg)) & 0xff)
+
+
+def _windowChecksums(window, starts, ends):
+    # Checksums of window[starts[k]:ends[k]] for all k. All sums are only needed
+    # modulo 256, so the prefix sums are kept as wrapping uint8.
+    #   P[k] = sum(window[:k])
+    #   Q[k] = sum(P[1:k+1])
+    #   ck_a = P[e] - P[s]
+    #   ck_b = Q[e] - Q[s] - (e - s) * P[s]
+    prefix = np.zeros(len(window) + 1, dtype=np.uint8)
+    np.cumsum(window, dtype=np.uint8, out=prefix[1:])
+    prefix2 = np.zeros(len(window) + 1, dtype=np.uint8)
+    np.cumsum(prefix[1:], dtype=np.uint8, out=prefix2[1:])
+
+    ckA = prefix[ends] - prefix[starts]
+    ckB = (prefix2[ends].astype(np.int64) - prefix2[starts] - (ends - starts) * prefix[starts].astype(np.int64)) & 0xff
+    return ckA, ckB.astype(np.uint8)
+
+
+def frameChecksums(buf, offsets, lengths, chunkSize=VALIDATE_CHUNK_SIZE):
+    # Computed (ck_a, ck_b) arrays for the frames starting (at the sync) at offsets
+    # with the given payload lengths. Offsets must be increasing.
+    data = np.frombuffer(buf, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = offsets + lengths + 8
+
+    ckA = np.zeros(len(offsets), dtype=np.uint8)
+    ckB = np.zeros(len(offsets), dtype=np.uint8)
+    i = 0
+    while i < len(offsets):
+        base = offsets[i]
+        j = max(i + 1, int(np.searchsorted(ends, base + chunkSize, side='right')))
+        window = data[base:ends[j-1]]
+        rel = offsets[i:j] - base
+        ckA[i:j], ckB[i:j] = _windowChecksums(window, rel + 2, rel + lengths[i:j] + 6)
+        i = j
+
+    return ckA, ckB
+
+
+def validateFrames(buf, offsets, lengths, chunkSize=VALIDATE_CHUNK_SIZE):
+    # Returns a bool array (or list without NumPy) that is True where the frame
+    # checksum matches
+    if np is None:
+        result = []
+        for offset, length in zip(offsets, lengths):
+            end = offset + length + 6
+            result.append(fletcher8(buf, offset+2, end) == (buf[end], buf[end+1]))
+        return result
+
+    data = np.frombuffer(buf, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(offsets) == 0:
+        return np.zeros(0, dtype=bool)
+    ckA, ckB = frameChecksums(buf, offsets, lengths, chunkSize)
+    end = offsets + lengths + 6
+    return (ckA == data[end]) & (ckB == data[end+1])
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+Seekable compressed UBX captures (.ubz)
+
+A .ubz file holds a UBX capture as a series of independently compressed
+blocks (zlib or lzma), each cut at a frame boundary and holding about
+blockSize bytes of the capture. Every block header records where the block
+sits in the uncompressed capture and the UTC time range of the epochs
+(NAV-PVT/HNR-PVT/NAV-TIMEUTC) it covers, and the headers are copied into a
+block index at the end of the file. A reader can then decompress only the blocks covering a time range.
+
+The file layout is
+
+    header      'UBXZ', version, codec
+    block       BLOCK_HEADER, compressed data
+    ...
+    index       INDEX_RECORD per block
+    trailer     index offset, number of blocks, 'UBZI'
+
+A file without the index and trailer (e.g. a capture that is still being
+written, or whose writer died) is read by walking the block headers.
+
+UbzFile opens a .ubz file like ubxFile.UbxFile, so the readers of UbxFile work
+on either. A BlockBuffer over the selected blocks takes the place of the memory
+map, so frame offsets are into their decompressed data. It decompresses blocks
+on demand and keeps only a few in memory, so a capture of any size can be read.
+openCapture() opens either kind by extension, optionally limited to a time range.
+"""
+import os
+import zlib
+import lzma
+import time
+import bisect
+import struct
+import logging
+import collections
+import numpy as np
+
+from ubxFile import UbxFile, buildFrameIndex, toUtcNanoseconds
+from ubxIndex import epochTime, NO_UTC, EPOCH_MESSAGES, EPOCH_CLIDS
+from ubloxMessage import CLIDPAIR_INV
+from ubxArrays import decodeFrames
+from gpsTimestamps import GPSMinusUTC
+
+UBZ_EXTENSION = '.ubz'
+UBZ_MAGIC = b'UBXZ'
+UBZ_VERSION = 1
+FILE_HEADER = struct.Struct('<4sBB')
+# magic, compressed size, size, offset in the capture, first and last epoch UTC, CRC-32 of the data
+BLOCK_MAGIC = b'UBZB'
+BLOCK_HEADER = struct.Struct('<4sIIQqqI')
+# Offset of the block header in the file, then as BLOCK_HEADER
+INDEX_RECORD = struct.Struct('<QIIQqqI')
+INDEX_MAGIC = b'UBZI'
+TRAILER = struct.Struct('<QI4s')
+
+BLOCK_DTYPE = np.dtype([('fileOffset', '<u8'), ('compressedSize', '<u4'), ('size', '<u4'), ('offset', '<u8'),
+                        ('firstUtc', '<i8'), ('lastUtc', '<i8'), ('crc32', '<u4')])
+assert BLOCK_DTYPE.itemsize == INDEX_RECORD.size
+
+CODECS = {'zlib': 1, 'lzma': 2}
+CODECS_INV = dict((value, key) for key, value in CODECS.items())
+DEFAULT_CODEC = 'zlib'
+DEFAULT_BLOCK_SIZE = 1 << 20
+# During capture a block is also finished after this many seconds, to bound the data lost in a crash
+DEFAULT_BLOCK_AGE = 60
+# Decompressed blocks kept in memory by a reader
+DEFAULT_CACHE_BLOCKS = 8
+
+
+def compressBlock(codec, data, level=None):
+    if codec == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    return lzma.compress(data, preset=6 if level is None else level)
+
+def decompressBlock(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    return lzma.decompress(data)
+
+
+class UbzWriter(object):
+    def __init__(self, path, codec=DEFAULT_CODEC, blockSize=DEFAULT_BLOCK_SIZE, level=None, maxBlockAge=None):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec {}, must be one of {}'.format(codec, sorted(CODECS)))
+        self.path = path
+        self.codec = codec
+        self.blockSize = blockSize
+        self.level = level
+        # Seconds before a partial block is written, None to wait for blockSize
+        self.maxBlockAge = maxBlockAge
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(UBZ_MAGIC, UBZ_VERSION, CODECS[codec]))
+        self.blocks = []
+        # Data of the block being filled, and its offset in the capture
+        self.pending = []
+        self.pendingSize = 0
+        self.blockOffset = 0
+        self.blockStartTime = None
+        # (offset, UTC) of the epochs not yet in a block, and the last valid UTC before them
+        self.epochs = collections.deque()
+        self.utc = NO_UTC
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def addEpoch(self, offset, utc):
+        # Time of an epoch frame at offset in the capture. Epochs must be added in order.
+        if utc != NO_UTC:
+            self.epochs.append((offset, utc))
+
+    def addFrame(self, offset, msgClass, msgId, length, msgData=None):
+        # Same as ubxIndex.IndexWriter.addFrame, so CaptureWriter can use either
+        if msgData is not None and (msgClass, msgId) in EPOCH_CLIDS:
+            self.addEpoch(offset, epochTime(msgData, CLIDPAIR_INV[(msgClass, msgId)])[1])
+
+    def write(self, data):
+        # Data must end at a frame boundary, as blocks are only cut between writes
+        if not data:
+            return
+        if not self.pending:
+            self.blockStartTime = time.time()
+        self.pending.append(bytes(data))
+        self.pendingSize += len(data)
+        if self.pendingSize >= self.blockSize or \
+                (self.maxBlockAge is not None and time.time() - self.blockStartTime >= self.maxBlockAge):
+            self.writeBlock()
+
+    def writeBlock(self):
+        if not self.pending:
+            return
+        data = b''.join(self.pending)
+        end = self.blockOffset + len(data)
+        # Epochs at the start of the block count for its first time
+        while self.epochs and self.epochs[0][0] <= self.blockOffset:
+            self.utc = self.epochs.popleft()[1]
+        firstUtc = self.utc
+        while self.epochs and self.epochs[0][0] < end:
+            self.utc = self.epochs.popleft()[1]
+            if firstUtc == NO_UTC:
+                firstUtc = self.utc
+
+        compressed = compressBlock(self.codec, data, self.level)
+        record = (self.file.tell(), len(compressed), len(data), self.blockOffset, firstUtc, self.utc, zlib.crc32(data))
+        self.file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, *record[1:]))
+        self.file.write(compressed)
+        self.blocks.append(record)
+
+        self.pending = []
+        self.pendingSize = 0
+        self.blockOffset = end
+
+    def flush(self):
+        # Only the finished blocks - a partial block is written at maxBlockAge or close
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        # Size of the capture written so far, before compression
+        return self.blockOffset + self.pendingSize
+
+    def close(self):
+        if self.file is None:
+            return
+        self.writeBlock()
+        indexOffset = self.file.tell()
+        for record in self.blocks:
+            self.file.write(INDEX_RECORD.pack(*record))
+        self.file.write(TRAILER.pack(indexOffset, len(self.blocks), INDEX_MAGIC))
+        self.file.close()
+        self.file = None
+
+
+def readHeader(f):
+    # Codec name of an open .ubz file
+    f.seek(0)
+    header = f.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        raise ValueError('Not a UBZ file')
+    magic, version, codec = FILE_HEADER.unpack(header)
+    if magic != UBZ_MAGIC or version != UBZ_VERSION or codec not in CODECS_INV:
+        raise ValueError('Not a UBZ file, or an unknown version')
+    return CODECS_INV[codec]
+
+
+def readBlockIndex(f):
+    # BLOCK_DTYPE records of the blocks of an open .ubz file, from the index at the end of
+    # the file or, if there is none, by walking the block headers
+    size = os.fstat(f.fileno()).st_size
+    if size >= FILE_HEADER.size + TRAILER.size:
+        f.seek(size - TRAILER.size)
+        indexOffset, numBlocks, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic == INDEX_MAGIC and indexOffset + numBlocks*INDEX_RECORD.size + TRAILER.size == size:
+            f.seek(indexOffset)
+            return np.frombuffer(f.read(numBlocks*INDEX_RECORD.size), dtype=BLOCK_DTYPE)
+
+    records = []
+    offset = FILE_HEADER.size
+    while offset + BLOCK_HEADER.size <= size:
+        f.seek(offset)
+        magic, compressedSize, blockSize, blockOffset, firstUtc, lastUtc, crc32 = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+        if magic != BLOCK_MAGIC or offset + BLOCK_HEADER.size + compressedSize > size:
+            break
+        records.append((offset, compressedSize, blockSize, blockOffset, firstUtc, lastUtc, crc32))
+        offset += BLOCK_HEADER.size + compressedSize
+    logging.info('No block index in {}, found {} blocks'.format(getattr(f, 'name', 'UBZ file'), len(records)))
+    return np.array(records, dtype=BLOCK_DTYPE)
+
+
+def selectBlocks(blocks, start=None, end=None):
+    # Indices of the run of blocks with frames whose epoch time may be in [start, end),
+    # in UTC nanoseconds. Blocks before the first valid time are only included without a start.
+    selected = np.ones(len(blocks), dtype=bool)
+    if start is not None:
+        selected &= blocks['lastUtc'] >= start
+    if end is not None:
+        selected &= blocks['firstUtc'] < end
+    selected = np.flatnonzero(selected)
+    if not len(selected):
+        return selected
+    return np.arange(selected[0], selected[-1] + 1)
+
+
+class BlockBuffer(object):
+    # The decompressed data of a run of blocks, sliced like bytes. Blocks are decompressed
+    # by readBlock(block number) when first needed, and only the cacheSize most recently
+    # used ones are kept.
+    def __init__(self, readBlock, cacheSize=DEFAULT_CACHE_BLOCKS):
+        self.readBlock = readBlock
+        self.cacheSize = max(cacheSize, 1)
+        self.cache = collections.OrderedDict()
+        # Block number and offset in the buffer of each block
+        self.blockNumbers = []
+        self.starts = []
+        self.size = 0
+
+    def append(self, blockNumber, data):
+        # Add the next block, whose data has just been read
+        self.blockNumbers.append(blockNumber)
+        self.starts.append(self.size)
+        self.size += len(data)
+        self.cacheBlock(len(self.starts) - 1, data)
+
+    def cacheBlock(self, k, data):
+        self.cache[k] = data
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+
+    def block(self, k):
+        # Data of the kth block of the buffer
+        data = self.cache.get(k)
+        if data is not None:
+            self.cache.move_to_end(k)
+            return data
+        data = self.readBlock(self.blockNumbers[k])
+        if data is None:
+            raise ValueError('Block {} can no longer be read'.format(self.blockNumbers[k]))
+        self.cacheBlock(k, data)
+        return data
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            if key < 0:
+                key += self.size
+            if not 0 <= key < self.size:
+                raise IndexError('BlockBuffer index out of range')
+            k = bisect.bisect_right(self.starts, key) - 1
+            return self.block(k)[key - self.starts[k]]
+
+        start, stop, step = key.indices(self.size)
+        if step != 1:
+            raise ValueError('BlockBuffer slices must be contiguous')
+        if start >= stop:
+            return b''
+        # Frames never span blocks, so a slice of a frame is a slice of one block
+        k = bisect.bisect_right(self.starts, start) - 1
+        pieces = []
+        while start < stop:
+            blockStart = self.starts[k]
+            data = self.block(k)
+            pieces.append(data[start - blockStart:stop - blockStart])
+            start = blockStart + len(data)
+            k += 1
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+    def rawRecords(self, offsets, dtype):
+        # ubxArrays.decodeFrames over the blocks, decompressing each block once
+        offsets = np.asarray(offsets, dtype=np.int64)
+        records = np.zeros(len(offsets), dtype=dtype)
+        blocks = np.searchsorted(np.array(self.starts, dtype=np.int64), offsets, 'right') - 1
+        order = np.argsort(blocks, kind='stable')
+        splits = np.flatnonzero(np.diff(blocks[order])) + 1
+        for group in np.split(order, splits):
+            if len(group):
+                k = int(blocks[group[0]])
+                records[group] = decodeFrames(self.block(k), offsets[group] - self.starts[k], dtype)
+        return records
+
+
+class UbzFile(UbxFile):
+    def __init__(self, path, start=None, end=None, gps=False, maxLength=None, leapSeconds=GPSMinusUTC,
+                 cacheSize=DEFAULT_CACHE_BLOCKS):
+        # start and end (as for UbxFile.seek) limit the blocks read to those covering that
+        # time range, and the frames indexed to those in it (see UbxFile.limitToWindow).
+        # cacheSize is the number of decompressed blocks kept in memory.
+        self.path = path
+        self.file = open(path, 'rb')
+        self.codec = readHeader(self.file)
+        self.blocks = readBlockIndex(self.file)
+        startUtc = toUtcNanoseconds(start, gps, leapSeconds) if start is not None else None
+        endUtc = toUtcNanoseconds(end, gps, leapSeconds) if end is not None else None
+        self.selected = selectBlocks(self.blocks, startUtc, endUtc)
+
+        # Index each block as it is read, so only the cached blocks are ever in memory
+        self.buffer = BlockBuffer(self.readBlock, cacheSize)
+        indices = []
+        for i in self.selected.tolist():
+            data = self.readBlock(i)
+            if data is not None:
+                index = buildFrameIndex(data, maxLength=maxLength)
+                index['offset'] += len(self.buffer)
+                indices.append(index)
+                self.buffer.append(i, data)
+        self.size = len(self.buffer)
+        # Offset of the decompressed data in the capture
+        self.baseOffset = int(self.blocks['offset'][self.selected[0]]) if len(self.selected) else 0
+
+        self.sidecar = None
+        self.index = np.concatenate(indices) if indices else buildFrameIndex(b'')
+        self.epochFrames = None
+        if start is not None or end is not None:
+            self.limitToWindow(start, end, gps, leapSeconds)
+
+    def readBlock(self, i):
+        # Decompressed data of block i, or None if it is corrupt. Blocks start at frame
+        # boundaries, so the frames of the other blocks can still be read.
+        block = self.blocks[i]
+        self.file.seek(int(block['fileOffset']) + BLOCK_HEADER.size)
+        try:
+            data = decompressBlock(self.codec, self.file.read(int(block['compressedSize'])))
+        except (zlib.error, lzma.LZMAError) as exc:
+            logging.warning('{}: skipping block {}: {}'.format(self.path, i, exc))
+            return None
+        if len(data) != block['size'] or zlib.crc32(data) != block['crc32']:
+            logging.warning('{}: skipping block {}: CRC or size mismatch'.format(self.path, i))
+            return None
+        return data
+
+    def rawRecords(self, offsets, dtype):
+        return self.buffer.rawRecords(offsets, dtype)
+
+    def frames(self, validOnly=True):
+        # As UbxFile.frames, but slicing each block directly instead of going through the buffer
+        offsets = self.index['offset'].tolist()
+        classes = self.index['msgClass'].tolist()
+        ids = self.index['msgId'].tolist()
+        lengths = self.index['length'].tolist()
+        checksumOk = self.index['checksumOk'].tolist()
+        starts = self.buffer.starts + [self.size]
+        blockStart = blockEnd = 0
+        data = b''
+        for offset, msgClass, msgId, length, ok in zip(offsets, classes, ids, lengths, checksumOk):
+            if validOnly and not ok:
+                continue
+            if not blockStart <= offset < blockEnd:
+                k = bisect.bisect_right(starts, offset) - 1
+                data = self.buffer.block(k)
+                blockStart = starts[k]
+                blockEnd = starts[k+1]
+            position = offset - blockStart
+            yield msgClass, msgId, data[position+6:position+length+6], offset
+
+    @property
+    def captureSize(self):
+        # Size of the whole capture, before compression
+        if not len(self.blocks):
+            return 0
+        return int(self.blocks['offset'][-1]) + int(self.blocks['size'][-1])
+
+
+def openCapture(path, start=None, end=None, gps=False, **kwargs):
+    # UbzFile for .ubz files, otherwise UbxFile, with only the frames from start to end
+    if path.endswith(UBZ_EXTENSION):
+        return UbzFile(path, start, end, gps, **kwargs)
+    ubxFile = UbxFile(path, **kwargs)
+    if start is not None or end is not None:
+        ubxFile.limitToWindow(start, end, gps)
+    return ubxFile
+
+
+def compressRange(ubxFile, path, start=0, end=None, codec=DEFAULT_CODEC, blockSize=DEFAULT_BLOCK_SIZE, level=None):
+    # Write bytes [start, end) of an opened capture (UbxFile or UbzFile) to a .ubz file.
+    # start must be at a frame boundary. Returns the number of blocks.
+    end = ubxFile.size if end is None else end
+    offsets = ubxFile.index['offset']
+    frameOffsets = offsets[(offsets > start) & (offsets < end)]
+    epochs = ubxFile.frameNumbers(EPOCH_MESSAGES)
+    epochs = epochs[(offsets[epochs] >= start) & (offsets[epochs] < end)]
+
+    with UbzWriter(path, codec, blockSize, level) as writer:
+        for i in epochs.tolist():
+            writer.addEpoch(int(offsets[i]) - start, ubxFile.frameTime(i))
+        cut = start
+        while cut < end:
+            # Each block ends at the first frame at or after blockSize
+            k = np.searchsorted(frameOffsets, cut + blockSize)
+            nextCut = int(frameOffsets[k]) if k < len(frameOffsets) else end
+            writer.write(ubxFile.buffer[cut:nextCut])
+            cut = nextCut
+    return len(writer.blocks)
+
+
+def compressFile(inputPath, outputPath=None, codec=DEFAULT_CODEC, blockSize=DEFAULT_BLOCK_SIZE, level=None):
+    # Compress a .ubx file to .ubz. Returns (output path, number of blocks).
+    if outputPath is None:
+        outputPath = os.path.splitext(inputPath)[0] + UBZ_EXTENSION
+    with UbxFile(inputPath) as ubxFile:
+        numBlocks = compressRange(ubxFile, outputPath, codec=codec, blockSize=blockSize, level=level)
+    return outputPath, numBlocks
+
+
+def decompressFile(inputPath, outputPath=None):
+    # Restore the original .ubx file of a .ubz file. Returns the output path.
+    if outputPath is None:
+        outputPath = os.path.splitext(inputPath)[0] + '.ubx'
+    with open(inputPath, 'rb') as f, open(outputPath, 'wb') as output:
+        codec = readHeader(f)
+        for block in readBlockIndex(f):
+            f.seek(int(block['fileOffset']) + BLOCK_HEADER.size)
+            output.write(decompressBlock(codec, f.read(int(block['compressedSize']))))
+    return outputPath
+
+
+if __name__=='__main__':
+    import argparse
+    import datetime
+    parser = argparse.ArgumentParser(description='Compress UBX captures to seekable .ubz files, or restore or list them')
+    parser.add_argument('input', nargs='+', help='.ubx files to compress, or .ubz files with --decompress/--list')
+    parser.add_argument('--codec', choices=sorted(CODECS), default=DEFAULT_CODEC)
+    parser.add_argument('--level', type=int, help='Compression level/preset')
+    parser.add_argument('--block-size', type=float, default=DEFAULT_BLOCK_SIZE/1e6, help='MB of capture per block')
+    parser.add_argument('--decompress', '-d', action='store_true', help='Restore the .ubx files')
+    parser.add_argument('--list', '-l', action='store_true', help='List the blocks')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    def utcString(utc):
+        if utc == NO_UTC:
+            return '-'
+        return datetime.datetime.utcfromtimestamp(utc/1e9).strftime('%Y-%m-%d %H:%M:%S')
+
+    for path in args.input:
+        if args.list:
+            with open(path, 'rb') as f:
+                codec = readHeader(f)
+                blocks = readBlockIndex(f)
+            print('{}: {} blocks ({})'.format(path, len(blocks), codec))
+            for i, block in enumerate(blocks):
+                print('{:6d} {:12d} {:8d} -> {:8d}  {} - {}'.format(i, int(block['offset']), int(block['size']), int(block['compressedSize']),
+                                                                   utcString(int(block['firstUtc'])), utcString(int(block['lastUtc']))))
+        elif args.decompress:
+            print('{} -> {}'.format(path, decompressFile(path)))
+        else:
+            startTime = time.time()
+            outputPath, numBlocks = compressFile(path, codec=args.codec, blockSize=int(args.block_size*1e6), level=args.level)
+            inputSize = os.path.getsize(path)
+            outputSize = os.path.getsize(outputPath)
+            print('{} -> {}: {} blocks, {:.1f} MB -> {:.1f} MB ({:.1f}%) in {:.1f} s'.format(
+                  path, outputPath, numBlocks, inputSize/1e6, outputSize/1e6, outputSize*100./max(inputSize, 1), time.time() - startTime))
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Declarative receiver configuration
+
+A profile describes the wanted configuration, e.g.
+
+{
+    "CFG-RATE": {"Meas": 200, "Nav": 1, "Time": 1},
+    "CFG-MSG": {"NAV-PVT": 1, "RXM-RAWX": {"UART1": 1, "USB": 1}, "NAV-SVINFO": 0},
+    "CFG-PRT": {"UART1": {"Out_proto_mask": 1}},
+    "CFG-GNSS": {"GPS": {"enable": true}, "GLONASS": {"enable": false}},
+    "CFG-PMS": {"PowerSetupValue": 0},
+    "CFG-HNR": {"HighNavRate": 30}
+}
+
+A CFG-MSG rate given as a number is for the port the receiver is connected
+through. Fixed length CFG messages (CFG-RATE, CFG-PMS, CFG-HNR, ...) give the
+fields to change. CFG-PRT and CFG-GNSS are keyed by port and GNSS name.
+
+applyConfig polls the current state of everything in the profile, then only
+writes the messages that differ. Polls and writes are pipelined, with a
+bounded number of messages and bytes in flight so the receiver's input
+buffer is not overrun. If a write is NACKed (or never ACKed), the writes
+already sent are rolled back to the polled state.
+
+The functions take a UbloxReader (or anything with requestPoll/requestConfig/
+sendMessage and a RequestTable) and its serial port.
+"""
+import copy
+import json
+import time
+import logging
+import collections
+import concurrent.futures
+
+from ubloxMessage import MSGFMT, CLIDPAIR, PORTID, GNSSID
+from ubxRequests import pollKey, ackKey
+
+# Limits on the requests in flight - a u-blox 8 UART input buffer holds a few KB
+DEFAULT_WINDOW = 8
+DEFAULT_WINDOW_BYTES = 1024
+
+# Profile entries applied last, as changing a port can interrupt the link
+APPLY_LAST = ['CFG-PRT']
+
+# Result of a request that was sent but never answered
+NO_RESPONSE = ('NO-RESPONSE', None)
+
+# Class of the CFG messages, which are ACKed when written and when polled
+CFG_CLASS = CLIDPAIR['CFG-RATE'][0]
+
+
+class ConfigError(Exception):
+    pass
+
+
+def portId(port):
+    return PORTID[port] if port in PORTID else int(port)
+
+def gnssId(gnss):
+    return GNSSID[gnss] if gnss in GNSSID else int(gnss)
+
+def fixedLength(msgFormat):
+    # Length of the set message of a fixed length CFG message, i.e. the longest format
+    lengths = [length for (name, length) in MSGFMT if name == msgFormat and length]
+    if not lengths:
+        raise ConfigError('{} is not a fixed length message'.format(msgFormat))
+    return max(lengths)
+
+def messageLength(msgFormat, msgData):
+    # Payload length of a variable length message from its number of repeated blocks
+    baseSize, _, _, repSize, _, _ = MSGFMT[(msgFormat, None)]
+    return baseSize + repSize*(len(msgData) - 1)
+
+def writeMessage(msgFormat, msgData):
+    # (length, data) to write a polled message back. Fixed length messages are built from a dict.
+    if (msgFormat, None) in MSGFMT:
+        return messageLength(msgFormat, msgData), msgData
+    return fixedLength(msgFormat), msgData[0]
+
+
+# Items - each thing in a profile that is polled and written as one message.
+# An item is (item key, msgFormat, poll length, poll data, match).
+
+def profileItems(profile):
+    items = []
+    for msgFormat in sorted(profile, key=lambda name: name in APPLY_LAST):
+        entry = profile[msgFormat]
+        if msgFormat == 'CFG-MSG':
+            for name in entry:
+                msgClass, msgId = CLIDPAIR[name]
+                items.append((('CFG-MSG', name), 'CFG-MSG', 2, {'msgClass': msgClass, 'msgId': msgId},
+                              lambda msgData, msgClass=msgClass, msgId=msgId: msgData[0]['msgClass'] == msgClass and msgData[0]['msgId'] == msgId))
+        elif msgFormat == 'CFG-PRT':
+            for port in entry:
+                items.append((('CFG-PRT', portId(port)), 'CFG-PRT', 1, {'PortID': portId(port)},
+                              lambda msgData, port=portId(port): len(msgData) > 1 and msgData[1]['PortID'] == port))
+        else:
+            items.append(((msgFormat,), msgFormat, 0, [], None))
+    return items
+
+# Poll of the port the receiver is connected through
+CURRENT_PORT_ITEM = (('CFG-PRT', None), 'CFG-PRT', 0, [], None)
+
+
+def pipeline(ublox, ser, requests, timeout=0.5, maxRetries=5, window=DEFAULT_WINDOW, windowBytes=DEFAULT_WINDOW_BYTES, stopOnNack=False):
+    # Send requests, a list of (key, msgFormat, length, data, match), keeping up to window
+    # requests and windowBytes in flight. Requests that time out are resent. Returns the
+    # list of responses (msgFormat, msgData), with NO_RESPONSE for requests that were never
+    # answered and None for requests not sent because an earlier one failed (with stopOnNack).
+    #
+    # ACKs only carry the class and id of the message. The receiver answers in order, so
+    # the ACKs of several writes with the same key go to the writes in the order they were
+    # sent (see RequestTable.resolve), as long as no ACK is missing or extra:
+    # - the ACK the receiver sends after each CFG poll is waited for, and a late one is
+    #   discarded (see RequestTable.discard) rather than left for the next write
+    # - a resend replaces the request. While it is in flight, and for timeout after it is
+    #   answered, no other request with that key is sent, so the ACK of the other attempt
+    #   finds nothing waiting for it. Other keys are not held up.
+    # - a write that times out may have been lost, with the ACKs of the later writes with
+    #   the same key each credited to the write before. Those writes answered since it was
+    #   sent are sent again - writing a setting twice is harmless.
+    results = [None]*len(requests)
+    queue = collections.deque(range(len(requests)))
+    # future -> [request index, time of the last send, attempts]
+    inFlight = {}
+    inFlightBytes = 0
+    # request index -> time answered, for the requests without a match
+    answered = {}
+    # key -> time a key is released after a resent request
+    held = {}
+    # (key, future) for the ACKs of CFG polls
+    pollAcks = []
+    stopped = False
+
+    def send(i):
+        key, msgFormat, length, data, match = requests[i]
+        future = ublox.requests.add(key, match)
+        if key[0] != 'ACK' and CLIDPAIR[msgFormat][0] == CFG_CLASS:
+            pollAcks.append((ackKey(msgFormat), ublox.requests.add(ackKey(msgFormat))))
+        ublox.sendMessage(ser, msgFormat, length, data)
+        return future
+
+    def isHeld(key, now):
+        return held.get(key, 0) > now or any(requests[i][0] == key and attempts > 1 for i, _, attempts in inFlight.values())
+
+    try:
+        while (queue and not stopped) or inFlight:
+            # Fill the window, skipping requests whose key is held. Nothing is sent ahead
+            # of a skipped request past a message applied last (e.g. CFG-PRT).
+            now = time.time()
+            skipped = False
+            for i in list(queue):
+                if stopped or len(inFlight) >= window:
+                    break
+                key, msgFormat, length, data, match = requests[i]
+                if inFlight and inFlightBytes + length + 8 > windowBytes:
+                    break
+                if skipped and msgFormat in APPLY_LAST:
+                    break
+                if match is None and isHeld(key, now):
+                    skipped = True
+                    continue
+                queue.remove(i)
+                inFlight[send(i)] = [i, time.time(), 1]
+                inFlightBytes += length + 8
+
+            timeoutWait = timeout/4 if inFlight else max(min(held.values()) - time.time(), 0)
+            done, _ = concurrent.futures.wait(list(inFlight), timeout=timeoutWait, return_when=concurrent.futures.FIRST_COMPLETED)
+            now = time.time()
+            for future in list(inFlight):
+                i, sentTime, attempts = inFlight[future]
+                key, msgFormat, length, data, match = requests[i]
+                if future in done:
+                    results[i] = future.result()
+                    if stopOnNack and results[i][0] == 'ACK-NACK':
+                        stopped = True
+                    if match is None:
+                        answered[i] = now
+                    if attempts > 1:
+                        held[key] = now + timeout
+                elif now - sentTime > timeout:
+                    if match is None:
+                        # The ACKs received since this was sent may have been its own
+                        resend = sorted(j for j, answerTime in answered.items()
+                                        if requests[j][0] == key and answerTime >= sentTime and results[j][0] == 'ACK-ACK')
+                        for j in reversed(resend):
+                            del answered[j]
+                            # Not known to be applied or not, until answered again
+                            results[j] = NO_RESPONSE
+                            queue.appendleft(j)
+                    if attempts < maxRetries:
+                        logging.warning('Timeout waiting for response to {}, resending'.format(msgFormat))
+                        ublox.requests.remove(key, future)
+                        del inFlight[future]
+                        inFlight[send(i)] = [i, now, attempts + 1]
+                        continue
+                    logging.warning('No response to {}'.format(msgFormat))
+                    results[i] = NO_RESPONSE
+                    held[key] = now + timeout
+                    if stopOnNack:
+                        stopped = True
+                else:
+                    continue
+                ublox.requests.remove(key, future)
+                del inFlight[future]
+                inFlightBytes -= length + 8
+            held = dict((key, release) for key, release in held.items() if release > now)
+
+        # The ACKs of the last polls, before any writes are sent
+        pending = [future for _, future in pollAcks if not future.done()]
+        if pending:
+            concurrent.futures.wait(pending, timeout=timeout)
+    finally:
+        for future, (i, sentTime, attempts) in inFlight.items():
+            ublox.requests.remove(requests[i][0], future)
+        # A receiver that ACKed none of the polls does not ACK them at all
+        acksPolls = any(future.done() for _, future in pollAcks)
+        for key, future in pollAcks:
+            if future.done():
+                continue
+            if acksPolls:
+                ublox.requests.discard(key, future, timeout*maxRetries)
+            else:
+                ublox.requests.remove(key, future)
+    return results
+
+
+def readItems(ublox, ser, items, required=True, **kwargs):
+    # Poll items. Returns {item key: (msgFormat, msgData)}. An item that is not answered raises
+    # ConfigError, or is left out if not required (e.g. a message the receiver does not support).
+    # The ACKs of the CFG polls have been received (or timed out) when this returns.
+    requests = [(pollKey(msgFormat), msgFormat, length, data, match) for _, msgFormat, length, data, match in items]
+    results = pipeline(ublox, ser, requests, **kwargs)
+    snapshot = {}
+    for (itemKey, msgFormat, _, _, _), result in zip(items, results):
+        if result is None or result is NO_RESPONSE:
+            if required:
+                raise ConfigError('No response polling {}'.format(' '.join(str(part) for part in itemKey)))
+            continue
+        snapshot[itemKey] = result
+    return snapshot
+
+
+def readConfig(ublox, ser, profile, cache=None, **kwargs):
+    # Poll the current state of everything in the profile. Returns {item key: (msgFormat, msgData)}.
+    # With a ConfigCache, items are served from the cache when it is still valid.
+    items = profileItems(profile)
+    if any(not isinstance(rates, dict) for rates in profile.get('CFG-MSG', {}).values()):
+        # The port the receiver is connected through, for CFG-MSG rates given as numbers
+        items.insert(0, CURRENT_PORT_ITEM)
+    if cache is not None:
+        return cache.snapshot(ublox, ser, items, **kwargs)
+    return readItems(ublox, ser, items, **kwargs)
+
+
+def diffConfig(profile, snapshot):
+    # The writes needed to go from snapshot to profile, as a list of (item key, msgFormat, length, msgData)
+    writes = []
+    for itemKey, msgFormat, _, _, _ in profileItems(profile):
+        current = snapshot[itemKey][1]
+        wanted = copy.deepcopy(current)
+        entry = profile[msgFormat]
+
+        if msgFormat == 'CFG-MSG':
+            rates = entry[itemKey[1]]
+            if isinstance(rates, dict):
+                for port, rate in rates.items():
+                    wanted[portId(port) + 1]['rate'] = rate
+            else:
+                if ('CFG-PRT', None) not in snapshot:
+                    raise ConfigError('Could not find the current port for the {} rate'.format(itemKey[1]))
+                wanted[snapshot[('CFG-PRT', None)][1][1]['PortID'] + 1]['rate'] = rates
+        elif msgFormat == 'CFG-PRT':
+            port = dict((portId(key), value) for key, value in entry.items())[itemKey[1]]
+            wanted[1].update(port)
+        elif msgFormat == 'CFG-GNSS':
+            settings = dict((gnssId(key), value) for key, value in entry.items())
+            for block in wanted[1:]:
+                fields = dict(settings.get(block['gnssId'], {}))
+                if 'enable' in fields:
+                    block['flags'] = (block['flags'] & ~1) | int(bool(fields.pop('enable')))
+                block.update(fields)
+        else:
+            wanted[0].update(entry)
+
+        if wanted != current:
+            length, data = writeMessage(msgFormat, wanted)
+            writes.append((itemKey, msgFormat, length, data))
+    return writes
+
+
+def writeConfig(ublox, ser, writes, stopOnNack=True, **kwargs):
+    # Send the writes from diffConfig. Returns the responses, see pipeline.
+    requests = [(ackKey(msgFormat), msgFormat, length, msgData, None) for _, msgFormat, length, msgData in writes]
+    return pipeline(ublox, ser, requests, stopOnNack=stopOnNack, **kwargs)
+
+
+def applyConfig(ublox, ser, profile, dryRun=False, cache=None, **kwargs):
+    # Bring the receiver to the profile. Returns the writes sent. If any write fails,
+    # the writes sent are reverted to the polled state and ConfigError is raised.
+    # With a ConfigCache, the current state is read from and the writes saved to the cache.
+    snapshot = readConfig(ublox, ser, profile, cache, **kwargs)
+    writes = diffConfig(profile, snapshot)
+    logging.info('{} of {} config messages need to be written'.format(len(writes), len(profileItems(profile))))
+    if dryRun or not writes:
+        return writes
+
+    results = writeConfig(ublox, ser, writes, **kwargs)
+    if cache is not None:
+        cache.update([write for write, result in zip(writes, results) if result is not None and result[0] == 'ACK-ACK'])
+    failed = [(itemKey, result) for (itemKey, _, _, _), result in zip(writes, results) if result is not None and result[0] != 'ACK-ACK']
+    if not failed:
+        return writes
+
+    # Roll back everything the receiver may have applied - a write that got no answer may still have been
+    rollback = []
+    for (itemKey, msgFormat, _, _), result in zip(writes, results):
+        if result is not None and result[0] != 'ACK-NACK':
+            length, data = writeMessage(msgFormat, snapshot[itemKey][1])
+            rollback.append((itemKey, msgFormat, length, data))
+    logging.warning('Rolling back {} config messages'.format(len(rollback)))
+    rollbackResults = writeConfig(ublox, ser, rollback, stopOnNack=False, **kwargs)
+    if cache is not None:
+        # Writes that got no answer leave the receiver state unknown
+        cache.update([write for write, result in zip(rollback, rollbackResults) if result[0] == 'ACK-ACK'])
+        cache.forget([itemKey for (itemKey, _, _, _), result in zip(rollback, rollbackResults) if result[0] != 'ACK-ACK'])
+    notRestored = [' '.join(str(part) for part in itemKey) for (itemKey, _, _, _), result in zip(rollback, rollbackResults) if result[0] != 'ACK-ACK']
+
+    itemKey, result = failed[0]
+    message = '{} was {}'.format(' '.join(str(part) for part in itemKey), 'NACKed' if result[0] == 'ACK-NACK' else 'not acknowledged')
+    if notRestored:
+        message += ', and rolling back failed for {}'.format(notRestored)
+    else:
+        message += ', configuration rolled back'
+    raise ConfigError(message)
+
+
+def loadProfile(path):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
+
+
+if __name__=='__main__':
+    import argparse
+    import serial
+    import serial.threaded
+    from ublox2 import UbloxReader
+    parser = argparse.ArgumentParser(description='Apply a configuration profile to a receiver')
+    parser.add_argument('profile', help='JSON profile')
+    parser.add_argument('--device', '-d', default='/dev/ttyHS1', help='Specify the serial port device to communicate with. e.g. /dev/ttyO5')
+    parser.add_argument('--baudrate', '-b', type=int, default=115200)
+    parser.add_argument('--dry-run', '-n', action='store_true', help='Only show the messages that would be written')
+    parser.add_argument('--cache', '-c', nargs='?', const=True, help='Read the current configuration from a cache file (see ubxConfigCache.py), optionally giving its path')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    profile = loadProfile(args.profile)
+    cache = None
+    if args.cache is not None:
+        from ubxConfigCache import ConfigCache, DEFAULT_CACHE_PATH
+        cache = ConfigCache(DEFAULT_CACHE_PATH if args.cache is True else args.cache)
+    ser = serial.Serial(args.device, args.baudrate, timeout=1)
+    with serial.threaded.ReaderThread(ser, UbloxReader) as ublox:
+        startTime = time.time()
+        try:
+            writes = applyConfig(ublox, ser, profile, dryRun=args.dry_run, cache=cache)
+        except ConfigError as exc:
+            print('Configuration failed: {}'.format(exc))
+            raise SystemExit(1)
+        for itemKey, msgFormat, length, msgData in writes:
+            print('{}{}: {}'.format(' '.join(str(part) for part in itemKey), ' (not sent)' if args.dry_run else '', msgData))
+        print('{} messages written in {:.2f} s'.format(0 if args.dry_run else len(writes), time.time() - startTime))
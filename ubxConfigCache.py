@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Cached receiver configuration
+
+ConfigCache keeps the polled CFG messages of each receiver in a local JSON
+file, keyed by the chip ID from SEC-UNIQID. The MON-VER strings are stored
+with them, so a firmware update invalidates the entry. Opening a receiver
+polls MON-VER and SEC-UNIQID, then re-polls a few check items (CFG-RATE and
+the port in use) and compares them with the cache. If they match, everything
+else is served from the cache, otherwise the entry is dropped and items are
+polled again as they are needed.
+
+Writes made through ubxConfig.applyConfig(..., cache=cache) are saved to the
+cache, so it stays valid. Changes made by other tools are only caught if they
+touch the check items, so use --refresh after running them.
+
+The file format is
+
+{
+    "version": 1,
+    "receivers": {
+        "<chip ID>": {"monVer": [...], "time": <unix time>,
+                      "items": [[<item key>, <msgFormat>, <payload hex or null if not supported>], ...]}
+    }
+}
+"""
+import os
+import json
+import time
+import logging
+
+from ubloxMessage import UbloxMessage, CLIDPAIR, MSGFMT, PORTID
+from ubxConfig import readItems, profileItems, CURRENT_PORT_ITEM, ConfigError
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ubx', 'receiverConfig.json')
+
+# Items re-polled to check the cache is still valid
+CHECK_ITEMS = [(('CFG-RATE',), 'CFG-RATE', 0, [], None), CURRENT_PORT_ITEM]
+
+# Fixed CFG messages in a full snapshot. Not every receiver supports all of them.
+SNAPSHOT_MESSAGES = ['CFG-ANT', 'CFG-GNSS', 'CFG-HNR', 'CFG-NMEA', 'CFG-PMS', 'CFG-RATE', 'CFG-RXM', 'CFG-SBAS', 'CFG-USB']
+# Message classes whose output rates are in a full snapshot
+SNAPSHOT_CLASSES = ['NAV', 'RXM', 'MON', 'TIM', 'ESF', 'HNR']
+
+
+def snapshotItems():
+    # Items of a full snapshot - the fixed CFG messages, every port and the rate of every decodable output message
+    profile = {'CFG-PRT': dict((port, {}) for port in sorted(PORTID, key=PORTID.get)),
+               'CFG-MSG': dict((name, 0) for name, length in MSGFMT if name.split('-')[0] in SNAPSHOT_CLASSES)}
+    profile.update((name, {}) for name in SNAPSHOT_MESSAGES)
+    return sorted(profileItems(profile), key=lambda item: item[0])
+
+
+def encodePayload(msgFormat, length, msgData):
+    # Payload of a message, with msgData as for UbloxMessage.buildMessage
+    return UbloxMessage.buildMessage(msgFormat, length, msgData)[6:-2]
+
+def decodePayload(msgFormat, payload):
+    msgClass, msgId = CLIDPAIR[msgFormat]
+    return UbloxMessage.decode(msgClass, msgId, len(payload), payload)
+
+def responsePayload(msgFormat, msgData):
+    # Payload of a decoded poll response
+    if (msgFormat, None) in MSGFMT:
+        baseSize, _, _, repSize, _, _ = MSGFMT[(msgFormat, None)]
+        return encodePayload(msgFormat, baseSize + repSize*(len(msgData) - 1), msgData)
+    length = max(length for name, length in MSGFMT if name == msgFormat and length)
+    return encodePayload(msgFormat, length, msgData[0])
+
+
+def loadCache(path):
+    # {chip ID: entry}, empty if there is no cache or it is from another version
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache['receivers']
+
+def saveCache(path, receivers):
+    # Write to a temporary file and rename, so readers never see a partial file
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tempPath = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tempPath, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'receivers': receivers}, f, indent=1, sort_keys=True)
+    os.rename(tempPath, path)
+
+
+class ConfigCache(object):
+    def __init__(self, path=DEFAULT_CACHE_PATH, maxAge=None, refresh=False):
+        self.path = path
+        # Seconds before an entry is polled again in full, None for no limit
+        self.maxAge = maxAge
+        # Ignore the cached entry
+        self.refresh = refresh
+        # Set by open
+        self.chipId = None
+        self.monVer = None
+        self.time = None
+        # item key -> payload, or None if the receiver did not answer the poll
+        self.items = {}
+        # Items only valid for this connection, e.g. the port in use
+        self.session = {}
+
+    def open(self, ublox, ser, **kwargs):
+        # Identify the receiver and load its entry if the check items still match. Returns
+        # whether the cached entry was used.
+        identity = readItems(ublox, ser, [(('MON-VER',), 'MON-VER', 0, [], None), (('SEC-UNIQID',), 'SEC-UNIQID', 0, [], None)],
+                             required=False, **kwargs)
+        if ('MON-VER',) not in identity:
+            raise ConfigError('No response polling MON-VER')
+        self.monVer = [value.decode('ascii', 'replace').rstrip('\x00') for block in identity[('MON-VER',)][1] for value in block.values()]
+        if ('SEC-UNIQID',) in identity:
+            self.chipId = identity[('SEC-UNIQID',)][1][0]['uniqueId'].hex()
+        else:
+            # Nothing to tell receivers with the same firmware apart
+            logging.warning('Receiver does not support SEC-UNIQID, configuration will not be cached')
+            self.chipId = None
+        self.items = {}
+        self.time = time.time()
+
+        checks = readItems(ublox, ser, CHECK_ITEMS, **kwargs)
+        self.session = {CURRENT_PORT_ITEM[0]: checks.pop(CURRENT_PORT_ITEM[0])}
+        currentPort = self.session[CURRENT_PORT_ITEM[0]][1][1]['PortID']
+        checks[('CFG-PRT', currentPort)] = self.session[CURRENT_PORT_ITEM[0]]
+
+        entry = loadCache(self.path).get(self.chipId) if self.chipId is not None and not self.refresh else None
+        if entry is None:
+            self.items = dict((itemKey, responsePayload(*result)) for itemKey, result in checks.items())
+            self.save()
+            return False
+
+        cachedItems = dict((tuple(itemKey), bytes.fromhex(payload) if payload is not None else None) for itemKey, msgFormat, payload in entry['items'])
+        reason = None
+        if entry['monVer'] != self.monVer:
+            reason = 'firmware changed'
+        elif self.maxAge is not None and time.time() - entry['time'] > self.maxAge:
+            reason = 'older than {} s'.format(self.maxAge)
+        else:
+            for itemKey, result in checks.items():
+                if itemKey in cachedItems and cachedItems[itemKey] != responsePayload(*result):
+                    reason = '{} changed'.format(' '.join(str(part) for part in itemKey))
+                    break
+        if reason is not None:
+            logging.info('Cached configuration of {} is not valid ({})'.format(self.chipId, reason))
+            self.items = dict((itemKey, responsePayload(*result)) for itemKey, result in checks.items())
+            self.save()
+            return False
+
+        logging.info('Using cached configuration of {}'.format(self.chipId))
+        self.items = cachedItems
+        self.items.update((itemKey, responsePayload(*result)) for itemKey, result in checks.items())
+        self.time = entry['time']
+        return True
+
+    def snapshot(self, ublox, ser, items, required=True, **kwargs):
+        # {item key: (msgFormat, msgData)} for items, like ubxConfig.readItems. Only the
+        # items that are not cached are polled.
+        if self.monVer is None:
+            self.open(ublox, ser, **kwargs)
+        missing = [item for item in items if item[0] not in self.items and item[0] not in self.session]
+        if missing:
+            logging.info('Polling {} items not in the configuration cache'.format(len(missing)))
+            results = readItems(ublox, ser, missing, required=False, **kwargs)
+            for itemKey, _, _, _, _ in missing:
+                self.items[itemKey] = responsePayload(*results[itemKey]) if itemKey in results else None
+            self.save()
+
+        snapshot = {}
+        for itemKey, msgFormat, _, _, _ in items:
+            if itemKey in self.session:
+                snapshot[itemKey] = self.session[itemKey]
+            elif self.items[itemKey] is not None:
+                snapshot[itemKey] = decodePayload(msgFormat, self.items[itemKey])
+            elif required:
+                raise ConfigError('No response polling {}'.format(' '.join(str(part) for part in itemKey)))
+        return snapshot
+
+    def update(self, writes):
+        # Save writes acknowledged by the receiver, as (item key, msgFormat, length, msgData) from ubxConfig.diffConfig
+        for itemKey, msgFormat, length, msgData in writes:
+            self.items[itemKey] = encodePayload(msgFormat, length, msgData)
+        if writes:
+            self.save()
+
+    def forget(self, itemKeys):
+        # Drop items whose state on the receiver is unknown
+        for itemKey in itemKeys:
+            self.items.pop(itemKey, None)
+        if itemKeys:
+            self.save()
+
+    def save(self):
+        if self.chipId is None:
+            return
+        receivers = loadCache(self.path)
+        receivers[self.chipId] = {'monVer': self.monVer, 'time': self.time,
+                                  'items': [[list(itemKey), itemKey[0], payload.hex() if payload is not None else None]
+                                            for itemKey, payload in sorted(self.items.items(), key=lambda item: str(item[0]))]}
+        saveCache(self.path, receivers)
+
+
+if __name__=='__main__':
+    import argparse
+    import serial
+    import serial.threaded
+    from ublox2 import UbloxReader
+    parser = argparse.ArgumentParser(description='Print the configuration of a receiver, from the cache when it is still valid')
+    parser.add_argument('--device', '-d', default='/dev/ttyHS1', help='Specify the serial port device to communicate with. e.g. /dev/ttyO5')
+    parser.add_argument('--baudrate', '-b', type=int, default=115200)
+    parser.add_argument('--cache', '-c', default=DEFAULT_CACHE_PATH, help='Cache file')
+    parser.add_argument('--max-age', type=float, help='Poll everything again if the cache is older than this many seconds')
+    parser.add_argument('--refresh', '-r', action='store_true', help='Ignore the cache and poll everything')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    ser = serial.Serial(args.device, args.baudrate, timeout=1)
+    with serial.threaded.ReaderThread(ser, UbloxReader) as ublox:
+        startTime = time.time()
+        cache = ConfigCache(args.cache, args.max_age, args.refresh)
+        try:
+            # Unsupported messages are not answered, so do not wait long for them
+            snapshot = cache.snapshot(ublox, ser, snapshotItems(), required=False, timeout=0.5, maxRetries=2)
+        except ConfigError as exc:
+            print('Reading configuration failed: {}'.format(exc))
+            raise SystemExit(1)
+        elapsed = time.time() - startTime
+
+    print('Receiver {} - {}'.format(cache.chipId, ', '.join(cache.monVer)))
+    for itemKey in sorted(snapshot, key=str):
+        UbloxMessage.printMessage(*snapshot[itemKey])
+    print('\n{} configuration messages in {:.2f} s'.format(len(snapshot), elapsed))
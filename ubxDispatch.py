@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Subscription based message dispatch
+
+Handlers subscribe to message names (e.g. 'NAV-PVT'), (class, id) pairs or
+NMEA sentence names (e.g. '$GPGGA'). The parsers look up the route for each
+frame from its header, so frames nobody subscribed to are never decoded.
+"""
+from ubloxMessage import CLIDPAIR
+
+# Route for a frame nobody subscribed to
+NO_ROUTE = ((), False)
+
+
+class Dispatcher(object):
+    def __init__(self):
+        # (key, handler, decode) in subscription order. A key of None matches every message.
+        self.subscriptions = []
+        # key -> (handlers, decode), rebuilt on every (un)subscribe
+        self.routes = {}
+        # Route for messages that only the catch-all subscriptions match
+        self.defaultRoute = NO_ROUTE
+        # (class, id) pairs with a subscriber, for FrameScanner.checksumKeys. None if
+        # there is a catch-all subscription.
+        self.checksumKeys = frozenset()
+
+    @staticmethod
+    def messageKey(msgType):
+        # (class, id) for a UBX message name or pair, or the name of an NMEA sentence
+        if isinstance(msgType, tuple):
+            return msgType
+        if msgType in CLIDPAIR:
+            return CLIDPAIR[msgType]
+        if msgType.startswith('$'):
+            return msgType
+        raise ValueError('Unknown message type {}'.format(msgType))
+
+    def _keys(self, msgTypes):
+        if msgTypes is None:
+            return [None]
+        if isinstance(msgTypes, (str, tuple)):
+            msgTypes = [msgTypes]
+        return [self.messageKey(msgType) for msgType in msgTypes]
+
+    def subscribe(self, msgTypes, handler, decode=True):
+        # Call handler for each message of msgTypes - a name, (class, id) pair, a list
+        # of them, or None for every message. With decode=False the handler only needs
+        # the header and raw frame, and gets msgData=None unless another subscriber
+        # of the same type asked for it to be decoded.
+        for key in self._keys(msgTypes):
+            self.subscriptions.append((key, handler, decode))
+        self._buildRoutes()
+
+    def unsubscribe(self, handler, msgTypes=None):
+        # Remove handler from msgTypes, or from everything it subscribed to
+        keys = None if msgTypes is None else set(self._keys(msgTypes))
+        self.subscriptions = [(key, h, decode) for key, h, decode in self.subscriptions
+                              if h != handler or (keys is not None and key not in keys)]
+        self._buildRoutes()
+
+    def _buildRoutes(self):
+        catchAll = [(handler, decode) for key, handler, decode in self.subscriptions if key is None]
+        routes = {}
+        for key, handler, decode in self.subscriptions:
+            if key is not None:
+                routes.setdefault(key, [])
+        for key in routes:
+            subscribers = [(handler, decode) for k, handler, decode in self.subscriptions if k is None or k == key]
+            routes[key] = (tuple(handler for handler, _ in subscribers), any(decode for _, decode in subscribers))
+        self.routes = routes
+        self.defaultRoute = (tuple(handler for handler, _ in catchAll), any(decode for _, decode in catchAll)) if catchAll else NO_ROUTE
+        self.checksumKeys = None if catchAll else frozenset(key for key in routes if isinstance(key, tuple))
+
+    def route(self, key):
+        # (handlers, decode) for a (class, id) pair or NMEA sentence name
+        return self.routes.get(key, self.defaultRoute)
+
+    def __len__(self):
+        return len(self.subscriptions)
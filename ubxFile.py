@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped UBX log reader
+
+UbxFile maps a UBX capture instead of reading it into memory, builds a compact
+frame index (NumPy arrays of offset, class, id, length and checksum flag) and
+decodes frames lazily, in order or by frame number. If the capture has a
+sidecar index (see ubxIndex), the frame index is loaded from it instead of
+rescanning the file.
+
+decodeArray() decodes every frame of a fixed length type, e.g. NAV-PVT, into a
+NumPy structured array in one pass.
+
+Frames can also be selected by time. seek() and framesInWindow() binary search
+over the NAV-PVT/HNR-PVT/NAV-TIMEUTC epochs, decoding only the epochs probed,
+and limitToWindow() drops the frames outside a time window.
+"""
+import os
+import mmap
+import logging
+import calendar
+import datetime
+from array import array
+import numpy as np
+
+from ubloxMessage import UbloxMessage, CLIDPAIR, CLIDPAIR_INV
+from frameScanner import UBX_SYNC, UBX_HEADER
+from ubxChecksum import fletcher8, validateFrames
+from ubxIndex import loadSidecar, epochTime, NO_UTC, EPOCH_MESSAGES
+from ubxArrays import MSGDTYPE, decodeFixed, decodeFrames
+from gpsTimestamps import gpsToPosix, GPSMinusUTC
+
+FRAME_INDEX_DTYPE = np.dtype([('offset', '<i8'), ('msgClass', 'u1'), ('msgId', 'u1'), ('length', '<u2'), ('checksumOk', '?')])
+
+
+def buildFrameIndex(buf, start=0, end=None, maxLength=None):
+    # Scan buf[start:end] for UBX frames and return a FRAME_INDEX_DTYPE array.
+    #
+    # A frame that is directly followed by another sync (or the end of the data)
+    # is taken as a frame without checking it here, and all of those are
+    # checksummed together at the end. Frames that are not will be checksummed
+    # on the spot to tell a real frame from a false sync in unframed data.
+    # Frames that line up but fail the checksum are kept with checksumOk False.
+    if end is None:
+        end = len(buf)
+
+    offsets = array('q')
+    classes = array('B')
+    ids = array('B')
+    lengths = array('H')
+    checked = array('b')
+
+    pos = start
+    while True:
+        pos = buf.find(UBX_SYNC, pos, end)
+        if pos < 0 or pos + 8 > end:
+            break
+
+        msgClass, msgId, length = UBX_HEADER.unpack_from(buf, pos+2)
+        frameEnd = pos + length + 8
+        if frameEnd > end or (maxLength is not None and length > maxLength):
+            pos += 2
+            continue
+
+        if frameEnd == end or buf[frameEnd:frameEnd+2] == UBX_SYNC:
+            checked.append(0)
+        elif fletcher8(buf, pos+2, frameEnd-2) == (buf[frameEnd-2], buf[frameEnd-1]):
+            checked.append(1)
+        else:
+            pos += 2
+            continue
+
+        offsets.append(pos)
+        classes.append(msgClass)
+        ids.append(msgId)
+        lengths.append(length)
+        pos = frameEnd
+
+    index = np.zeros(len(offsets), dtype=FRAME_INDEX_DTYPE)
+    index['offset'] = np.frombuffer(offsets, dtype=np.int64)
+    index['msgClass'] = np.frombuffer(classes, dtype=np.uint8)
+    index['msgId'] = np.frombuffer(ids, dtype=np.uint8)
+    index['length'] = np.frombuffer(lengths, dtype=np.uint16)
+
+    checked = np.frombuffer(checked, dtype=np.int8).astype(bool)
+    index['checksumOk'] = checked
+    unchecked = ~checked
+    index['checksumOk'][unchecked] = validateFrames(buf, index['offset'][unchecked], index['length'][unchecked])
+
+    return index
+
+
+def messageTypeMask(index, msgFormats):
+    # Boolean mask of the index entries whose type is one of msgFormats, e.g. ['NAV-PVT', 'NAV-SAT']
+    keys = np.array([(CLIDPAIR[msgFormat][0] << 8) | CLIDPAIR[msgFormat][1] for msgFormat in msgFormats], dtype=np.uint16)
+    return np.isin((index['msgClass'].astype(np.uint16) << 8) | index['msgId'], keys)
+
+
+class UbxFile(object):
+    def __init__(self, path, maxLength=None, useSidecar=True, start=0, end=None):
+        # start and end limit the index to the frames starting in that byte range,
+        # which must begin at a frame boundary (see parseArchive.frameBoundary)
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # mmap can't map an empty file
+        if self.size:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = b''
+
+        # Sidecar index records, covering the first len(self.sidecar) frames of the index
+        self.sidecar = loadSidecar(path, self.size) if useSidecar else None
+        if self.sidecar is not None and not self.checkSidecar():
+            logging.warning('Sidecar index does not match {}, rescanning'.format(path))
+            self.sidecar = None
+
+        if self.sidecar is None:
+            self.index = buildFrameIndex(self.buffer, start, end, maxLength)
+        else:
+            self.index = self.indexFromSidecar(maxLength)
+            if start or end is not None:
+                inRange = self.index['offset'] >= start
+                if end is not None:
+                    inRange &= self.index['offset'] < end
+                self.sidecar = self.sidecar[inRange[:len(self.sidecar)]]
+                self.index = self.index[inRange]
+
+        self.epochFrames = None
+
+    def checkSidecar(self):
+        # Cheap check that the sidecar belongs to this file - sync bytes at the first and last frame
+        for record in (self.sidecar[:1], self.sidecar[-1:]):
+            if len(record):
+                offset = int(record['offset'][0])
+                if self.buffer[offset:offset+2] != UBX_SYNC:
+                    return False
+        return True
+
+    def indexFromSidecar(self, maxLength=None):
+        index = np.zeros(len(self.sidecar), dtype=FRAME_INDEX_DTYPE)
+        for field in ['offset', 'msgClass', 'msgId', 'length']:
+            index[field] = self.sidecar[field]
+        # Only frames that passed the checksum are saved and indexed during capture
+        index['checksumOk'] = True
+
+        # Scan anything written after the last indexed frame
+        start = int(self.sidecar['offset'][-1]) + int(self.sidecar['length'][-1]) + 8 if len(self.sidecar) else 0
+        if start < self.size:
+            index = np.concatenate([index, buildFrameIndex(self.buffer, start=start, maxLength=maxLength)])
+
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            if isinstance(self.buffer, mmap.mmap):
+                self.buffer.close()
+            self.file.close()
+            self.file = None
+            self.buffer = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        # Frame i as (msgClass, msgId, payload, offset), like FrameScanner.frames()
+        entry = self.index[i]
+        offset = int(entry['offset'])
+        length = int(entry['length'])
+        return int(entry['msgClass']), int(entry['msgId']), self.buffer[offset+6:offset+length+6], offset
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self, validOnly=True):
+        offsets = self.index['offset'].tolist()
+        classes = self.index['msgClass'].tolist()
+        ids = self.index['msgId'].tolist()
+        lengths = self.index['length'].tolist()
+        checksumOk = self.index['checksumOk'].tolist()
+        buf = self.buffer
+        for offset, msgClass, msgId, length, ok in zip(offsets, classes, ids, lengths, checksumOk):
+            if validOnly and not ok:
+                continue
+            yield msgClass, msgId, buf[offset+6:offset+length+6], offset
+
+    def rawFrame(self, i):
+        offset = int(self.index['offset'][i])
+        return self.buffer[offset:offset+int(self.index['length'][i])+8]
+
+    def rawRecords(self, offsets, dtype):
+        # Records of dtype at each of the buffer offsets (see ubxArrays.decodeFrames)
+        return decodeFrames(self.buffer, offsets, dtype)
+
+    def messageType(self, i):
+        msgClass = int(self.index['msgClass'][i])
+        msgId = int(self.index['msgId'][i])
+        return CLIDPAIR_INV.get((msgClass, msgId), 'UNKNOWN-0x{:02x}-0x{:02x}'.format(msgClass, msgId))
+
+    def decode(self, i, records=False):
+        # Returns (msgFormat, msgData) for frame i. Raises ValueError if the format is unknown.
+        # With records, msgData is a compact record from MSGRECORD instead of a list of dicts.
+        msgClass, msgId, payload, offset = self[i]
+        if records:
+            return UbloxMessage.decodeRecord(msgClass, msgId, len(payload), payload)
+        return UbloxMessage.decode(msgClass, msgId, len(payload), payload)
+
+    def frameNumbers(self, msgFormats=None, validOnly=True):
+        # Frame numbers, optionally limited to the given message types
+        mask = self.index['checksumOk'] if validOnly else np.ones(len(self.index), dtype=bool)
+        if msgFormats is not None:
+            mask = mask & messageTypeMask(self.index, msgFormats)
+        return np.flatnonzero(mask)
+
+    def messages(self, msgFormats=None, validOnly=True, records=False):
+        # Decoded (msgFormat, msgData) for each frame. Frames of other types are not decoded.
+        for i in self.frameNumbers(msgFormats, validOnly).tolist():
+            try:
+                yield self.decode(i, records)
+            except ValueError:
+                continue
+
+    def decodeArray(self, msgFormat, length=None, validOnly=True):
+        # All frames of a fixed length message type decoded at once into a NumPy
+        # structured array (see ubxArrays). length is only needed for the types
+        # with more than one fixed length. Frames of other lengths are skipped.
+        clid = CLIDPAIR[msgFormat]
+        if length is None:
+            lengths = [key[1] for key in MSGDTYPE if key[0] == clid]
+            if len(lengths) != 1 or lengths[0] is None:
+                raise ValueError('{} is not a message type with a single fixed length'.format(msgFormat))
+            length = lengths[0]
+        _, dtype, _ = MSGDTYPE[(clid, length)]
+        frameNumbers = self.frameNumbers([msgFormat], validOnly)
+        frameNumbers = frameNumbers[self.index['length'][frameNumbers] == length]
+        return decodeFixed(self, frameNumbers, dtype)
+
+    def frameTime(self, i):
+        # UTC time (ns since the POSIX epoch) of epoch frame i, or NO_UTC if it has no valid time
+        if self.sidecar is not None and i < len(self.sidecar):
+            return int(self.sidecar['utc'][i])
+        try:
+            msgFormat, msgData = self.decode(i)
+        except ValueError:
+            return NO_UTC
+        return epochTime(msgData, msgFormat)[1]
+
+    def seek(self, t, gps=False, after=False, leapSeconds=GPSMinusUTC):
+        # Frame number of the first epoch at or after time t (strictly after if after is
+        # True), or len(self) if there is none. t is a UTC datetime or POSIX timestamp,
+        # or a GPS timestamp (seconds since the GPS epoch) if gps is True.
+        target = toUtcNanoseconds(t, gps, leapSeconds)
+        if self.epochFrames is None:
+            self.epochFrames = self.frameNumbers(EPOCH_MESSAGES)
+        epochs = self.epochFrames
+
+        lo = 0
+        hi = len(epochs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            # Epochs without a valid time can't be compared - use the next valid one
+            k = mid
+            value = NO_UTC
+            while k < hi:
+                value = self.frameTime(int(epochs[k]))
+                if value != NO_UTC:
+                    break
+                k += 1
+            if value == NO_UTC:
+                hi = mid
+            elif value < target or (after and value == target):
+                lo = k + 1
+            else:
+                hi = k
+
+        return int(epochs[lo]) if lo < len(epochs) else len(self)
+
+    def framesInWindow(self, start=None, end=None, msgFormats=None, gps=False, validOnly=True, leapSeconds=GPSMinusUTC):
+        # Frame numbers from the first epoch at or after start up to the first epoch
+        # at or after end, optionally limited to the given message types
+        first = self.seek(start, gps, leapSeconds=leapSeconds) if start is not None else 0
+        last = self.seek(end, gps, leapSeconds=leapSeconds) if end is not None else len(self)
+        frameNumbers = self.frameNumbers(msgFormats, validOnly)
+        return frameNumbers[np.searchsorted(frameNumbers, first):np.searchsorted(frameNumbers, last)]
+
+    def limitToWindow(self, start=None, end=None, gps=False, leapSeconds=GPSMinusUTC):
+        # Drop the frames outside framesInWindow(start, end), so everything else only sees the window
+        first = self.seek(start, gps, leapSeconds=leapSeconds) if start is not None else 0
+        last = self.seek(end, gps, leapSeconds=leapSeconds) if end is not None else len(self)
+        if self.sidecar is not None:
+            self.sidecar = self.sidecar[first:last]
+        self.index = self.index[first:last]
+        self.epochFrames = None
+
+    def messagesInWindow(self, start=None, end=None, msgFormats=None, gps=False, leapSeconds=GPSMinusUTC, records=False):
+        for i in self.framesInWindow(start, end, msgFormats, gps, leapSeconds=leapSeconds).tolist():
+            try:
+                yield self.decode(i, records)
+            except ValueError:
+                continue
+
+
+def toUtcNanoseconds(t, gps=False, leapSeconds=GPSMinusUTC):
+    # UTC datetime, POSIX timestamp or GPS timestamp to UTC nanoseconds since the POSIX epoch
+    if isinstance(t, datetime.datetime):
+        return calendar.timegm(t.timetuple()) * 1000000000 + t.microsecond * 1000
+    if gps:
+        t = gpsToPosix(t, leapSeconds)
+    return int(round(t * 1e9))
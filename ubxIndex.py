@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Sidecar index files for UBX captures
+
+A capture ublox_20260101T000000Z.ubx gets an index ublox_20260101T000000Z.ubx.idx
+with one fixed size record per frame: file offset, payload length, class, id,
+and the iTOW and UTC time of the most recent NAV-PVT/HNR-PVT/NAV-TIMEUTC epoch
+at or before the frame. Epoch frames carry their own time.
+
+The index is appended to by UbloxReader.saveMessage during capture and can be
+rebuilt offline from the UBX file with this script.
+"""
+import os
+import struct
+import calendar
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ubloxMessage import CLIDPAIR, CLIDPAIR_INV
+
+SIDECAR_EXTENSION = '.idx'
+SIDECAR_MAGIC = b'UBXIDX'
+SIDECAR_VERSION = 1
+SIDECAR_HEADER = struct.Struct('<6sHI')
+SIDECAR_RECORD = struct.Struct('<QHBBIq')
+
+# Values used before the first epoch, or when the receiver time is not valid
+NO_ITOW = 0xffffffff
+NO_UTC = -(1 << 63)
+
+EPOCH_MESSAGES = ['NAV-PVT', 'HNR-PVT', 'NAV-TIMEUTC']
+
+# Valid flags needed for a UTC time - validDate and validTime, or validUTC for NAV-TIMEUTC
+EPOCH_UTC_VALID = {'NAV-PVT': 0x3, 'HNR-PVT': 0x3, 'NAV-TIMEUTC': 0x4}
+EPOCH_CLIDS = [CLIDPAIR[msgFormat] for msgFormat in EPOCH_MESSAGES]
+
+if np is not None:
+    SIDECAR_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u2'), ('msgClass', 'u1'), ('msgId', 'u1'), ('iTOW', '<u4'), ('utc', '<i8')])
+    assert SIDECAR_DTYPE.itemsize == SIDECAR_RECORD.size
+
+
+def sidecarPath(ubxPath):
+    return ubxPath + SIDECAR_EXTENSION
+
+
+def epochTime(msgData, msgFormat='NAV-PVT'):
+    # (iTOW, UTC nanoseconds since the POSIX epoch) of a decoded NAV-PVT, HNR-PVT or NAV-TIMEUTC
+    data = msgData[0]
+    validMask = EPOCH_UTC_VALID[msgFormat]
+    if (data['Valid'] & validMask) != validMask:
+        return data['ITOW'], NO_UTC
+    seconds = calendar.timegm((data['Year'], data['Month'], data['Day'], data['Hour'], data['Min'], data['Sec'], 0, 0, 0))
+    return data['ITOW'], seconds * 1000000000 + data['Nano']
+
+
+class IndexWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, SIDECAR_RECORD.size))
+        self.iTOW = NO_ITOW
+        self.utc = NO_UTC
+
+    def addFrame(self, offset, msgClass, msgId, length, msgData=None):
+        # msgData is the decoded message, used to update the epoch time on the EPOCH_MESSAGES
+        if msgData is not None and (msgClass, msgId) in EPOCH_CLIDS:
+            self.iTOW, self.utc = epochTime(msgData, CLIDPAIR_INV[(msgClass, msgId)])
+        self.file.write(SIDECAR_RECORD.pack(offset, length, msgClass, msgId, self.iTOW, self.utc))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def loadSidecar(ubxPath, ubxSize=None):
+    # Returns the SIDECAR_DTYPE records, or None if there is no usable index.
+    # Records for frames past the end of the UBX file (i.e. not flushed to it yet)
+    # and a trailing partial record are dropped.
+    path = sidecarPath(ubxPath)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        header = f.read(SIDECAR_HEADER.size)
+        if len(header) < SIDECAR_HEADER.size:
+            return None
+        magic, version, recordSize = SIDECAR_HEADER.unpack(header)
+        if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION or recordSize != SIDECAR_RECORD.size:
+            logging.warning('Ignoring sidecar index {} with unknown format'.format(path))
+            return None
+        data = f.read()
+
+    records = np.frombuffer(data, dtype=SIDECAR_DTYPE, count=len(data) // SIDECAR_DTYPE.itemsize)
+
+    if ubxSize is None:
+        ubxSize = os.path.getsize(ubxPath)
+    complete = (records['offset'] + records['length'] + 8) <= ubxSize
+    if not complete.all():
+        records = records[:np.argmin(complete)]
+
+    return records
+
+
+def buildSidecar(ubxPath):
+    # Rebuild the sidecar index of a UBX file offline. Returns the number of records.
+    # ubxFile imports this module to read sidecars, so import it here.
+    from ubxFile import UbxFile
+
+    with UbxFile(ubxPath, useSidecar=False) as ubxFile:
+        frameNumbers = ubxFile.frameNumbers()
+        index = ubxFile.index[frameNumbers]
+        records = np.zeros(len(index), dtype=SIDECAR_DTYPE)
+        records['offset'] = index['offset']
+        records['length'] = index['length']
+        records['msgClass'] = index['msgClass']
+        records['msgId'] = index['msgId']
+        records['iTOW'] = NO_ITOW
+        records['utc'] = NO_UTC
+
+        # Time of each epoch frame, then carried forward to the frames that follow it
+        epochs = np.zeros(len(index), dtype=bool)
+        for msgClass, msgId in EPOCH_CLIDS:
+            epochs |= (index['msgClass'] == msgClass) & (index['msgId'] == msgId)
+        for i in np.flatnonzero(epochs).tolist():
+            try:
+                msgFormat, msgData = ubxFile.decode(int(frameNumbers[i]))
+            except ValueError:
+                continue
+            records['iTOW'][i], records['utc'][i] = epochTime(msgData, msgFormat)
+
+        last = np.maximum.accumulate(np.where(epochs, np.arange(len(index)), -1))
+        hasEpoch = last >= 0
+        records['iTOW'][hasEpoch] = records['iTOW'][last[hasEpoch]]
+        records['utc'][hasEpoch] = records['utc'][last[hasEpoch]]
+
+    with open(sidecarPath(ubxPath), 'wb') as f:
+        f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, SIDECAR_RECORD.size))
+        f.write(records.tobytes())
+
+    return len(records)
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Rebuild sidecar index files for UBX captures')
+    parser.add_argument('input', nargs='+', help='UBX files to index')
+    args = parser.parse_args()
+
+    for ubxPath in args.input:
+        numRecords = buildSidecar(ubxPath)
+        print('{}: {} frames indexed'.format(sidecarPath(ubxPath), numRecords))
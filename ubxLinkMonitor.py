@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Link throughput and buffer monitor
+
+LinkMonitor subscribes to MON-IO, MON-TXBUF and MON-RXBUF on a reader
+(UbloxReader or AsyncUbloxReader) and combines them with the byte and
+checksum error counters of the reader's FrameScanner. For each receiver
+port it reports the byte rates, the UART utilisation, the TX buffer usage
+and peak, and the receiver's error counters. For the port the host is
+connected through, bytes the receiver sent that never arrived are counted
+as dropped.
+
+The MON messages can be polled (see poll) or enabled as periodic output,
+e.g. with ubxConfig.applyConfig(ublox, ser, MONITOR_PROFILE).
+"""
+import time
+import logging
+
+from ubloxMessage import PORTID_INV
+
+MONITOR_MESSAGES = ['MON-IO', 'MON-TXBUF', 'MON-RXBUF']
+# ubxConfig profile enabling the MON messages once per navigation solution on the current port
+MONITOR_PROFILE = {'CFG-MSG': dict((name, 1) for name in MONITOR_MESSAGES)}
+NUM_PORTS = 6
+# MON-TXBUF errors bits. Bits 0-5 are set when the buffer limit of that port was reached.
+TXBUF_MEM = 0x40
+TXBUF_ALLOC = 0x80
+# Warn above these levels
+UTILISATION_WARNING = 0.8
+TX_PEAK_WARNING = 80
+
+
+def counterDelta(new, old, bits=32):
+    # Difference of two wrapping counters
+    return (new - old) % (1 << bits)
+
+
+class LinkMonitor(object):
+    def __init__(self, reader, port=None, baudRate=None):
+        self.reader = reader
+        # Port the host is connected through, e.g. 1 for UART1. If None, it is taken to be the
+        # port whose transmitted byte count best matches the bytes received.
+        self.port = port
+        # Host link rate, for the utilisation of self.port
+        self.baudRate = baudRate
+        self.monIo = None
+        self.monIoTime = None
+        # hostCounters() when the last MON-IO arrived
+        self.monIoHost = None
+        self.txBuf = None
+        self.rxBuf = None
+        # Baseline for the rates - (time, MON-IO blocks, host bytes, frame bytes, checksum errors)
+        self.baseline = None
+        self.report = None
+        for msgFormat in MONITOR_MESSAGES:
+            reader.subscribe(msgFormat, self.handleMessage)
+
+    def close(self):
+        self.reader.unsubscribe(self.handleMessage)
+
+    def poll(self, *args):
+        # Request the MON messages without waiting for them, e.g. poll(ser) for a UbloxReader
+        # or poll() for an AsyncUbloxReader. The answers arrive through the subscription.
+        for msgFormat in MONITOR_MESSAGES:
+            self.reader.sendMessage(*(args + (msgFormat, 0, [])))
+
+    def hostCounters(self):
+        # Running totals - the scanner stats must not be reset while monitoring
+        scanner = self.reader.scanner
+        return scanner.bytesFed, scanner.frameBytes, scanner.checksumErrors
+
+    def handleMessage(self, msgTime, msgFormat, msgData, rawMessage):
+        if msgFormat == 'MON-TXBUF':
+            self.txBuf = msgData[0]
+        elif msgFormat == 'MON-RXBUF':
+            self.rxBuf = msgData[0]
+        elif msgFormat == 'MON-IO':
+            self.monIo = msgData[1:]
+            self.monIoTime = msgTime
+            self.monIoHost = self.hostCounters()
+            if self.baseline is None:
+                self.baseline = (msgTime, self.monIo) + self.monIoHost
+            elif msgTime > self.baseline[0]:
+                self.report = self.buildReport()
+
+    def buildReport(self):
+        # Rates since the baseline. Returns a dict with the host counters and a 'ports' dict of
+        # port id -> counters.
+        startTime, startIo, startBytes, startFrameBytes, startErrors = self.baseline
+        hostBytes, frameBytes, checksumErrors = self.monIoHost
+        elapsed = self.monIoTime - startTime
+        report = {'elapsed': elapsed,
+                  'hostBytes': hostBytes - startBytes,
+                  'hostRate': (hostBytes - startBytes)*8/elapsed,
+                  'frameBytes': frameBytes - startFrameBytes,
+                  'checksumErrors': checksumErrors - startErrors,
+                  'ports': {}}
+
+        for portId, (block, startBlock) in enumerate(zip(self.monIo, startIo)):
+            if portId >= NUM_PORTS:
+                break
+            txBytes = counterDelta(block['txBytes'], startBlock['txBytes'])
+            rxBytes = counterDelta(block['rxBytes'], startBlock['rxBytes'])
+            port = {'name': PORTID_INV.get(portId, str(portId)),
+                    'txBytes': txBytes,
+                    'rxBytes': rxBytes,
+                    'txRate': txBytes*8/elapsed,
+                    'rxRate': rxBytes*8/elapsed,
+                    'parityErrs': counterDelta(block['parityErrs'], startBlock['parityErrs'], 16),
+                    'framingErrs': counterDelta(block['framingErrs'], startBlock['framingErrs'], 16),
+                    'overrunErrs': counterDelta(block['overrunErrs'], startBlock['overrunErrs'], 16),
+                    'rxBusy': block['rxBusy'],
+                    'txBusy': block['txBusy']}
+            if self.txBuf is not None:
+                port['txPending'] = self.txBuf['pending{}'.format(portId)]
+                port['txUsage'] = self.txBuf['usage{}'.format(portId)]
+                port['txPeakUsage'] = self.txBuf['peakUsage{}'.format(portId)]
+                port['txLimitReached'] = bool(self.txBuf['errors'] & (1 << portId))
+            if self.rxBuf is not None:
+                port['rxPending'] = self.rxBuf['pending{}'.format(portId)]
+                port['rxPeakUsage'] = self.rxBuf['peakUsage{}'.format(portId)]
+            report['ports'][portId] = port
+
+        hostPort = self.port
+        if hostPort is None and report['ports']:
+            hostPort = min(report['ports'], key=lambda portId: abs(report['ports'][portId]['txBytes'] - report['hostBytes']))
+        report['hostPort'] = hostPort
+        if hostPort in report['ports']:
+            port = report['ports'][hostPort]
+            # Both counts end at a MON-IO, so they only differ by what was lost, give or take
+            # the bytes queued in the receiver's TX buffer
+            port['droppedBytes'] = max(port['txBytes'] - report['hostBytes'], 0)
+            if self.baudRate:
+                # 10 bits per byte on a UART
+                port['utilisation'] = port['txBytes']*10/elapsed/self.baudRate
+        if self.txBuf is not None:
+            report['txUsage'] = self.txBuf['tUsage']
+            report['txPeakUsage'] = self.txBuf['tPeakUsage']
+            report['txMemError'] = bool(self.txBuf['errors'] & TXBUF_MEM)
+            report['txAllocError'] = bool(self.txBuf['errors'] & TXBUF_ALLOC)
+        return report
+
+    def reset(self):
+        # Start a new interval from the last MON-IO
+        if self.monIo is not None:
+            self.baseline = (self.monIoTime, self.monIo) + self.monIoHost
+        self.report = None
+
+    def warnings(self, report=None):
+        # List of problems in a report - the link is, or is about to be, losing data
+        report = report or self.report
+        if report is None:
+            return []
+        messages = []
+        if report['checksumErrors']:
+            messages.append('{} checksum errors on the host'.format(report['checksumErrors']))
+        for portId, port in sorted(report['ports'].items()):
+            if port.get('droppedBytes'):
+                messages.append('{}: {} bytes sent but not received'.format(port['name'], port['droppedBytes']))
+            if port.get('utilisation', 0) > UTILISATION_WARNING:
+                messages.append('{}: {:.0f}% of the link rate used'.format(port['name'], port['utilisation']*100))
+            if port.get('txPeakUsage', 0) > TX_PEAK_WARNING:
+                messages.append('{}: TX buffer peaked at {}%'.format(port['name'], port['txPeakUsage']))
+            if port.get('txLimitReached'):
+                messages.append('{}: TX buffer limit reached'.format(port['name']))
+            for counter in ['parityErrs', 'framingErrs', 'overrunErrs']:
+                if port[counter]:
+                    messages.append('{}: {} {}'.format(port['name'], port[counter], counter))
+        if report.get('txMemError') or report.get('txAllocError'):
+            messages.append('TX buffer allocation error')
+        return messages
+
+    @staticmethod
+    def formatReport(report):
+        lines = ['Host: {:.1f} kbps, {} checksum errors (port {})'.format(report['hostRate']/1e3, report['checksumErrors'], report['hostPort'])]
+        for portId, port in sorted(report['ports'].items()):
+            if not (port['txBytes'] or port['rxBytes'] or port.get('txPending')):
+                continue
+            line = '{:>6}: TX {:.1f} kbps, RX {:.1f} kbps'.format(port['name'], port['txRate']/1e3, port['rxRate']/1e3)
+            if 'utilisation' in port:
+                line += ', {:.0f}% used'.format(port['utilisation']*100)
+            if 'txPeakUsage' in port:
+                line += ', TX buffer {}% (peak {}%, {} B pending)'.format(port['txUsage'], port['txPeakUsage'], port['txPending'])
+            if 'droppedBytes' in port:
+                line += ', {} B dropped'.format(port['droppedBytes'])
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+if __name__=='__main__':
+    import argparse
+    import serial
+    import serial.threaded
+    from ublox2 import UbloxReader
+    parser = argparse.ArgumentParser(description='Report link throughput and buffer usage from MON-IO, MON-TXBUF and MON-RXBUF')
+    parser.add_argument('--device', '-d', default='/dev/ttyHS1', help='Specify the serial port device to communicate with. e.g. /dev/ttyO5')
+    parser.add_argument('--baudrate', '-b', type=int, default=115200)
+    parser.add_argument('--port', '-p', help='Receiver port the host is connected to, e.g. UART1. Found from the byte counts if not given.')
+    parser.add_argument('--interval', '-i', type=float, default=5, help='Seconds between reports')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    from ubxConfig import portId
+    ser = serial.Serial(args.device, args.baudrate, timeout=1)
+    with serial.threaded.ReaderThread(ser, UbloxReader) as ublox:
+        monitor = LinkMonitor(ublox, portId(args.port) if args.port is not None else None, args.baudrate)
+        try:
+            monitor.poll(ser)
+            while True:
+                time.sleep(args.interval)
+                monitor.poll(ser)
+                # Let the answers arrive
+                time.sleep(0.2)
+                if monitor.report is None:
+                    print('No MON-IO received')
+                    continue
+                print(LinkMonitor.formatReport(monitor.report))
+                for message in monitor.warnings():
+                    print('  WARNING: {}'.format(message))
+                monitor.reset()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Request/response correlation for polls and config messages
+
+RequestTable keeps the pending requests keyed by the response they expect:
+the (class, id) of a polled message, or the ClsID/MsgID an ACK-ACK/ACK-NACK
+refers to. Each request is a future that the parser resolves, so any number
+of polls and config messages can be outstanding at once and an ACK is only
+matched to the message it acknowledges.
+"""
+import time
+import threading
+import concurrent.futures
+
+from ubloxMessage import CLIDPAIR
+
+ACK_CLIDS = (CLIDPAIR['ACK-ACK'], CLIDPAIR['ACK-NACK'])
+
+
+def pollKey(msgFormat):
+    # Key for a poll - the (class, id) of the response
+    return CLIDPAIR[msgFormat]
+
+def ackKey(msgFormat):
+    # Key for a config message - its ACK-ACK/ACK-NACK
+    return ('ACK',) + CLIDPAIR[msgFormat]
+
+
+class RequestTable(object):
+    def __init__(self, futureFactory=concurrent.futures.Future):
+        # Creates the futures, e.g. loop.create_future for asyncio
+        self.futureFactory = futureFactory
+        self.lock = threading.Lock()
+        # key -> list of (future, match)
+        self.pending = {}
+        # future -> time after which a discarded request is removed
+        self.expiry = {}
+
+    def add(self, key, match=None):
+        # Returns a future resolved with (msgFormat, msgData) of the response. match is an
+        # optional function of msgData to tell apart responses with the same key, e.g.
+        # CFG-MSG polls for different messages.
+        future = self.futureFactory()
+        with self.lock:
+            if self.expiry:
+                self.removeExpired()
+            self.pending.setdefault(key, []).append((future, match))
+        return future
+
+    def discard(self, key, future, timeout):
+        # Stop waiting for a request whose response may still arrive, e.g. to an earlier
+        # attempt of a resent message. It stays registered for up to timeout seconds so the
+        # response, if it comes, is not taken for the response to a later request.
+        with self.lock:
+            if any(request[0] is future for request in self.pending.get(key, ())):
+                self.expiry[future] = time.time() + timeout
+
+    def removeExpired(self):
+        # With the lock held
+        now = time.time()
+        for key in list(self.pending):
+            requests = [request for request in self.pending[key] if self.expiry.get(request[0], now) >= now]
+            if requests:
+                self.pending[key] = requests
+            else:
+                del self.pending[key]
+        self.expiry = dict((future, expiry) for future, expiry in self.expiry.items() if expiry >= now)
+
+    def remove(self, key, future):
+        with self.lock:
+            self.expiry.pop(future, None)
+            requests = [request for request in self.pending.get(key, ()) if request[0] is not future]
+            if requests:
+                self.pending[key] = requests
+            else:
+                self.pending.pop(key, None)
+
+    def wants(self, msgClass, msgId):
+        # Whether a message must be decoded to resolve a request
+        if (msgClass, msgId) in ACK_CLIDS:
+            return any(key[0] == 'ACK' for key in self.pending)
+        return (msgClass, msgId) in self.pending
+
+    def resolve(self, msgFormat, msgData):
+        # Resolve the oldest request waiting for this message. The receiver answers in
+        # order, so responses go to the requests in the order they were sent, as long as
+        # every message sent that gets this response has a request waiting (see
+        # ubxConfig.pipeline - an ACK only carries the class and id). Returns the number
+        # resolved (0 or 1).
+        if msgFormat in ('ACK-ACK', 'ACK-NACK'):
+            key = ('ACK', msgData[0]['ClsID'], msgData[0]['MsgID'])
+        else:
+            # None for NMEA sentences
+            key = CLIDPAIR.get(msgFormat)
+        with self.lock:
+            requests = self.pending.get(key)
+            if not requests:
+                return 0
+            for i, (future, match) in enumerate(requests):
+                if not future.done() and (match is None or match(msgData)):
+                    break
+            else:
+                return 0
+            del requests[i]
+            if not requests:
+                del self.pending[key]
+            self.expiry.pop(future, None)
+        future.set_result((msgFormat, msgData))
+        return 1
+
+    def failAll(self, exc):
+        with self.lock:
+            requests = [request for requests in self.pending.values() for request in requests]
+            self.pending = {}
+            self.expiry = {}
+        for future, match in requests:
+            if not future.done():
+                future.set_exception(exc)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(requests) for requests in self.pending.values())
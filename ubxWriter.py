@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Background writer for UBX captures
+
+CaptureWriter takes raw frames from the parser thread into a bounded queue
+and writes them from its own thread, so a slow disk or SD card never stalls
+the serial reader. The writer thread coalesces the queued frames into large
+writes, opens and rotates the files and writes the sidecar index.
+
+Files rotate at the hour or day of the NAV-PVT time (as UbloxReader's
+saveInterval always has) and, optionally, when they reach a maximum size.
+With compression ('zlib' or 'lzma') the files are written as seekable .ubz
+files (see ubxCompressed), whose block index takes the place of the sidecar
+index. If the queue is full, frames are dropped and counted rather than blocking
+the reader. stats() reports the queue depth and write latency, to show
+storage back-pressure before frames are lost.
+"""
+import os
+import time
+import datetime
+import threading
+import collections
+import logging
+
+from ubxIndex import IndexWriter, sidecarPath, EPOCH_MESSAGES
+from ubxCompressed import UbzWriter, DEFAULT_BLOCK_SIZE, DEFAULT_BLOCK_AGE
+
+DEFAULT_MAX_QUEUE_BYTES = 32*1024*1024
+# The writer wakes when this much is queued, or after flushInterval
+BATCH_BYTES = 256*1024
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+
+class CaptureWriter(object):
+    def __init__(self, baseName, interval=None, maxFileSize=None, index=True, fsyncInterval=None,
+                 maxQueueBytes=DEFAULT_MAX_QUEUE_BYTES, flushInterval=DEFAULT_FLUSH_INTERVAL, extension=None, logger=logging,
+                 compression=None, blockSize=DEFAULT_BLOCK_SIZE):
+        # Files are named <baseName>_<UTC time>.<extension>
+        self.baseName = baseName
+        # Codec of .ubz files, or None for plain .ubx files
+        self.compression = compression
+        self.blockSize = blockSize
+        if extension is None:
+            extension = 'ubz' if compression is not None else 'ubx'
+        self.extension = extension
+        # 'hourly', 'daily' or None for one file (apart from size rotation)
+        self.interval = interval
+        # Start a new file before one grows past this many bytes (before compression), None for no limit
+        self.maxFileSize = maxFileSize
+        self.index = index
+        # Seconds between fsyncs of the files, 0 to fsync every write or None to leave it to the OS
+        self.fsyncInterval = fsyncInterval
+        self.maxQueueBytes = maxQueueBytes
+        self.flushInterval = flushInterval
+        self.logger = logger
+
+        # Queue of (msgTime, msgFormat, msgData, rawMessage), guarded by condition
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        self.queueBytes = 0
+        self.closing = False
+        self.error = None
+
+        # Current file, only used by the writer thread
+        self.file = None
+        self.fileName = None
+        self.fileSize = 0
+        self.indexWriter = None
+        self.curInterval = None
+        self.lastEpoch = None
+        self.lastFsyncTime = time.time()
+
+        self.resetStats()
+        self.thread = threading.Thread(target=self.run, name='CaptureWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def resetStats(self):
+        with self.condition:
+            self.peakQueueBytes = self.queueBytes
+            self.peakQueueFrames = len(self.queue)
+            self.droppedFrames = 0
+            self.droppedBytes = 0
+        self.bytesWritten = 0
+        self.writes = 0
+        self.writeTime = 0.0
+        self.maxWriteTime = 0.0
+        self.statsStartTime = time.time()
+
+    def put(self, msgTime, msgFormat, msgData, rawMessage):
+        # Queue a frame. Only epoch messages need msgData, for the file rotation and index.
+        # Returns False if the queue is full and the frame was dropped.
+        if msgFormat not in EPOCH_MESSAGES:
+            msgData = None
+        with self.condition:
+            if self.queueBytes + len(rawMessage) > self.maxQueueBytes or self.error is not None or self.closing:
+                if not self.droppedFrames:
+                    self.logger.warning('Capture writer queue full ({} bytes), dropping frames'.format(self.queueBytes))
+                self.droppedFrames += 1
+                self.droppedBytes += len(rawMessage)
+                return False
+            self.queue.append((msgTime, msgFormat, msgData, rawMessage))
+            self.queueBytes += len(rawMessage)
+            if self.queueBytes > self.peakQueueBytes:
+                self.peakQueueBytes = self.queueBytes
+                self.peakQueueFrames = len(self.queue)
+            if self.queueBytes >= BATCH_BYTES:
+                self.condition.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.closing and self.queueBytes < BATCH_BYTES:
+                    self.condition.wait(self.flushInterval)
+                batch = self.queue
+                self.queue = collections.deque()
+                self.queueBytes = 0
+                closing = self.closing
+            if batch and self.error is None:
+                try:
+                    self.writeBatch(batch)
+                except (IOError, OSError) as exc:
+                    self.logger.error('Capture writer failed, frames will be dropped: {}'.format(exc))
+                    self.error = exc
+            if closing:
+                break
+        try:
+            self.closeFile()
+        except (IOError, OSError) as exc:
+            self.logger.error('Capture writer failed to close {}: {}'.format(self.fileName, exc))
+
+    def writeBatch(self, batch):
+        startTime = time.time()
+        chunks = []
+        chunkSize = 0
+        written = 0
+        for msgTime, msgFormat, msgData, rawMessage in batch:
+            if msgData is not None:
+                self.lastEpoch = msgData[0]
+            newFile = self.rotation(msgTime, msgFormat, msgData, self.fileSize + chunkSize, len(rawMessage))
+            if newFile is not None:
+                if chunks:
+                    self.file.write(b''.join(chunks))
+                    written += chunkSize
+                    chunks = []
+                    chunkSize = 0
+                self.openFile(newFile)
+            if self.file is None:
+                # Waiting for the first NAV-PVT to name an hourly/daily file
+                continue
+            chunks.append(rawMessage)
+            if self.indexWriter is not None:
+                self.indexWriter.addFrame(self.fileSize + chunkSize, rawMessage[2], rawMessage[3], len(rawMessage) - 8, msgData)
+            chunkSize += len(rawMessage)
+        if chunks:
+            self.file.write(b''.join(chunks))
+            written += chunkSize
+        self.fileSize += chunkSize
+
+        if self.file is not None:
+            self.file.flush()
+            if self.indexWriter is not None:
+                self.indexWriter.flush()
+            if self.fsyncInterval is not None and time.time() - self.lastFsyncTime >= self.fsyncInterval:
+                os.fsync(self.file.fileno())
+                if self.indexWriter is not None and self.indexWriter is not self.file:
+                    os.fsync(self.indexWriter.file.fileno())
+                self.lastFsyncTime = time.time()
+
+        elapsed = time.time() - startTime
+        self.writes += 1
+        self.writeTime += elapsed
+        self.maxWriteTime = max(self.maxWriteTime, elapsed)
+        self.bytesWritten += written
+
+    def rotation(self, msgTime, msgFormat, msgData, fileSize, length):
+        # Name of the file to start before this frame, or None to keep writing the current one.
+        # fileSize includes the frames of this batch not written yet.
+        if self.interval is not None and msgFormat == 'NAV-PVT':
+            interval = msgData[0]['Hour'] if self.interval == 'hourly' else msgData[0]['Day']
+            if interval != self.curInterval:
+                self.curInterval = interval
+                return self.newFileName(msgTime)
+        if self.file is None:
+            return self.newFileName(msgTime) if self.interval is None else None
+        if self.maxFileSize is not None and fileSize and fileSize + length > self.maxFileSize:
+            return self.newFileName(msgTime)
+        return None
+
+    def newFileName(self, msgTime):
+        # Named by the last NAV-PVT time for interval files, otherwise the host time of the frame
+        epoch = self.lastEpoch
+        if self.interval is not None and epoch is not None:
+            dt = datetime.datetime(epoch['Year'], epoch['Month'], epoch['Day'], epoch['Hour'], epoch['Min'], epoch['Sec'])
+        else:
+            dt = datetime.datetime.utcfromtimestamp(msgTime)
+        stem = '{}_{}'.format(self.baseName, dt.strftime('%Y%m%dT%H%M%SZ'))
+        filename = '{}.{}'.format(stem, self.extension)
+        # Size rotation can start several files in the same second
+        suffix = 1
+        while os.path.exists(filename) or filename == self.fileName:
+            filename = '{}_{}.{}'.format(stem, suffix, self.extension)
+            suffix += 1
+        return filename
+
+    def openFile(self, filename):
+        self.closeFile()
+        self.logger.info('*** Opening save file {} for write'.format(filename))
+        if self.compression is not None:
+            # Frames are written in whole frames, so blocks are cut at frame boundaries
+            self.file = UbzWriter(filename, self.compression, self.blockSize, maxBlockAge=DEFAULT_BLOCK_AGE)
+        else:
+            self.file = open(filename, 'wb')
+        self.fileName = filename
+        self.fileSize = 0
+        if self.compression is not None:
+            # The block index replaces the sidecar, and needs the epoch times
+            self.indexWriter = self.file
+        elif self.index:
+            self.indexWriter = IndexWriter(sidecarPath(filename))
+
+    def closeFile(self):
+        # Close the UBX file first so the index never points past the end of the saved data
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.indexWriter is not None:
+            self.indexWriter.close()
+            self.indexWriter = None
+
+    def stats(self, reset=False):
+        # Queue depth, drops and write latency since the last reset
+        with self.condition:
+            stats = {'queueBytes': self.queueBytes,
+                     'queueFrames': len(self.queue),
+                     'peakQueueBytes': self.peakQueueBytes,
+                     'peakQueueFrames': self.peakQueueFrames,
+                     'droppedFrames': self.droppedFrames,
+                     'droppedBytes': self.droppedBytes}
+        elapsed = max(time.time() - self.statsStartTime, 1e-9)
+        stats.update({'bytesWritten': self.bytesWritten,
+                      'writeRate': self.bytesWritten/elapsed,
+                      'writes': self.writes,
+                      'meanWriteTime': self.writeTime/self.writes if self.writes else 0.0,
+                      'maxWriteTime': self.maxWriteTime,
+                      'fileName': self.fileName,
+                      'error': self.error})
+        if reset:
+            self.resetStats()
+        return stats
+
+    @staticmethod
+    def formatStats(stats):
+        text = 'writer queue {:.0f} KB (peak {:.0f} KB), {:.1f} KB/s in {} writes, write {:.1f} ms (max {:.1f} ms)'.format(
+            stats['queueBytes']/1e3, stats['peakQueueBytes']/1e3, stats['writeRate']/1e3, stats['writes'],
+            stats['meanWriteTime']*1e3, stats['maxWriteTime']*1e3)
+        if stats['droppedFrames']:
+            text += ', {} frames ({} B) dropped'.format(stats['droppedFrames'], stats['droppedBytes'])
+        if stats['error'] is not None:
+            text += ', error: {}'.format(stats['error'])
+        return text
+
+    def close(self):
+        # Write everything queued and close the files
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()